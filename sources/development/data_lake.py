@@ -0,0 +1,152 @@
+"""
+Local data lake of the Chicago taxi trips, partitioned by trip start day.
+
+The trips are stored as Hive partitioned parquet files:
+
+    <root>/year=2022/month=4/day=1/part-0.parquet
+
+Each day is downloaded as one query window (downloader.download_windows), converted
+to parquet with the same columns and types for every day, and marked as complete
+with a _SUCCESS file. Reads only download the missing days of the requested range,
+and only open the partitions of the range, with the given columns and filters.
+
+Classes:
+
+    TripsDataLake
+
+"""
+
+import os
+import csv
+import shutil
+from typing import List, Optional
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet as pq
+
+from development import downloader
+from development.preprocessor import Preprocessor
+
+DATA_LAKE_PATH = os.getenv(
+    "DATA_LAKE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "chicago-taxi", "trips"),
+)
+DATE_FIELDS = ["Trip Start Timestamp", "Trip End Timestamp"]
+DTYPE = {"Pickup Community Area": str, "Dropoff Community Area": str}
+# Text columns of the trips csv (after renaming). The others are floats
+STRING_COLUMNS = [
+    "trip_id",
+    "taxi_id",
+    "pickup_community_area",
+    "dropoff_community_area",
+    "payment_type",
+    "company",
+    "pickup_centroid_location",
+    "dropoff_centroid__location",
+]
+PART_FILE = "part-0.parquet"
+SUCCESS_FILE = "_SUCCESS"
+# Ignored by the parquet readers, as any path starting with "_"
+STAGING_DIR = "_staging"
+
+
+def column_types(csv_path: str) -> dict:
+    """Arrow types of the trips csv columns, the same for all the days"""
+    with open(csv_path, newline="") as f_in:
+        header = next(csv.reader(f_in), [])
+    types = {}
+    for column in header:
+        name = column.lower().replace(" ", "_")
+        if column in DATE_FIELDS:
+            types[column] = pa.timestamp("ns")
+        elif name in STRING_COLUMNS:
+            types[column] = pa.string()
+        else:
+            types[column] = pa.float64()
+    return types
+
+
+class TripsDataLake:
+    def __init__(
+        self,
+        root: str = DATA_LAKE_PATH,
+        base_url: str = downloader.CHICAGO_TRIPS_URL,
+        max_workers: int = downloader.DOWNLOAD_WORKERS,
+    ):
+
+        self.root = root
+        self.base_url = base_url
+        self.max_workers = max_workers
+
+    def partition_dir(self, day: date) -> str:
+        return os.path.join(
+            self.root, f"year={day.year}", f"month={day.month}", f"day={day.day}"
+        )
+
+    def days(self, start: date, end: date) -> List[date]:
+
+        # Days in [start, end)
+        return [start + timedelta(days=i) for i in range((end - start).days)]
+
+    def missing_days(self, start: date, end: date) -> List[date]:
+
+        return [
+            day
+            for day in self.days(start, end)
+            if not os.path.exists(os.path.join(self.partition_dir(day), SUCCESS_FILE))
+        ]
+
+    def download(self, days: List[date]):
+
+        staging_dir = os.path.join(self.root, STAGING_DIR)
+        starts = [datetime.combine(day, datetime.min.time()) for day in days]
+        windows = [(start, start + timedelta(days=1)) for start in starts]
+        # Part files are kept until converted, so a failed run resumes the download
+        part_paths = downloader.download_windows(
+            windows, staging_dir, self.base_url, self.max_workers
+        )
+
+        preprocessor = Preprocessor()
+        for day, part_path in zip(days, part_paths):
+            parquet_path, _ = preprocessor.convert_csv(
+                part_path, DATE_FIELDS, DTYPE, column_types=column_types(part_path)
+            )
+            partition_dir = self.partition_dir(day)
+            os.makedirs(partition_dir, exist_ok=True)
+            os.replace(parquet_path, os.path.join(partition_dir, PART_FILE))
+            # The partition is complete
+            open(os.path.join(partition_dir, SUCCESS_FILE), "w").close()
+            os.remove(part_path)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def ensure(self, start: date, end: date) -> List[str]:
+        """Downloads the missing days. Returns the files of the days in [start, end)"""
+        missing = self.missing_days(start, end)
+        if missing:
+            print(f"Downloading {len(missing)} days of trips into {self.root}")
+            self.download(missing)
+        return [
+            os.path.join(self.partition_dir(day), PART_FILE)
+            for day in self.days(start, end)
+        ]
+
+    def read(
+        self,
+        start: date,
+        end: date,
+        columns: Optional[List[str]] = None,
+        filters: Optional[list] = None,
+    ) -> pd.DataFrame:
+        """
+        Trips that started in [start, end), only the columns, and the rows that pass
+        the filters (pyarrow filters, e.g. preprocessor.TRIP_SECONDS_FILTERS)
+        """
+        files = self.ensure(start, end)
+        if not files:
+            return pd.DataFrame(columns=columns)
+        # The partition keys are not added as columns: the frame has the csv columns
+        return pq.read_table(
+            files, columns=columns, filters=filters, partitioning=None
+        ).to_pandas()
@@ -1,6 +1,13 @@
 """
 This module downloads datasets from data.cityofchicago.org API and stores them as csv files
 
+The requested period is split into query windows (one day by default) that are
+downloaded concurrently by a bounded thread pool. Each window is written to its own
+part file, which is only renamed to its final name when it is complete, so that a
+failed download is retried (resuming with a Range request when the server allows
+it) and a rerun only downloads the missing windows. The parts are then merged into
+the output csv file.
+
 Functions:
 
   download_file(url:str, output_filename:str)
@@ -9,13 +16,50 @@ Functions:
   Downloads a dataset from the chicago taxi api, according to the specified parameters.
   If days = 0, it will download the enrtire month
 
+  query_url(start: datetime, end: datetime, base_url: str)
+  query_windows(start: datetime, end: datetime, window: timedelta)
+  content_range_size(response: requests.Response)
+  download_window(url: str, part_path: str, retries: int)
+  download_windows(windows, parts_dir: str, base_url: str, max_workers: int)
+  merge_parts(part_paths, output_filename: str)
+  dataset_range(year: int, month: int, days: int)
+
 """
 
-from datetime import datetime
+import os
+import time
+import shutil
+import logging
+import threading
+from typing import List, Tuple, Optional
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from dateutil.relativedelta import relativedelta
 
+CHICAGO_TRIPS_URL = os.getenv(
+    "CHICAGO_TRIPS_URL", "https://data.cityofchicago.org/api/views/wrvz-psew/rows.csv"
+)
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_RETRIES = 3
+# (connect, read) timeouts. The read timeout is the longest wait for data from the
+# server, so that a stalled download raises, and is retried (resuming it)
+DOWNLOAD_CONNECT_TIMEOUT_SEC = 10
+DOWNLOAD_TIMEOUT_SEC = float(os.getenv("DOWNLOAD_TIMEOUT_SEC", "60"))
+CHUNK_SIZE = 1 << 20
+
+# One keep-alive session per worker thread
+_sessions = threading.local()
+
+
+def get_session() -> requests.Session:
+
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
 
 def download_file(url: str, output_filename: str):
     if output_filename is None:
@@ -31,27 +75,157 @@ def download_file(url: str, output_filename: str):
     return output_filename
 
 
-def download_dataset(year: int, month: int, days: int, output_filename: str):
+def query_url(start: datetime, end: datetime, base_url: str = CHICAGO_TRIPS_URL):
 
-    # the path of the output_filename path must exist
+    # Trips with start timestamp in [start, end)
+    query = (
+        "select * where `trip_start_timestamp` >= "
+        f"'{start:%Y-%m-%dT%H:%M:%S}' AND `trip_start_timestamp` < "
+        f"'{end:%Y-%m-%dT%H:%M:%S}'"
+    )
+    return (
+        f"{base_url}?query={quote(query, safe='*')}"
+        "&read_from_nbe=true&version=2.1&accessType=DOWNLOAD"
+    )
 
+
+def query_windows(
+    start: datetime, end: datetime, window: timedelta = timedelta(days=1)
+) -> List[Tuple[datetime, datetime]]:
+
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window, end)))
+        start += window
+    return windows
+
+
+def content_range_size(response: requests.Response) -> Optional[int]:
+
+    # Size of the file in the Content-Range header ("bytes */1234" in a 416)
+    size = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(size) if size.isdigit() else None
+
+
+def download_window(url: str, part_path: str, retries: int = DOWNLOAD_RETRIES):
+    """
+    Downloads url into part_path. The data is written to part_path.tmp, and renamed
+    when complete. A complete part is not downloaded again. A partial download is
+    resumed from its size; if the server has nothing after it (416), it was
+    complete.
+    """
+    if os.path.exists(part_path):
+        return part_path
+
+    temp_path = f"{part_path}.tmp"
+    for attempt in range(retries + 1):
+        # Resume the partial download, if any
+        offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with get_session().get(
+                url,
+                stream=True,
+                headers=headers,
+                timeout=(DOWNLOAD_CONNECT_TIMEOUT_SEC, DOWNLOAD_TIMEOUT_SEC),
+            ) as response:
+                if response.status_code == 416 and offset:
+                    # Nothing after offset: the partial file may be complete
+                    if content_range_size(response) in (None, offset):
+                        os.replace(temp_path, part_path)
+                        return part_path
+                    # Not the file of the server: downloaded again
+                    os.remove(temp_path)
+                response.raise_for_status()
+                # 206: the server sends the rest of the file. 200: the whole file
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(temp_path, mode) as f_out:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f_out.write(chunk)
+            os.replace(temp_path, part_path)
+            return part_path
+        except requests.RequestException as error:
+            if attempt == retries:
+                raise
+            logging.warning(
+                "Download of %s failed (%s), retrying",
+                os.path.basename(part_path),
+                error,
+            )
+            time.sleep(2**attempt * 0.5)
+    return part_path
+
+
+def download_windows(
+    windows: List[Tuple[datetime, datetime]],
+    parts_dir: str,
+    base_url: str = CHICAGO_TRIPS_URL,
+    max_workers: int = DOWNLOAD_WORKERS,
+) -> List[str]:
+
+    os.makedirs(parts_dir, exist_ok=True)
+    part_paths = [
+        os.path.join(parts_dir, f"part-{start:%Y%m%d%H}-{end:%Y%m%d%H}.csv")
+        for start, end in windows
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_window, query_url(start, end, base_url), path)
+            for (start, end), path in zip(windows, part_paths)
+        ]
+        # Raises the first error, after all the downloads have finished
+        for future in futures:
+            future.result()
+    return part_paths
+
+
+def merge_parts(part_paths: List[str], output_filename: str):
+
+    # Each part has the csv header: only the first one is kept
+    temp_path = f"{output_filename}.tmp"
+    with open(temp_path, "wb") as f_out:
+        for i, part_path in enumerate(part_paths):
+            with open(part_path, "rb") as f_in:
+                header = f_in.readline()
+                if i == 0:
+                    f_out.write(header)
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+    os.replace(temp_path, output_filename)
+    return output_filename
+
+
+def dataset_range(year: int, month: int, days: int) -> Tuple[datetime, datetime]:
+
+    # Trips with start timestamp in [start_date, end_date)
     start_date = datetime(year, month, 1)
     if days == 0:
         end_date = start_date + relativedelta(months=1, days=-1)
     else:
         end_date = datetime(year, month, days)
+    return start_date, end_date
 
-    start_date = start_date.strftime("%Y-%m-%d")
-    end_date = end_date.strftime("%Y-%m-%d")
 
-    uri = (
-        "https://data.cityofchicago.org/api/views/wrvz-psew/rows.csv?"
-        + "query=select%20*%20where%20%60trip_start_timestamp%60%20%3E%3D%20%27"
-        + f"{start_date}%27%20AND%20%60trip_start_timestamp%60%20%3C%20%27"
-        + f"{end_date}%27&read_from_nbe=true&version=2.1&accessType=DOWNLOAD"
-    )
+def download_dataset(
+    year: int,
+    month: int,
+    days: int,
+    output_filename: str,
+    window: timedelta = timedelta(days=1),
+    max_workers: int = DOWNLOAD_WORKERS,
+    base_url: str = CHICAGO_TRIPS_URL,
+):
+
+    # the path of the output_filename path must exist
 
-    output_filename = download_file(uri, output_filename)
+    start_date, end_date = dataset_range(year, month, days)
+
+    # Parts are kept until they are merged, so that a rerun resumes the download
+    parts_dir = f"{output_filename}.parts"
+    part_paths = download_windows(
+        query_windows(start_date, end_date, window), parts_dir, base_url, max_workers
+    )
+    output_filename = merge_parts(part_paths, output_filename)
+    shutil.rmtree(parts_dir)
 
     return output_filename
 
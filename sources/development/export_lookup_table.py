@@ -0,0 +1,96 @@
+"""
+Exports the registered model (LinReg/GBRegressor pipeline from development/model.py)
+as a lookup table that production/model_service.py can serve without sklearn or mlflow.
+
+The pipeline is evaluated over the full cross product of the community areas, and the
+result is checked against the pipeline on a shuffled sample of the inputs (or on a
+preprocessed parquet dataset if PARITY_SET_PATH is set).
+
+Functions:
+
+    export_registered_model(tracking_uri, name, stage, output_path, parity_set)
+
+"""
+
+import os
+from typing import Optional
+
+import numpy as np
+import mlflow
+import pandas as pd
+from mlflow.tracking import MlflowClient
+
+from production.lookup_table import (
+    FEATURES,
+    COMMUNITY_AREAS,
+    check_parity,
+    export_lookup_table,
+)
+
+PARITY_TOLERANCE = 1e-6
+
+
+def export_registered_model(
+    tracking_uri: str,
+    name: str,
+    stage: str,
+    output_path: str,
+    parity_set: Optional[pd.DataFrame] = None,
+):
+
+    client = MlflowClient(tracking_uri=tracking_uri)
+    model_version = client.get_latest_versions(name=name, stages=[stage])[0]
+    print(
+        f"Exporting model {name}: version={model_version.version}, "
+        f"run_id={model_version.run_id}"
+    )
+
+    mlflow.set_tracking_uri(tracking_uri)
+    model = mlflow.pyfunc.load_model(f"models:/{name}/{model_version.version}")
+
+    lookup_model = export_lookup_table(
+        model,
+        output_path,
+        metadata={
+            "name": name,
+            "version": str(model_version.version),
+            "run_id": model_version.run_id,
+        },
+    )
+
+    if parity_set is None:
+        rng = np.random.default_rng(42)
+        parity_set = pd.DataFrame(
+            {feature: rng.choice(COMMUNITY_AREAS, size=10_000) for feature in FEATURES}
+        )
+    max_error = check_parity(model, lookup_model, parity_set[FEATURES])
+    print(f"Parity check on {len(parity_set)} rows: max abs error = {max_error}")
+    if max_error > PARITY_TOLERANCE:
+        raise ValueError(
+            f"Lookup table does not match the model: max abs error {max_error}"
+        )
+
+    return lookup_model
+
+
+if __name__ == "__main__":
+
+    MLFLOW_MODEL_STAGE = os.getenv("MLFLOW_MODEL_STATE", "Staging")
+    MLFLOW_MODEL_NAME = os.getenv("MLFLOW_MODEL_NAME", "chicago-taxi")
+    MLFLOW_TRACKING_URI = os.getenv("MLFLOW_TRACKING_URI", "http://127.0.0.1:8080")
+    LOOKUP_TABLE_LOCATION = os.getenv("LOOKUP_TABLE_LOCATION", "./lookup_table")
+    # Optional parquet file produced by the Preprocessor, e.g. Taxi_Trips_2022_04.parquet
+    PARITY_SET_PATH = os.getenv("PARITY_SET_PATH", "")
+
+    parity_set = None
+    if PARITY_SET_PATH != "":
+        parity_set = pd.read_parquet(PARITY_SET_PATH, columns=FEATURES)
+        parity_set = parity_set.fillna("-1").astype(str)
+
+    export_registered_model(
+        MLFLOW_TRACKING_URI,
+        MLFLOW_MODEL_NAME,
+        MLFLOW_MODEL_STAGE,
+        LOOKUP_TABLE_LOCATION,
+        parity_set,
+    )
@@ -0,0 +1,172 @@
+"""
+On-disk cache of the preprocessed datasets (Preprocessor.process), shared by the
+training pipeline, the batch monitoring and the replay (send_data.py).
+
+Entries are content addressed: the key is the hash of the input file and of the
+preprocessing parameters (feature lists, dtypes, Preprocessor source). The input
+can also be a list of files, e.g. the daily partitions of the data lake. Each entry
+is a parquet file with the features (categories included) and the target. The
+least recently used entries are evicted when the cache is larger than max_bytes.
+
+The hash of each input file is kept in file_hashes.json with the file size and
+modification time, so that a multi-GB csv is only hashed again when it changes.
+
+Classes:
+
+    PreprocessingCache
+
+Functions:
+
+    file_hash(file_path)
+    default_cache()
+
+"""
+
+import os
+import json
+import hashlib
+import threading
+from typing import Callable, List, Optional, Tuple, Union
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+PREPROCESSING_CACHE_DIR = os.getenv(
+    "PREPROCESSING_CACHE_DIR",
+    str(Path.home() / ".cache" / "chicago-taxi" / "preprocessing"),
+)
+PREPROCESSING_CACHE_SIZE_MB = int(os.getenv("PREPROCESSING_CACHE_SIZE_MB", "2048"))
+TARGET_COLUMN = "__target__"
+HASHES_FILE = "file_hashes.json"
+
+
+def file_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreprocessingCache:
+    def __init__(
+        self, cache_dir: str, max_bytes: int = PREPROCESSING_CACHE_SIZE_MB << 20
+    ):
+
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def input_hash(self, file_path: str) -> str:
+        """Hash of the file content, reused while the size and mtime do not change"""
+        hashes_path = self.cache_dir / HASHES_FILE
+        with self.lock:
+            hashes = {}
+            if hashes_path.exists():
+                with open(hashes_path) as f_in:
+                    hashes = json.load(f_in)
+            stat = os.stat(file_path)
+            path = os.path.realpath(file_path)
+            known = hashes.get(path)
+            if (
+                known
+                and known["size"] == stat.st_size
+                and known["mtime_ns"] == stat.st_mtime_ns
+            ):
+                return known["sha256"]
+
+            hashes[path] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": file_hash(file_path),
+            }
+            temp_path = f"{hashes_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as f_out:
+                json.dump(hashes, f_out, indent=2)
+            os.replace(temp_path, hashes_path)
+            return hashes[path]["sha256"]
+
+    def key(self, file_paths: Union[str, List[str]], params: dict) -> str:
+
+        # One input file, or several (e.g. the partitions of the data lake)
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+        digest = hashlib.sha256()
+        for file_path in file_paths:
+            digest.update(self.input_hash(file_path).encode())
+        # default=str for the dtypes, e.g. {"Pickup Community Area": str}
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, np.ndarray]]:
+
+        path = self.entry_path(key)
+        try:
+            df = pd.read_parquet(path)
+            # The access time for the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        target = df.pop(TARGET_COLUMN).values.reshape(-1, 1)
+        return df, target
+
+    def put(self, key: str, features: pd.DataFrame, target: np.ndarray):
+
+        df = features.copy()
+        df[TARGET_COLUMN] = np.ravel(target)
+        path = self.entry_path(key)
+        # Write and rename, so that readers never see half an entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        df.to_parquet(temp_path, engine="pyarrow")
+        os.replace(temp_path, path)
+        self.evict()
+
+    def get_or_compute(
+        self,
+        file_paths: Union[str, List[str]],
+        params: dict,
+        compute: Callable[[], Tuple[pd.DataFrame, np.ndarray]],
+    ) -> Tuple[pd.DataFrame, np.ndarray]:
+
+        key = self.key(file_paths, params)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        features, target = compute()
+        self.put(key, features, target)
+        return features, target
+
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in self.cache_dir.glob("*.parquet"))
+
+    def evict(self):
+
+        # Least recently used first
+        entries = sorted(
+            (path.stat().st_mtime, path.stat().st_size, path)
+            for path in self.cache_dir.glob("*.parquet")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.stats["evictions"] += 1
+
+
+def default_cache() -> Optional[PreprocessingCache]:
+
+    # An empty PREPROCESSING_CACHE_DIR disables the cache
+    if not PREPROCESSING_CACHE_DIR:
+        return None
+    return PreprocessingCache(PREPROCESSING_CACHE_DIR)
@@ -12,7 +12,9 @@ from hyperopt.pyll import scope
 from sklearn.metrics import mean_squared_error
 
 from development import downloader
+from development.data_lake import TripsDataLake
 from development.preprocessor import Preprocessor
+from development.preprocessing_cache import default_cache
 
 
 def train_xgboost_search(X_train, X_val, y_val):
@@ -51,29 +53,36 @@ def train_xgboost_search(X_train, X_val, y_val):
 
 
 @task
-def download_dataset(year: int, month: int, days: int, output_filename: str):
-    downloader.download_dataset(year, month, days, output_filename)
+def download_dataset(lake_path: str, year: int, month: int, days: int):
+    # Only the days missing in the data lake are downloaded
+    start_date, end_date = downloader.dataset_range(year, month, days)
+    TripsDataLake(lake_path).ensure(start_date, end_date)
+    return start_date, end_date
 
 
 @task
-def preprocess_datasets(TRAIN_PATHFILE: str, VAL_PATHFILE: str, TEST_PATHFILE: str):
+def preprocess_datasets(lake_path: str, train_range, val_range, test_range):
 
-    DATE_FIELDS = ["Trip Start Timestamp", "Trip End Timestamp"]
     CATEGORICAL_FEATURES = ["pickup_community_area", "dropoff_community_area"]
     TARGET = "trip_seconds"
-    DTYPE = {"Pickup Community Area": str, "Dropoff Community Area": str}
 
-    data_processor = Preprocessor(verbose=False, analyse=False)
+    # Preprocessed datasets are reused while the partitions and the preprocessing
+    # do not change
+    lake = TripsDataLake(lake_path)
+    cache = default_cache()
+    data_processor = Preprocessor(verbose=False, analyse=False, cache=cache)
     # Fit only the train dataset.
-    df_train, y_train = data_processor.process(
-        TRAIN_PATHFILE, DATE_FIELDS, TARGET, CATEGORICAL_FEATURES, dtype=DTYPE
+    df_train, y_train = data_processor.process_trips(
+        lake, *train_range, TARGET, CATEGORICAL_FEATURES
     )
-    df_val, y_val, = data_processor.process(
-        VAL_PATHFILE, DATE_FIELDS, TARGET, CATEGORICAL_FEATURES, dtype=DTYPE
+    df_val, y_val = data_processor.process_trips(
+        lake, *val_range, TARGET, CATEGORICAL_FEATURES
     )
-    df_test, y_test = data_processor.process(
-        TEST_PATHFILE, DATE_FIELDS, TARGET, CATEGORICAL_FEATURES, dtype=DTYPE
+    df_test, y_test = data_processor.process_trips(
+        lake, *test_range, TARGET, CATEGORICAL_FEATURES
     )
+    if cache is not None:
+        print(f"Preprocessing cache: {cache.stats}")
     return (
         df_train,
         y_train,
@@ -209,12 +218,8 @@ def main_flow(
 ):
     # pylint: disable=unused-argument
     # pylint: disable=unused-variable
-    TRAIN_SET_NAME = f"Taxi_Trips_2022_{train_month:02d}.csv"
-    VAL_SET_NAME = f"Taxi_Trips_2022_{val_month:02d}.csv"
-    TEST_SET_NAME = f"Taxi_Trips_2022_{test_month:02d}.csv"
-    TRAIN_PATHFILE = f"{data_path}/{TRAIN_SET_NAME}"
-    VAL_PATHFILE = f"{data_path}/{VAL_SET_NAME}"
-    TEST_PATHFILE = f"{data_path}/{TEST_SET_NAME}"
+    # Trips partitioned by day, shared by the three datasets
+    LAKE_PATH = f"{data_path}/trips"
     PROJECT_ID = os.getenv("PROJECT_ID") or "chicago_taxi"
     MLFLOW_TRACKING_URI = (
         os.getenv("MLFLOW_TRACKING_URI") or "http://52.213.112.212:8080"
@@ -243,12 +248,10 @@ def main_flow(
 
     # Download datasets
 
-    for dataset_pathfile in [TRAIN_PATHFILE, VAL_PATHFILE, TEST_PATHFILE]:
-        if not os.path.exists(dataset_pathfile):
-            print(f"Downloading train set: {dataset_pathfile}")
-            download_dataset(year, train_month, num_of_days, dataset_pathfile)
-        else:
-            print("{dataset_pathfile} set already exists. Skipping download")
+    train_range, val_range, test_range = [
+        download_dataset(LAKE_PATH, year, month, num_of_days)
+        for month in [train_month, val_month, test_month]
+    ]
 
     # Prepare X and y.
     (
@@ -258,7 +261,7 @@ def main_flow(
         y_val,
         df_test,
         y_test,
-    ) = preprocess_datasets(TRAIN_PATHFILE, VAL_PATHFILE, TEST_PATHFILE)
+    ) = preprocess_datasets(LAKE_PATH, train_range, val_range, test_range)
 
     now = datetime.now().timestamp() * 1000
     # Train a set of models
@@ -267,8 +270,8 @@ def main_flow(
         y_train,
         df_val,
         y_val,
-        TRAIN_PATHFILE,
-        VAL_PATHFILE,
+        f"{LAKE_PATH}[{train_range[0]:%Y-%m-%d}, {train_range[1]:%Y-%m-%d})",
+        f"{LAKE_PATH}[{val_range[0]:%Y-%m-%d}, {val_range[1]:%Y-%m-%d})",
     )
 
     # Get the best 3 models and register them in the model registry
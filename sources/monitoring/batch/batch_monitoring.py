@@ -1,63 +1,129 @@
 import os
 import json
-from typing import List
+import time
+import hashlib
+from typing import List, Optional
 from pathlib import Path
+from datetime import datetime, timedelta
 
+import numpy as np
 import pandas
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
 from evidently import ColumnMapping
-from evidently.dashboard import Dashboard
-from evidently.test_suite import TestSuite
-from evidently.test_preset import DataDriftTestPreset
-from evidently.model_profile import Profile
-from evidently.dashboard.tabs import DataDriftTab, RegressionPerformanceTab
-from evidently.model_profile.sections import (
-    DataDriftProfileSection,
-    RegressionPerformanceProfileSection,
+from evidently.report import Report
+from evidently.metrics import (
+    DataDriftTable,
+    RegressionErrorPlot,
+    DatasetDriftMetric,
+    RegressionErrorBiasTable,
+    RegressionQualityMetric,
+    RegressionTopErrorMetric,
+    RegressionErrorNormality,
+    RegressionErrorDistribution,
+    RegressionPredictedVsActualPlot,
+    RegressionAbsPercentageErrorPlot,
+    RegressionPredictedVsActualScatter,
 )
 
 from development import downloader
+from development.data_lake import TripsDataLake
 from development.preprocessor import Preprocessor
+from development.preprocessing_cache import PREPROCESSING_CACHE_DIR, default_cache
 from production.model_service import init_model_mlflow
 
 # from prefect import flow, task
 
+MONGODB_ADDRESS = os.getenv("MONGODB_ADDRESS", "mongodb://localhost:27018/")
+# UpdateOne operations sent per bulk_write
+TARGET_BATCH_SIZE = int(os.getenv("TARGET_BATCH_SIZE", "5000"))
+# Documents per cursor batch of get_actual_data
+ACTUAL_DATA_BATCH_SIZE = int(os.getenv("ACTUAL_DATA_BATCH_SIZE", "10000"))
+# Predictions of the last hours analyzed. 0: all the predictions
+ACTUAL_DATA_HOURS = int(os.getenv("ACTUAL_DATA_HOURS", "0"))
+# false: only the profile and the drift test (retraining decision)
+HTML_REPORT = os.getenv("HTML_REPORT", "true").lower() == "true"
+# Share of drifted columns from which the training pipeline is run (threshold of
+# TestShareOfDriftedFeatures in DataDriftTestPreset)
+DRIFT_SHARE_THRESHOLD = 0.3
+# Predictions of the reference data, next to the preprocessed reference data
+REFERENCE_PREDICTIONS_DIR = os.getenv(
+    "REFERENCE_PREDICTIONS_DIR",
+    os.path.join(PREPROCESSING_CACHE_DIR, "predictions")
+    if PREPROCESSING_CACHE_DIR
+    else "",
+)
+
 # @task
-def add_target_to_actual_data(filename):
-    client = MongoClient("mongodb://localhost:27018/")
-    collection = client.get_database("prediction_service").get_collection("data")
-    with open(filename) as f_target:
-        for line in f_target.readlines():
-            row = line.split(",")
-            collection.update_one(
-                {"trip_id": row[0]}, {"$set": {"target": float(row[1])}}
-            )
-    client.close()
+def add_target_to_actual_data(
+    filename, collection=None, batch_size: int = TARGET_BATCH_SIZE
+):
+    """
+    Sets the target of the predictions in the collection, from the csv file of
+    trip_id,target lines. The updates are sent unordered, batch_size at a time
+    """
+    client = None
+    if collection is None:
+        client = MongoClient(MONGODB_ADDRESS)
+        collection = client.get_database("prediction_service").get_collection("data")
+
+    start = time.perf_counter()
+    try:
+        targets = pandas.read_csv(
+            filename,
+            header=None,
+            names=["trip_id", "target"],
+            dtype={"trip_id": str, "target": float},
+        )
+    except pandas.errors.EmptyDataError:
+        targets = pandas.DataFrame({"trip_id": [], "target": []})
+    # Each update looks up a trip_id
+    collection.create_index("trip_id")
+
+    matched = 0
+    trip_ids = targets["trip_id"].tolist()
+    values = targets["target"].tolist()
+    for i in range(0, len(trip_ids), batch_size):
+        result = collection.bulk_write(
+            [
+                UpdateOne({"trip_id": trip_id}, {"$set": {"target": value}})
+                for trip_id, value in zip(
+                    trip_ids[i : i + batch_size], values[i : i + batch_size]
+                )
+            ],
+            ordered=False,
+        )
+        matched += result.matched_count
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"Targets: {len(trip_ids)} rows, {matched} matched, "
+        f"{len(trip_ids) / max(elapsed, 1e-9):.0f} rows/sec"
+    )
+    if client is not None:
+        client.close()
+    return {"rows": len(trip_ids), "matched": matched, "seconds": elapsed}
 
 
 # @task
-def download_reference_data(year, month, days, file_path):
+def download_reference_data(year, month, days, lake: TripsDataLake):
 
-    if not os.path.exists(file_path):
-        print(f"Downloading test set: {file_path}")
-        downloader.download_dataset(year, month, days, file_path)
-    else:
-        print("Reference set already exists. Skipping download")
+    # Only the days missing in the data lake are downloaded
+    start_date, end_date = downloader.dataset_range(year, month, days)
+    lake.ensure(start_date, end_date)
 
-    return file_path
+    return start_date, end_date
 
 
 # @task
 def preprocess_reference_data(
-    ref_set_path: str, date_fields: List[str], dtype: dict, categorical_features
+    lake: TripsDataLake, start_date, end_date, categorical_features: List[str]
 ):
 
-    preprocessor = Preprocessor(False, False)
-    test_set_path_parquet = preprocessor.read_dataframe_csv(
-        ref_set_path, date_fields, dtype
+    preprocessor = Preprocessor(False, False, cache=default_cache())
+    ref_data, target = preprocessor.process_trips(
+        lake, start_date, end_date, "trip_seconds", categorical_features
     )
-    test_set = preprocessor.read_dataframe_parquet(test_set_path_parquet)
-    ref_data, target = preprocessor.preprocess_data(test_set, categorical_features, [])
     # preprocess_data returns the features and the target columns separately
     # target is 'duration' by default, so add it as 'target' for evidently
     ref_data["target"] = target
@@ -69,64 +135,212 @@ def load_model(tracking_uri: str, name: str, stage: str):
     return init_model_mlflow(tracking_uri=tracking_uri, name=name, stage=stage)
 
 
+def dataframe_hash(df: pandas.DataFrame) -> str:
+
+    # Content of the frame, hashed column by column without serializing it
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(column) for column in df.columns]).encode())
+    digest.update(pandas.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def model_key(model) -> Optional[str]:
+
+    # The run_id or the registry version identifies the model, e.g. the one
+    # resolved from the Staging stage by init_model_mlflow
+    metadata = getattr(model, "metadata", {})
+    if metadata.get("run_id"):
+        return f"run-{metadata['run_id']}"
+    if metadata.get("version"):
+        return f"v{metadata['version']}"
+    return None
+
+
 # @task
-def add_prediction_to_ref_data(ref_data, model):
+def add_prediction_to_ref_data(
+    ref_data, model, cache_dir: Optional[str] = REFERENCE_PREDICTIONS_DIR
+):
     # print(type(model.model.predict(dicts[0])))
     # print(model.model.predict(dicts[0]))
-    ref_data["prediction"] = model.predict(ref_data)
 
+    # The predictions are reused while the reference data and the model do not
+    # change. The cache is disabled if cache_dir is empty
+    key = model_key(model)
+    if not cache_dir or key is None:
+        ref_data["prediction"] = model.predict(ref_data)
+        return
 
-# @task
-def get_actual_data(features, target, prediction):
+    data_hash = dataframe_hash(ref_data.drop(columns="prediction", errors="ignore"))
+    cache_path = os.path.join(cache_dir, f"{data_hash}-{key}.parquet")
+    if os.path.exists(cache_path):
+        print(f"Reference predictions cache hit: {cache_path}")
+        ref_data["prediction"] = pandas.read_parquet(cache_path)["prediction"].values
+        return
 
-    client = MongoClient("mongodb://localhost:27018/")
-    data = client.get_database("prediction_service").get_collection("data").find()
-    df = pandas.DataFrame(list(data))
+    ref_data["prediction"] = model.predict(ref_data)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write and rename, so that a failed run never leaves a partial entry
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    pandas.DataFrame(
+        {"prediction": np.ravel(ref_data["prediction"].values)}
+    ).to_parquet(temp_path, engine="pyarrow")
+    os.replace(temp_path, cache_path)
+    # Predictions of the previous models are not read anymore
+    for path in Path(cache_dir).glob(f"{data_hash}-*.parquet"):
+        if str(path) != cache_path:
+            path.unlink(missing_ok=True)
 
-    df.drop(
-        df.columns.difference(features + target + prediction),
-        axis=1,
-        inplace=True,
-    )
 
-    return df
+# @task
+def get_actual_data(
+    features,
+    target,
+    prediction,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    collection=None,
+    batch_size: int = ACTUAL_DATA_BATCH_SIZE,
+):
+    """
+    Predictions stored in [start, end) (by the time of the ObjectId), with only the
+    features, target and prediction fields. The cursor batches are appended to one
+    list per field, so only the projected values are held in memory
+    """
+    client = None
+    if collection is None:
+        client = MongoClient(MONGODB_ADDRESS)
+        collection = client.get_database("prediction_service").get_collection("data")
+
+    fields = features + target + prediction
+    query = {}
+    if start is not None:
+        query.setdefault("_id", {})["$gte"] = ObjectId.from_datetime(start)
+    if end is not None:
+        query.setdefault("_id", {})["$lt"] = ObjectId.from_datetime(end)
+    projection = {field: 1 for field in fields}
+    projection["_id"] = 0
+
+    columns = {field: [] for field in fields}
+    for document in collection.find(query, projection, batch_size=batch_size):
+        for field, values in columns.items():
+            values.append(document.get(field))
+    if client is not None:
+        client.close()
+
+    return pandas.DataFrame(columns)
+
+
+def drift_test_results(
+    drift_table: dict, share_threshold: float = DRIFT_SHARE_THRESHOLD
+) -> dict:
+    """
+    Share of drifted features test, with the layout of the TestSuite JSON, from the
+    DataDriftTable results of a report (Report.as_dict)
+    """
+    share = drift_table["share_of_drifted_columns"]
+    return {
+        "tests": [
+            {
+                "name": "Share of Drifted Features",
+                "description": (
+                    f"The drift is detected for {share * 100:.3g}% features "
+                    f'({drift_table["number_of_drifted_columns"]} out of '
+                    f'{drift_table["number_of_columns"]}). '
+                    f"The test threshold is lt={share_threshold}"
+                ),
+                "status": "SUCCESS" if share < share_threshold else "FAIL",
+                "group": "data_drift",
+                "parameters": {
+                    "condition": {"lt": share_threshold},
+                    "features": {
+                        column: {
+                            "stattest": drift["stattest_name"],
+                            "score": round(drift["drift_score"], 3),
+                            "threshold": drift["threshold"],
+                            "data_drift": "Detected"
+                            if drift["drift_detected"]
+                            else "Not Detected",
+                        }
+                        for column, drift in drift_table["drift_by_columns"].items()
+                    },
+                },
+            }
+        ]
+    }
 
 
 # @task
-def run_evidently(ref_data, data):
-
-    profile = Profile(
-        sections=[DataDriftProfileSection(), RegressionPerformanceProfileSection()]
-    )
+def run_evidently(ref_data, data, html_report_path: Optional[str] = None):
+    """
+    Data drift and regression performance of data against ref_data. The JSON
+    profile and the drift test are built from the same report run. The HTML report
+    (if html_report_path) needs the regression plots, which have no JSON output:
+    it is another report, run only when requested. Returns the profile, the test
+    results and the seconds taken by each output
+    """
+    timings = {}
+    start = time.perf_counter()
     mapping = ColumnMapping(
         prediction="prediction",
         categorical_features=["pickup_community_area", "dropoff_community_area"],
         numerical_features=[],
         datetime_features=[],
     )
-    profile.calculate(ref_data, data, mapping)
+    # DataDriftPreset and the regression metrics with a JSON output
+    profile_metrics = [
+        DatasetDriftMetric(),
+        DataDriftTable(),
+        RegressionQualityMetric(),
+        RegressionErrorBiasTable(),
+    ]
+    report = Report(metrics=profile_metrics)
+    report.run(reference_data=ref_data, current_data=data, column_mapping=mapping)
+    timings["analysis"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Plain JSON types, for the database
+    profile = json.loads(report.json())
+    timings["profile"] = time.perf_counter() - start
+
+    # Test of DataDriftTestPreset, on the drift results of the report
+    start = time.perf_counter()
+    test_suite_data_results = drift_test_results(profile["metrics"]["DataDriftTable"])
+    timings["drift_test"] = time.perf_counter() - start
+    print(json.dumps(test_suite_data_results, indent=4))
 
-    dashboard = Dashboard(
-        tabs=[DataDriftTab(), RegressionPerformanceTab(verbose_level=0)]
-    )
-    dashboard.calculate(ref_data, data, mapping)
+    if html_report_path:
+        start = time.perf_counter()
+        html_report = Report(
+            metrics=[
+                DatasetDriftMetric(),
+                DataDriftTable(),
+                RegressionQualityMetric(),
+                RegressionPredictedVsActualScatter(),
+                RegressionPredictedVsActualPlot(),
+                RegressionErrorPlot(),
+                RegressionAbsPercentageErrorPlot(),
+                RegressionErrorDistribution(),
+                RegressionErrorNormality(),
+                RegressionTopErrorMetric(),
+                RegressionErrorBiasTable(),
+            ]
+        )
+        html_report.run(
+            reference_data=ref_data, current_data=data, column_mapping=mapping
+        )
+        save_html_report(html_report, html_report_path)
+        timings["html"] = time.perf_counter() - start
 
-    test_suite_results = TestSuite(
-        tests=[
-            DataDriftTestPreset(),
-        ]
+    print(
+        "Evidently timings: "
+        + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
     )
-
-    test_suite_results.run(reference_data=ref_data, current_data=data)
-    test_suite_data_results = json.loads(test_suite_results.json())
-    print(json.dumps(test_suite_data_results, indent=4))
-
-    return json.loads(profile.json()), dashboard, test_suite_data_results
+    return profile, test_suite_data_results, timings
 
 
 # @task
 def save_report(result):
-    client = MongoClient("mongodb://localhost:27018/")
+    client = MongoClient(MONGODB_ADDRESS)
     client.get_database("prediction_service").get_collection("report").insert_one(
         result
     )
@@ -134,7 +348,7 @@ def save_report(result):
 
 # @task
 def save_html_report(result, report_path):
-    result.save(report_path)
+    result.save_html(report_path)
 
 
 # @flow
@@ -142,11 +356,9 @@ def batch_analyze(
     ref_year: int,
     ref_month: int,
     ref_days: int,
-    ref_set_path: str,
+    lake: TripsDataLake,
     test_target_set_path: str,
     report_path: str,
-    date_fields: List[str],
-    dtype: dict,
     model,
     categorical_features,
 ):
@@ -155,13 +367,11 @@ def batch_analyze(
     add_target_to_actual_data(test_target_set_path)
 
     # Load and preprocess the reference data.
-    # Download
-    reference_data_csv_path = download_reference_data(
-        ref_year, ref_month, ref_days, ref_set_path
-    )
+    # Download (into the data lake)
+    start_date, end_date = download_reference_data(ref_year, ref_month, ref_days, lake)
     # Preprocess (including target)
     ref_data = preprocess_reference_data(
-        reference_data_csv_path, date_fields, dtype, categorical_features
+        lake, start_date, end_date, categorical_features
     )
     # Predict
     add_prediction_to_ref_data(ref_data, model)
@@ -169,16 +379,24 @@ def batch_analyze(
     print(ref_data.columns)
 
     # Load the actual data from the database
+    start = None
+    if ACTUAL_DATA_HOURS:
+        start = datetime.utcnow() - timedelta(hours=ACTUAL_DATA_HOURS)
     actual_data = get_actual_data(
-        features=CATEGORICAL_FEATURES, target=["target"], prediction=["prediction"]
+        features=CATEGORICAL_FEATURES,
+        target=["target"],
+        prediction=["prediction"],
+        start=start,
     )
 
     print(actual_data.columns)
     # Run batch monitoring
-    profile, dashboard, test_suite_data_results = run_evidently(ref_data, actual_data)
+    # The HTML report is only rendered if requested
+    profile, test_suite_data_results, _ = run_evidently(
+        ref_data, actual_data, report_path if HTML_REPORT else None
+    )
 
     save_report(profile)
-    save_html_report(dashboard, report_path)
 
     test_result = test_suite_data_results["tests"][0]
 
@@ -198,14 +416,10 @@ if __name__ == "__main__":
     REF_YEAR = 2022
     REF_MONTH = 3
     REF_DAYS = 2
-    REF_SET_NAME = f"Taxi_Trips_2022_{REF_MONTH:02d}.csv"
     current_path = Path(__file__).parent
     REF_PATH = current_path / "reference_data"
-    REF_SET_PATH = f"{REF_PATH}/{REF_SET_NAME}"
     TEST_TARGET_SET_NAME = "test_target_values.csv"
     TEST_TARGET_SET_PATH = f"{REF_PATH}/{TEST_TARGET_SET_NAME}"
-    DATE_FIELDS = ["Trip Start Timestamp", "Trip End Timestamp"]
-    DTYPE = {"Pickup Community Area": str, "Dropoff Community Area": str}
 
     # trip_id actually is not a feature in the model, but it has to be defined here in order to preprocess the dataset correctly
     CATEGORICAL_FEATURES = [
@@ -233,11 +447,9 @@ if __name__ == "__main__":
         REF_YEAR,
         REF_MONTH,
         REF_DAYS,
-        REF_SET_PATH,
+        TripsDataLake(),
         TEST_TARGET_SET_PATH,
         report_path,
-        DATE_FIELDS,
-        DTYPE,
         model,
         CATEGORICAL_FEATURES,
     )
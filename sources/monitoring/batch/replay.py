@@ -0,0 +1,294 @@
+"""
+Concurrent replay of trips to the prediction service.
+
+The trips are sent by a pool of concurrency threads, each with its own keep-alive
+session, at a target rate of requests per second (0: as fast as possible). Each
+request carries batch_size trips: a single record, or a list of records whose
+predictions come back in the same order. The predicted records are stored in
+MongoDB with insert_many, and the client side latency of the requests is
+reported as percentiles, so the replay doubles as a load generator.
+
+The timed replay (ReplayClient.replay_timed) reproduces the arrival process of
+the trips instead: each trip is sent at its trip_start_timestamp, relative to the
+first trip and speedup times faster, by a timer wheel run on an asyncio event
+loop. Bursts of trips are kept, and the lag of the sends behind their schedule is
+reported.
+
+Classes:
+
+    DateTimeEncoder
+    TimerWheel
+    ReplayClient
+
+Functions:
+
+    percentiles_ms(seconds)
+
+"""
+
+import json
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from typing import List
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import requests
+
+LATENCY_PERCENTILES = [50, 95, 99]
+
+
+def percentiles_ms(seconds: List[float]) -> dict:
+
+    values = np.percentile(np.array(seconds) * 1000, LATENCY_PERCENTILES)
+    return {
+        f"p{percentile}": float(value)
+        for percentile, value in zip(LATENCY_PERCENTILES, values)
+    }
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return json.JSONEncoder.default(self, o)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel run by the asyncio event loop. Timers are kept in the slot
+    of their tick (tick_sec resolution), and all the timers of a tick are fired by
+    one wake-up of the loop, at the absolute time of the tick, so bursts are kept
+    and the delays do not accumulate. The lag of each timer is recorded
+    """
+
+    def __init__(self, tick_sec: float = 0.005, n_slots: int = 1024):
+
+        self.tick_sec = tick_sec
+        self.n_slots = n_slots
+        # Slot: {tick: [(callback, args), ...]}, ticks of all the rounds of the slot
+        self.slots = [{} for _ in range(n_slots)]
+        self.pending = 0
+        self.lags = []
+
+    def tick(self, delay_sec: float) -> int:
+        return int(delay_sec / self.tick_sec)
+
+    def schedule(self, delay_sec: float, callback, *args):
+        """Calls callback(*args) delay_sec seconds after the wheel starts running"""
+        tick = self.tick(delay_sec)
+        self.slots[tick % self.n_slots].setdefault(tick, []).append((callback, args))
+        self.pending += 1
+
+    def next_tick(self, tick: int) -> int:
+
+        # First tick >= tick with timers, one turn of the wheel at a time
+        while True:
+            for candidate in range(tick, tick + self.n_slots):
+                if candidate in self.slots[candidate % self.n_slots]:
+                    return candidate
+            tick += self.n_slots
+
+    async def run(self):
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tick = 0
+        while self.pending:
+            tick = self.next_tick(tick)
+            deadline = start + tick * self.tick_sec
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            timers = self.slots[tick % self.n_slots].pop(tick)
+            self.pending -= len(timers)
+            lag = max(0.0, loop.time() - deadline)
+            for callback, args in timers:
+                self.lags.append(lag)
+                callback(*args)
+            tick += 1
+
+
+class ReplayClient:
+    def __init__(
+        self,
+        url: str,
+        concurrency: int = 8,
+        rate: float = 0,
+        batch_size: int = 1,
+        collection=None,
+        insert_batch_size: int = 1000,
+        timeout_sec: float = 30.0,
+    ):
+
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.batch_size = batch_size
+        self.collection = collection
+        self.insert_batch_size = insert_batch_size
+        self.timeout_sec = timeout_sec
+        self.stats = {"requests": 0, "records": 0, "errors": 0, "inserted": 0}
+        self.latencies = []
+        self.pending_inserts = []
+        # One keep-alive session per worker thread
+        self._sessions = threading.local()
+        # Thread pool and requests in flight of the timed replay
+        self.executor = None
+        self.in_flight = []
+
+    def session(self) -> requests.Session:
+
+        if not hasattr(self._sessions, "session"):
+            self._sessions.session = requests.Session()
+        return self._sessions.session
+
+    def send(self, batch: List[dict]):
+        """Requests the predictions of the batch. Returns the batch, predictions and latency"""
+        # A single trip is sent as a record, as the original replay did
+        body = batch[0] if self.batch_size == 1 else batch
+        start = time.perf_counter()
+        response = self.session().post(
+            self.url,
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(body, cls=DateTimeEncoder),
+            timeout=self.timeout_sec,
+        )
+        response.raise_for_status()
+        result = response.json()
+        latency = time.perf_counter() - start
+        if isinstance(result, dict):
+            predictions = [result["prediction"]]
+        else:
+            predictions = result
+        return batch, predictions, latency
+
+    def collect(self, futures):
+
+        for future in futures:
+            try:
+                batch, predictions, latency = future.result()
+            except (requests.RequestException, ValueError, KeyError) as error:
+                self.stats["errors"] += 1
+                logging.warning("Prediction request failed: %s", error)
+                continue
+            if len(predictions) != len(batch):
+                # The predictions could not be matched with the records
+                self.stats["errors"] += 1
+                logging.warning(
+                    "%s predictions for a batch of %s records",
+                    len(predictions),
+                    len(batch),
+                )
+                continue
+            self.stats["requests"] += 1
+            self.stats["records"] += len(batch)
+            self.latencies.append(latency)
+            for record, prediction in zip(batch, predictions):
+                self.pending_inserts.append({**record, "prediction": prediction})
+            if len(self.pending_inserts) >= self.insert_batch_size:
+                self.flush()
+
+    def flush(self):
+
+        if self.collection is not None and self.pending_inserts:
+            self.collection.insert_many(self.pending_inserts, ordered=False)
+            self.stats["inserted"] += len(self.pending_inserts)
+        self.pending_inserts = []
+
+    def submit_batches(self, executor, batches):
+        """Submits the batches at the target rate, at most concurrency in flight"""
+        pending = set()
+        start = time.perf_counter()
+        for i, batch in enumerate(batches):
+            if self.rate:
+                delay = start + i / self.rate - time.perf_counter()
+            else:
+                delay = 0
+            if delay > 0:
+                time.sleep(delay)
+            if len(pending) >= self.concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                self.collect(done)
+            pending.add(executor.submit(self.send, batch))
+        self.collect(wait(pending)[0])
+
+    def replay(self, records: List[dict]) -> dict:
+
+        batches = [
+            records[i : i + self.batch_size]
+            for i in range(0, len(records), self.batch_size)
+        ]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            self.submit_batches(executor, batches)
+        self.flush()
+        return self.report(time.perf_counter() - start)
+
+    def replay_timed(
+        self,
+        records: List[dict],
+        timestamps: pd.Series,
+        speedup: float = 60.0,
+        tick_sec: float = 0.005,
+    ) -> dict:
+        """
+        Sends each trip at its start time, relative to the first trip and speedup
+        times faster. The trips of the same tick are sent together, batch_size
+        per request
+        """
+        offsets = (timestamps - timestamps.min()).dt.total_seconds().values / speedup
+        wheel = TimerWheel(tick_sec)
+        order = np.argsort(offsets, kind="stable")
+        for _, group in itertools.groupby(order, key=lambda i: wheel.tick(offsets[i])):
+            group = list(group)
+            for i in range(0, len(group), self.batch_size):
+                batch = [records[j] for j in group[i : i + self.batch_size]]
+                wheel.schedule(offsets[group[i]], self.submit_async, batch)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            self.executor = executor
+            asyncio.run(self.run_timed(wheel))
+        self.flush()
+        report = self.report(time.perf_counter() - start)
+        if wheel.lags:
+            report["schedule_lag_ms"] = percentiles_ms(wheel.lags)
+            print(f"Schedule lag {report['schedule_lag_ms']}")
+        return report
+
+    def submit_async(self, batch: List[dict]):
+
+        # Called by the timer wheel: the request runs in the thread pool, and the
+        # result is collected by the event loop
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.send, batch
+        )
+        future.add_done_callback(lambda done: self.collect([done]))
+        self.in_flight.append(future)
+
+    async def run_timed(self, wheel: TimerWheel):
+
+        self.in_flight = []
+        await wheel.run()
+        await asyncio.gather(*self.in_flight, return_exceptions=True)
+
+    def report(self, seconds: float) -> dict:
+
+        report = {**self.stats, "seconds": seconds}
+        report["requests_per_sec"] = self.stats["requests"] / max(seconds, 1e-9)
+        report["records_per_sec"] = self.stats["records"] / max(seconds, 1e-9)
+        if self.latencies:
+            report["latency_ms"] = percentiles_ms(self.latencies)
+        print(
+            f"Replay: {report['records']} trips, {report['requests']} requests "
+            f"({report['errors']} errors) in {seconds:.1f}s, "
+            f"{report['requests_per_sec']:.1f} requests/sec, "
+            f"latency {report.get('latency_ms')}"
+        )
+        return report
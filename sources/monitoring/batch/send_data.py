@@ -1,27 +1,46 @@
 import os
-import json
-from time import sleep
+from typing import List
 from pathlib import Path
-from datetime import datetime
 
-import requests
+import pandas as pd
 from pymongo import MongoClient
 
-from development.downloader import download_dataset
-from development.preprocessor import Preprocessor
-
-
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.isoformat()
-        return json.JSONEncoder.default(self, o)
-
-
-def save_to_db(collection, record):
-    # rec = record.copy()
-    # rec['prediction'] = prediction
-    collection.insert_one(record)
+from development.data_lake import TripsDataLake
+from development.downloader import dataset_range
+from development.preprocessor import (
+    TRIP_SECONDS_FILTERS,
+    Preprocessor,
+    normalize_categorical,
+)
+from development.preprocessing_cache import default_cache
+from monitoring.batch.replay import ReplayClient
+
+# Requests per second (0: as fast as possible), requests in flight and trips per
+# request
+REPLAY_RATE = float(os.getenv("REPLAY_RATE", "1"))
+REPLAY_CONCURRENCY = int(os.getenv("REPLAY_CONCURRENCY", "8"))
+REPLAY_BATCH_SIZE = int(os.getenv("REPLAY_BATCH_SIZE", "1"))
+# If > 0, the trips are sent at their trip_start_timestamp, this times faster
+# (e.g. 60: one hour of trips in one minute), instead of at REPLAY_RATE
+REPLAY_SPEEDUP = float(os.getenv("REPLAY_SPEEDUP", "0"))
+
+
+def trip_start_timestamps(lake, start_date, end_date, trip_ids: List[str]) -> pd.Series:
+    """
+    Start times of the trips, in the order of trip_ids (preprocessed ids). NaT for
+    the trips that are not in the data lake
+    """
+    trips = lake.read(
+        start_date,
+        end_date,
+        columns=["trip_id", "trip_start_timestamp"],
+        filters=TRIP_SECONDS_FILTERS,
+    )
+    # Joined on the ids formatted as in the preprocessed trips
+    trip_index = pd.Index(normalize_categorical(trips["trip_id"].values)).astype(str)
+    timestamps = pd.Series(trips["trip_start_timestamp"].values, index=trip_index)
+    timestamps = timestamps[~timestamps.index.duplicated()]
+    return timestamps.reindex(trip_ids).reset_index(drop=True)
 
 
 if __name__ == "__main__":
@@ -41,14 +60,10 @@ if __name__ == "__main__":
     TEST_YEAR = 2022
     TEST_MONTH = 4
     TEST_DAYS = 2
-    TEST_SET_NAME = f"Taxi_Trips_2022_{TEST_MONTH:02d}.csv"
     TEST_TARGET_SET_NAME = "test_target_values.csv"
     current_path = Path(__file__).parent
     TEST_PATH = current_path / "reference_data"
-    TEST_SET_PATH = f"{TEST_PATH}/{TEST_SET_NAME}"
     TEST_TARGET_SET_PATH = f"{TEST_PATH}/{TEST_TARGET_SET_NAME}"
-    DATE_FIELDS = ["Trip Start Timestamp", "Trip End Timestamp"]
-    DTYPE = {"Pickup Community Area": str, "Dropoff Community Area": str}
     CATEGORICAL_FEATURES = [
         "pickup_community_area",
         "dropoff_community_area",
@@ -59,50 +74,49 @@ if __name__ == "__main__":
     if not os.path.exists(TEST_PATH):
         os.makedirs(TEST_PATH)
 
-    # Download dataset
-    if not os.path.exists(TEST_SET_PATH):
-        print(f"Downloading test set: {TEST_SET_PATH}")
-        download_dataset(TEST_YEAR, TEST_MONTH, TEST_DAYS, TEST_SET_PATH)
-    else:
-        print("Test set already exists. Skipping download")
+    # The days missing in the data lake are downloaded, and the preprocessed test
+    # set is reused by later runs
+    preprocessor = Preprocessor(False, False, cache=default_cache())
 
-    preprocessor = Preprocessor(False, False)
-
-    test_set_path_parquet = preprocessor.read_dataframe_csv(
-        TEST_SET_PATH, DATE_FIELDS, DTYPE
+    start_date, end_date = dataset_range(TEST_YEAR, TEST_MONTH, TEST_DAYS)
+    lake = TripsDataLake()
+    dataset, target = preprocessor.process_trips(
+        lake, start_date, end_date, TARGET, CATEGORICAL_FEATURES
     )
-    dataset = preprocessor.read_dataframe_parquet(test_set_path_parquet)
-
-    dataset, target = preprocessor.preprocess_data(dataset, CATEGORICAL_FEATURES, [])
     # to_dict outputs a list of dicts
     dataset = dataset.to_dict("records")
 
+    # This should not happend, since preprocessor has filled NaNs with '-1'
+    valid = [
+        i
+        for i, record in enumerate(dataset)
+        if record["pickup_community_area"] is not None
+        and record["dropoff_community_area"] is not None
+    ]
     with open(TEST_TARGET_SET_PATH, "w") as f_target:
-        for i, record in enumerate(dataset):
-
-            # This should not happend, since preprocessor has filled NaNs with '-1'
-            if (
-                record["pickup_community_area"] is None
-                or record["dropoff_community_area"] is None
-            ):
-                continue
-            # Write to file the target values (converted to minutes as we did in the trainning)
-            # Preprocessor has created duration field already
-            # target is a np array of shape n_samples, 1
-            f_target.write(f"{record['trip_id']},{target[i,0]}\n")
-
-            # Request the prediction to prediction service
-            data = json.dumps(record, cls=DateTimeEncoder)
-            print(f"sending features to prediction service: {data}")
-            response = requests.post(
-                url,
-                headers={"Content-Type": "application/json"},
-                data=data,
-            ).json()
-            if isinstance(response, list):
-                if len(response) == 1:
-                    prediction = response[0]
-            print(f"prediction: {prediction}")
-            record['prediction'] = prediction
-            save_to_db(collection, record)
-            sleep(1)
+        # Write to file the target values (converted to minutes as we did in the trainning)
+        # Preprocessor has created duration field already
+        # target is a np array of shape n_samples, 1
+        f_target.writelines(f"{dataset[i]['trip_id']},{target[i,0]}\n" for i in valid)
+
+    # Request the predictions to prediction service, and store them in the database
+    client = ReplayClient(
+        url,
+        concurrency=REPLAY_CONCURRENCY,
+        rate=REPLAY_RATE,
+        batch_size=REPLAY_BATCH_SIZE,
+        collection=collection,
+    )
+    records = [dataset[i] for i in valid]
+    if REPLAY_SPEEDUP > 0:
+        timestamps = trip_start_timestamps(
+            lake, start_date, end_date, [record["trip_id"] for record in records]
+        )
+        found = timestamps.notna().values
+        client.replay_timed(
+            [record for record, has_time in zip(records, found) if has_time],
+            timestamps[found].reset_index(drop=True),
+            speedup=REPLAY_SPEEDUP,
+        )
+    else:
+        client.replay(records)
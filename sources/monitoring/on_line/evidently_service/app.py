@@ -10,18 +10,28 @@ The service gets a reference dataset from reference.csv file and process current
 Metrics calculation results are available with `GET /metrics` HTTP method in Prometheus compatible format.
 """
 import hashlib
+import json
 import os
 
 import dataclasses
 import datetime
 import logging
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 from typing import List
+from typing import Tuple
+from typing import Union
 from typing import Optional
 
 import flask
 import pandas as pd
+import pyarrow as pa
 import prometheus_client
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.core import Metric
 from pyarrow import parquet as pq
 from flask import Flask
 import yaml
@@ -40,7 +50,10 @@ from evidently.model_monitoring import RegressionPerformanceMonitor
 from evidently.runner.loader import DataLoader
 from evidently.runner.loader import DataOptions
 
+from categorical_drift import CategoricalDrift
 from preprocessor import Preprocessor
+from reference_cache import load_reference_data
+from window_buffer import WindowBuffer
 
 
 def preprocess_reference_data(
@@ -48,10 +61,7 @@ def preprocess_reference_data(
 ):
 
     preprocessor = Preprocessor(False, False)
-    test_set_path_parquet = preprocessor.read_dataframe_csv(
-        ref_set_path, date_fields, dtype
-    )
-    test_set = preprocessor.read_dataframe_parquet(test_set_path_parquet)
+    test_set = preprocessor.read_dataframe(ref_set_path, date_fields, dtype)
     ref_data, target = preprocessor.preprocess_data(test_set, categorical_features, [])
     # preprocess_data returns the features and the target columns separately
     # target is 'duration' by default, so add it as 'target' for evidently
@@ -59,6 +69,9 @@ def preprocess_reference_data(
     return ref_data
 
 
+# Preprocessed reference datasets. An empty value disables the cache
+REFERENCE_CACHE_DIR = os.getenv("REFERENCE_CACHE_DIR", "datasets/cache")
+
 app = Flask(__name__)
 
 logging.basicConfig(
@@ -81,6 +94,7 @@ class MonitoringServiceOptions:
     moving_reference: bool
     window_size: int
     calculation_period_sec: int
+    max_concurrent_calculations: int = 1
 
 
 @dataclasses.dataclass
@@ -102,26 +116,61 @@ EVIDENTLY_MONITORS_MAPPING = {
 }
 
 
+def make_window_buffer(column_mapping: ColumnMapping, window_size: int):
+
+    # Features, target and prediction columns are kept. Other columns (e.g. trip_id)
+    # are not used by the monitors
+    numerical_columns = list(column_mapping.numerical_features or [])
+    for column in [column_mapping.target, column_mapping.prediction]:
+        if isinstance(column, str):
+            numerical_columns.append(column)
+    return WindowBuffer(
+        window_size, column_mapping.categorical_features or [], numerical_columns
+    )
+
+
 class MonitoringService:
+    """
+    /iterate only appends the rows to the window of the dataset. The metrics are
+    calculated in a thread pool: a scheduler thread (start) takes a snapshot of
+    each full window every calculation_period_sec and runs the monitors over it.
+    At most max_concurrent_calculations run at the same time, and one per dataset.
+    Calculations that do not fit are skipped, and the ones that take longer than
+    calculation_period_sec are counted as overruns.
+
+    The drift of the categorical features is also calculated incrementally, from
+    the category counts of the window, at every scrape of /metrics.
+    """
+
     # names of monitoring datasets
     datasets: List[str]
-    metric: Dict[str, prometheus_client.Gauge]
-    last_run: Optional[datetime.datetime]
+    # last calculated samples (metric name, labels, value), per dataset
+    metrics: Dict[str, List[Tuple[str, Dict[str, str], float]]]
     # collection of reference data
     reference: Dict[str, pd.DataFrame]
     # collection of current data
-    current: Dict[str, Optional[pd.DataFrame]]
+    current: Dict[str, WindowBuffer]
     # collection of monitoring objects
     monitoring: Dict[str, ModelMonitoring]
     calculation_period_sec: float = 15
     window_size: int
 
-    def __init__(self, datasets: Dict[str, LoadedDataset], window_size: int):
+    def __init__(
+        self,
+        datasets: Dict[str, LoadedDataset],
+        window_size: int,
+        registry: prometheus_client.CollectorRegistry = prometheus_client.REGISTRY,
+        calculation_period_sec: float = 15,
+        max_concurrent_calculations: int = 1,
+    ):
         self.reference = {}
         self.monitoring = {}
         self.current = {}
         self.column_mapping = {}
+        # drift of the categorical features, updated on every /iterate
+        self.categorical_drift = {}
         self.window_size = window_size
+        self.calculation_period_sec = calculation_period_sec
 
         for dataset_info in datasets.values():
             self.reference[dataset_info.name] = dataset_info.references
@@ -132,79 +181,177 @@ class MonitoringService:
                 options=[],
             )
             self.column_mapping[dataset_info.name] = dataset_info.column_mapping
+            self.current[dataset_info.name] = make_window_buffer(
+                dataset_info.column_mapping, window_size
+            )
+            self.categorical_drift[dataset_info.name] = CategoricalDrift(
+                self.current[dataset_info.name],
+                dataset_info.references,
+                dataset_info.column_mapping.categorical_features or [],
+            )
 
         self.metrics = {}
         self.next_run_time = {}
+        self.stats = {"calculations": 0, "skipped": 0, "overruns": 0, "errors": 0}
+        # Protects the windows: /iterate writes, the scheduler takes snapshots
+        self.lock = threading.Lock()
+        self.running = set()
+        self.slots = threading.BoundedSemaphore(max_concurrent_calculations)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_calculations,
+            thread_name_prefix="evidently-calculation",
+        )
+        self._stop = threading.Event()
+        self._thread = None
+        # prometheus registry of the metrics, served by /metrics
+        self.registry = registry
+        self.registry.register(self)
 
-    def iterate(self, dataset_name: str, new_rows: pd.DataFrame):
+    def iterate(self, dataset_name: str, new_rows: Union[pd.DataFrame, List[dict]]):
         """Add data to current dataset for specified dataset"""
-        window_size = self.window_size
-
-        if dataset_name in self.current:
-            current_data = self.current[dataset_name].append(
-                new_rows, ignore_index=True
-            )
-
-        else:
-            current_data = new_rows
-
-        current_size = current_data.shape[0]
+        # The ring buffer keeps the last window_size rows
+        with self.lock:
+            self.current[dataset_name].extend(new_rows)
+
+    def run_pending(self) -> List[Future]:
+        """
+        Submits the calculation of the datasets with a full window whose next run
+        time has passed. Returns the futures of the submitted calculations.
+        """
+        futures = []
+        now = datetime.datetime.now()
+        for dataset_name, window in self.current.items():
+            current_size = len(window)
+            if current_size < self.window_size:
+                logging.debug(
+                    "Not enough data for measurement: %s of %s. Waiting more data",
+                    current_size,
+                    self.window_size,
+                )
+                continue
 
-        if current_size > self.window_size:
-            # cut current_size by window size value
-            current_data.drop(
-                index=list(range(0, current_size - self.window_size)), inplace=True
+            next_run_time = self.next_run_time.get(dataset_name)
+            if next_run_time is not None and next_run_time > now:
+                continue
+            self.next_run_time[dataset_name] = now + datetime.timedelta(
+                seconds=self.calculation_period_sec
             )
-            current_data.reset_index(drop=True, inplace=True)
 
-        self.current[dataset_name] = current_data
+            # The previous calculation of the dataset is still running, or all
+            # the slots are busy
+            if dataset_name in self.running or not self.slots.acquire(blocking=False):
+                self.stats["skipped"] += 1
+                logging.warning("Calculation for dataset %s skipped", dataset_name)
+                continue
 
-        if current_size < window_size:
-            logging.info(
-                f"Not enough data for measurement: {current_size} of {window_size}."
-                f" Waiting more data"
+            self.running.add(dataset_name)
+            with self.lock:
+                snapshot = window.snapshot()
+            futures.append(self.executor.submit(self.calculate, dataset_name, snapshot))
+        return futures
+
+    def calculate(self, dataset_name: str, window: WindowBuffer):
+
+        started = time.perf_counter()
+        try:
+            # The DataFrame is only built when the metrics are calculated
+            self.monitoring[dataset_name].execute(
+                self.reference[dataset_name],
+                window.to_frame(),
+                self.column_mapping[dataset_name],
             )
-            return
 
-        next_run_time = self.next_run_time.get(dataset_name)
+            samples = []
+            for metric, value, labels in self.monitoring[dataset_name].metrics():
+                if isinstance(value, str):
+                    continue
+                labels = {
+                    **{key: str(label) for key, label in (labels or {}).items()},
+                    "dataset_name": dataset_name,
+                }
+                samples.append((f"evidently:{metric.name}", labels, value))
+
+            # All the metrics of the dataset are replaced at once, so /metrics never
+            # returns values of different calculations
+            self.metrics[dataset_name] = samples
+            self.stats["calculations"] += 1
+        except Exception as error:  # pylint: disable=broad-except
+            self.stats["errors"] += 1
+            logging.error("Calculation for dataset %s failed: %s", dataset_name, error)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed > self.calculation_period_sec:
+                self.stats["overruns"] += 1
+                logging.warning(
+                    "Calculation for dataset %s took %.3f s, more than %s s",
+                    dataset_name,
+                    elapsed,
+                    self.calculation_period_sec,
+                )
+            self.running.discard(dataset_name)
+            self.slots.release()
+
+    def collect(self):
+        """Prometheus collector of the last calculated metrics"""
+        families = {}
+        for samples in list(self.metrics.values()):
+            for metric_key, labels, value in samples:
+                family = families.get(metric_key)
+                if family is None:
+                    family = Metric(metric_key, "", "gauge")
+                    families[metric_key] = family
+                family.add_sample(metric_key, labels, value)
+        yield from families.values()
+
+        # Calculated from the window counts at every scrape
+        drift = Metric("evidently:categorical_drift:value", "", "gauge")
+        for dataset_name, categorical_drift in self.categorical_drift.items():
+            try:
+                with self.lock:
+                    statistics = categorical_drift.statistics()
+            except Exception as error:  # pylint: disable=broad-except
+                # One failing monitor must not fail the whole scrape
+                logging.error(
+                    "Categorical drift of dataset %s failed: %s", dataset_name, error
+                )
+                continue
+            for feature, values in statistics.items():
+                for stat_test, value in values.items():
+                    labels = {
+                        "dataset_name": dataset_name,
+                        "feature": feature,
+                        "stat_test": stat_test,
+                    }
+                    drift.add_sample(drift.name, labels, value)
+        yield drift
 
-        if next_run_time is not None and next_run_time > datetime.datetime.now():
-            logging.info("Next run for dataset %s at %s", dataset_name, next_run_time)
-            return
+        for stat, value in self.stats.items():
+            yield GaugeMetricFamily(f"evidently_service:{stat}", "", value=value)
 
-        self.next_run_time[dataset_name] = datetime.datetime.now() + datetime.timedelta(
-            seconds=self.calculation_period_sec
-        )
-        self.monitoring[dataset_name].execute(
-            self.reference[dataset_name],
-            current_data,
-            self.column_mapping[dataset_name],
-        )
-
-        for metric, value, labels in self.monitoring[dataset_name].metrics():
-            metric_key = f"evidently:{metric.name}"
-            found = self.metrics.get(metric_key)
+    def describe(self):
+        # Metrics are only known after the first calculation
+        return []
 
-            if not labels:
-                labels = {}
+    def run(self):
 
-            labels["dataset_name"] = dataset_name
+        while not self._stop.wait(min(1.0, self.calculation_period_sec)):
+            self.run_pending()
 
-            if isinstance(value, str):
-                continue
+    def start(self):
 
-            if found is None:
-                found = prometheus_client.Gauge(
-                    metric_key, "", list(sorted(labels.keys()))
-                )
-                self.metrics[metric_key] = found
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="evidently-scheduler", daemon=True
+        )
+        self._thread.start()
+        return self
 
-            try:
-                found.labels(**labels).set(value)
+    def stop(self, timeout: Optional[float] = None):
 
-            except ValueError as error:
-                # ignore errors sending other metrics
-                logging.error("Value error for metric %s, error: ", metric_key, error)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.executor.shutdown(wait=True)
 
 
 SERVICE: Optional[MonitoringService] = None
@@ -214,6 +361,11 @@ SERVICE: Optional[MonitoringService] = None
 def configure_service():
     # pylint: disable=global-statement
     global SERVICE
+    # Already configured (e.g. in tests)
+    if SERVICE is not None:
+        return
+    started = time.perf_counter()
+
     config_file_path = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "config.yaml"
     )
@@ -245,8 +397,17 @@ def configure_service():
         logging.info(
             f"Load reference data for dataset {dataset_name} from {reference_file}"
         )
-        reference_data = preprocess_reference_data(
-            reference_file, DATE_FIELDS, DTYPE, CATEGORICAL_FEATURES
+        reference_data = load_reference_data(
+            reference_file,
+            {
+                "date_fields": DATE_FIELDS,
+                "dtype": DTYPE,
+                "categorical_features": CATEGORICAL_FEATURES,
+            },
+            lambda: preprocess_reference_data(
+                reference_file, DATE_FIELDS, DTYPE, CATEGORICAL_FEATURES
+            ),
+            REFERENCE_CACHE_DIR,
         )
         datasets[dataset_name] = LoadedDataset(
             name=dataset_name,
@@ -260,21 +421,53 @@ def configure_service():
             len(reference_data),
         )
 
-    SERVICE = MonitoringService(datasets=datasets, window_size=options.window_size)
+    SERVICE = MonitoringService(
+        datasets=datasets,
+        window_size=options.window_size,
+        calculation_period_sec=options.calculation_period_sec,
+        max_concurrent_calculations=options.max_concurrent_calculations,
+    ).start()
+    logging.info("Service started in %.3f s", time.perf_counter() - started)
+
+
+# Content types of the /iterate bodies, besides JSON (one record or a list)
+JSON_LINES_CONTENT_TYPES = ["application/x-ndjson", "application/jsonlines"]
+ARROW_STREAM_CONTENT_TYPES = [
+    "application/vnd.apache.arrow.stream",
+    "application/x-arrow-stream",
+]
+
+
+def read_rows(request: flask.Request) -> Union[pd.DataFrame, List[dict]]:
+    """Rows of an /iterate request body: JSON, JSON lines or Arrow IPC stream"""
+    if request.mimetype in ARROW_STREAM_CONTENT_TYPES:
+        with pa.ipc.open_stream(request.get_data()) as reader:
+            return reader.read_all().to_pandas()
+    if request.mimetype in JSON_LINES_CONTENT_TYPES:
+        lines = request.get_data(as_text=True).splitlines()
+        return [json.loads(line) for line in lines if line.strip()]
+    rows = request.get_json(force=True)
+    return rows if isinstance(rows, list) else [rows]
 
 
 @app.route("/iterate/<dataset>", methods=["POST"])
 def iterate(dataset: str):
 
-    item = flask.request.json
-
     global SERVICE
     if SERVICE is None:
         return "Internal Server Error: service not found", 500
-    logging.info(item)
-    logging.info(type(item))
-
-    SERVICE.iterate(dataset_name=dataset, new_rows=pd.DataFrame.from_dict([item]))
+    if dataset not in SERVICE.current:
+        return f"Not Found: dataset {dataset} is not configured", 404
+
+    try:
+        rows = read_rows(flask.request)
+    except (ValueError, pa.ArrowInvalid) as error:
+        return f"Bad Request: {error}", 400
+    logging.debug("Received %s rows for dataset %s", len(rows), dataset)
+
+    # The whole batch is added to the window in one call. The metrics are
+    # calculated in the background
+    SERVICE.iterate(dataset_name=dataset, new_rows=rows)
     return "ok"
 
 
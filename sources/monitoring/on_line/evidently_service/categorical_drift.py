@@ -0,0 +1,124 @@
+"""
+Incremental drift statistics for the categorical features of the current window.
+
+The reference histogram of each categorical column is counted once, with the codes
+of the WindowBuffer, and the window histogram is kept up to date by the buffer as
+rows are appended and evicted. The statistics are then calculated from the counts
+only, in O(categories), so they can be exported at every Prometheus scrape instead
+of waiting for the next evidently calculation.
+
+The statistics are calculated as evidently does for categorical features
+(evidently.calculations.stattests): chi-square p-value, PSI and Jensen-Shannon
+distance, over the categories present in the reference or in the window. As in
+evidently, missing values are left out: the sizes are the valid rows of each column.
+
+Classes:
+
+    CategoricalDrift
+
+Functions:
+
+    chisquare_p_value(reference_counts, current_counts, reference_size, current_size)
+    psi(reference_percents, current_percents)
+    jensenshannon(reference_percents, current_percents)
+
+"""
+
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import distance
+from scipy.stats import chisquare
+
+from window_buffer import MISSING_CODE, WindowBuffer
+
+# evidently replaces empty buckets by this share in the PSI
+PSI_MIN_PERCENT = 0.0001
+
+
+def chisquare_p_value(
+    reference_counts: np.ndarray,
+    current_counts: np.ndarray,
+    reference_size: int,
+    current_size: int,
+) -> float:
+
+    # Expected counts are the reference counts, scaled to the size of the window
+    f_exp = reference_counts * (current_size / reference_size)
+    return float(chisquare(current_counts, f_exp)[1])
+
+
+def psi(reference_percents: np.ndarray, current_percents: np.ndarray) -> float:
+
+    reference_percents = np.where(
+        reference_percents == 0, PSI_MIN_PERCENT, reference_percents
+    )
+    current_percents = np.where(
+        current_percents == 0, PSI_MIN_PERCENT, current_percents
+    )
+    return float(
+        np.sum(
+            (reference_percents - current_percents)
+            * np.log(reference_percents / current_percents)
+        )
+    )
+
+
+def jensenshannon(
+    reference_percents: np.ndarray, current_percents: np.ndarray
+) -> float:
+    return float(distance.jensenshannon(reference_percents, current_percents))
+
+
+class CategoricalDrift:
+    def __init__(
+        self, window: WindowBuffer, reference: pd.DataFrame, columns: List[str]
+    ):
+
+        self.window = window
+        self.columns = [column for column in columns if column in reference]
+        # Reference values are encoded with the codes of the window
+        self.reference_counts = {}
+        for column in self.columns:
+            codes = window.encode(column, reference[column].values)
+            self.reference_counts[column] = np.bincount(
+                codes[codes != MISSING_CODE]
+            ).astype(np.int64)
+
+    def counts(self, column: str):
+        """Reference and window counts of the column, over the same categories"""
+        n_categories = len(self.window.categories[column])
+        reference_counts = self.reference_counts[column]
+        current_counts = self.window.counts[column]
+        reference_counts = np.pad(
+            reference_counts, (0, n_categories - len(reference_counts))
+        )
+        current_counts = np.pad(current_counts, (0, n_categories - len(current_counts)))
+        # Categories present in the reference or in the window
+        present = (reference_counts > 0) | (current_counts > 0)
+        return reference_counts[present], current_counts[present]
+
+    def statistics(self) -> Dict[str, Dict[str, float]]:
+        """Drift statistics per column: {column: {stat_test: value}}"""
+        if len(self.window) == 0:
+            return {}
+
+        statistics = {}
+        for column in self.columns:
+            reference_counts, current_counts = self.counts(column)
+            # Rows with a value, missing values are not counted
+            reference_size = reference_counts.sum()
+            current_size = current_counts.sum()
+            if reference_size == 0 or current_size == 0:
+                continue
+            reference_percents = reference_counts / reference_size
+            current_percents = current_counts / current_size
+            statistics[column] = {
+                "chisquare": chisquare_p_value(
+                    reference_counts, current_counts, reference_size, current_size
+                ),
+                "psi": psi(reference_percents, current_percents),
+                "jensenshannon": jensenshannon(reference_percents, current_percents),
+            }
+        return statistics
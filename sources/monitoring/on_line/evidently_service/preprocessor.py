@@ -8,33 +8,215 @@ Classes:
 
 """
 
-from typing import List
+import re
+import logging
+from typing import List, Optional
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from pyarrow import parquet as pq
 from sklearn.feature_extraction import DictVectorizer
 
 
+# Bytes of csv read (and rows written to the parquet file) at a time
+CSV_BLOCK_SIZE = 16 << 20
+# Timestamps of the data.cityofchicago.org csv files, e.g. 04/01/2022 12:00:00 AM
+TIMESTAMP_PARSERS = [pa_csv.ISO8601, "%m/%d/%Y %I:%M:%S %p"]
+
+# Trips kept by preprocess_data
+MIN_TRIP_SECONDS = 60
+MAX_TRIP_SECONDS = 3600
+# Same filter, pushed down into the parquet read (read_dataframe_parquet)
+TRIP_SECONDS_FILTERS = [
+    ("trip_seconds", ">", MIN_TRIP_SECONDS),
+    ("trip_seconds", "<", MAX_TRIP_SECONDS),
+]
+
+
+def preprocessing_columns(
+    categorical_features: List[str], numerical_features: List[str]
+) -> List[str]:
+
+    # Columns read by preprocess_data
+    return categorical_features + numerical_features + ["trip_seconds"]
+
+
+def normalize_categorical(values: np.ndarray) -> pd.Categorical:
+    """
+    Same values as fillna(-1), astype(str), str.lower() and str.replace(" ", "_"),
+    but the strings are only formatted once per unique value and mapped back
+    through the codes
+    """
+    # Hash based, the unique values are not sorted. NaNs have code -1
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques)
+    labels = uniques.astype(str).str.lower().str.replace(" ", "_").tolist()
+    if (codes < 0).any():
+        # NaNs take the last label
+        labels.append("-1.0" if pd.api.types.is_float_dtype(uniques) else "-1")
+    # Different values may have the same formatted value, e.g. "A" and "a"
+    label_codes, categories = pd.factorize(np.asarray(labels, dtype=object))
+    return pd.Categorical.from_codes(label_codes[codes], categories)
+
+
+def csv_column_types(file_path: str, parse_dates: List[str], dtype: dict) -> dict:
+    """
+    Arrow types of the csv columns. The types are inferred from the first block,
+    and integers are read as floats, since a later block may have decimals
+    """
+    with pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            timestamp_parsers=TIMESTAMP_PARSERS, strings_can_be_null=True
+        ),
+    ) as reader:
+        schema = reader.schema
+
+    column_types = {}
+    for field in schema:
+        if field.name in dtype:
+            column_types[field.name] = pa.from_numpy_dtype(np.dtype(dtype[field.name]))
+        elif field.name in parse_dates:
+            column_types[field.name] = pa.timestamp("ns")
+        elif pa.types.is_integer(field.type):
+            column_types[field.name] = pa.float64()
+        elif pa.types.is_null(field.type):
+            # Empty in the first block
+            column_types[field.name] = pa.string()
+        else:
+            column_types[field.name] = field.type
+    return column_types
+
+
+def failed_csv_column(error: pa.ArrowInvalid, column_names: List[str]):
+
+    # e.g. "In CSV column #5: Row #1002: CSV conversion error to double: ..."
+    match = re.search(r"In CSV column #(\d+)", str(error))
+    if match is None or int(match.group(1)) >= len(column_names):
+        return None
+    return column_names[int(match.group(1))]
+
+
+def rename_schema(schema: pa.Schema) -> pa.Schema:
+
+    # "Trip Start Timestamp" -> "trip_start_timestamp"
+    return pa.schema(
+        [field.with_name(field.name.lower().replace(" ", "_")) for field in schema]
+    )
+
+
 class Preprocessor:
     def __init__(self, verbose: bool = False, analyse: bool = False):
 
         self.verbose = verbose
         self.analyse = analyse
 
+    def convert_csv(
+        self,
+        file_path: str,
+        parse_dates: List[str],
+        dtype: dict,
+        collect: bool = False,
+        column_types: Optional[dict] = None,
+    ):
+        """
+        Streams the csv file into a parquet file (same name, .parquet), one block
+        of CSV_BLOCK_SIZE bytes at a time, so the memory does not depend on the size
+        of the file. Returns the parquet file name and, if collect, the arrow table.
+        column_types (arrow types by csv column) replace the inferred types.
+
+        The types are inferred from the first block. If a later block has values of
+        another type (e.g. text in a column of numbers), the conversion restarts
+        with that column read as strings, as pandas reads such columns
+        """
+        column_types = {
+            **csv_column_types(file_path, parse_dates, dtype),
+            **(column_types or {}),
+        }
+        column_names = list(column_types)
+        # Only the extension is replaced, not "csv" in the directory names
+        output_file_name = str(Path(file_path).with_suffix(".parquet"))
+        while True:
+            try:
+                table = self.stream_csv(
+                    file_path, output_file_name, column_types, collect
+                )
+                return output_file_name, table
+            except pa.ArrowInvalid as error:
+                column = failed_csv_column(error, column_names)
+                if column is None or column_types[column] == pa.string():
+                    raise
+                logging.warning(
+                    "Column %s of %s changes type after the first block (%s), "
+                    "reading it as strings",
+                    column,
+                    file_path,
+                    error,
+                )
+                column_types[column] = pa.string()
+
+    def stream_csv(
+        self,
+        file_path: str,
+        output_file_name: str,
+        column_types: dict,
+        collect: bool = False,
+    ) -> Optional[pa.Table]:
+
+        batches = []
+        with pa_csv.open_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=column_types,
+                timestamp_parsers=TIMESTAMP_PARSERS,
+                # Empty values are NaNs, as in pandas
+                strings_can_be_null=True,
+            ),
+        ) as reader:
+            schema = rename_schema(reader.schema)
+            with pq.ParquetWriter(output_file_name, schema) as writer:
+                for batch in reader:
+                    batch = pa.RecordBatch.from_arrays(batch.columns, schema=schema)
+                    writer.write_batch(batch)
+                    if collect:
+                        batches.append(batch)
+
+        return pa.Table.from_batches(batches, schema=schema) if collect else None
+
     def read_dataframe_csv(self, file_path: str, parse_dates: List[str], dtype: dict):
 
         # Ensure that columns in dtype are correctly read as strings.
-        df = pd.read_csv(file_path, parse_dates=parse_dates, dtype=dtype)
-        df.columns = df.columns.str.lower().str.replace(" ", "_")
-        output_file_name = file_path.replace("csv", "parquet")
-        df.to_parquet(output_file_name, engine="pyarrow", index=None)
+        output_file_name, _ = self.convert_csv(file_path, parse_dates, dtype)
 
         return output_file_name
 
-    def read_dataframe_parquet(self, file_path: str):
+    def read_dataframe(self, file_path: str, parse_dates: List[str], dtype: dict):
+        """
+        read_dataframe_csv + read_dataframe_parquet, without reading back the
+        parquet file
+        """
+        _, table = self.convert_csv(file_path, parse_dates, dtype, collect=True)
+        return table.to_pandas()
 
-        return pd.read_parquet(file_path)
+    def read_dataframe_parquet(
+        self,
+        file_path: str,
+        columns: Optional[List[str]] = None,
+        filters: Optional[list] = None,
+    ):
+        """
+        Only the columns are read, and the filters (e.g. TRIP_SECONDS_FILTERS) skip
+        the row groups by their statistics and drop the rows before the conversion
+        to pandas
+        """
+        return pd.read_parquet(
+            file_path, engine="pyarrow", columns=columns, filters=filters
+        )
 
     def analyse_dataframe(self, df: pd.DataFrame, target: str = None):
 
@@ -94,6 +276,8 @@ class Preprocessor:
             categorical fillnans with -1
             categorical to str
             categorical value formatting
+            Only the unique values are formatted (normalize_categorical), and the
+            columns are returned as pandas categories
 
         2.- Target
         create duration in minutes as target
@@ -103,38 +287,35 @@ class Preprocessor:
         Return df and target
         """
 
-        df = df[df.trip_seconds.notnull()]
+        # NaNs are not > 60. No copy of the frame, only of the columns kept
+        mask = (
+            (df.trip_seconds > MIN_TRIP_SECONDS) & (df.trip_seconds < MAX_TRIP_SECONDS)
+        ).values
         # df = df[df.trip_start_timestamp.notnull()]
-        df = df[(df.trip_seconds > 60) & (df.trip_seconds < 3600)]
-        df["duration"] = df["trip_seconds"] / 60
 
+        columns = {}
         for column in categorical_features:
             if self.verbose:
                 print(
-                    f"\nFilling {round(df[column].isna().mean()*100,2)}% "
+                    f"\nFilling {round(df[column][mask].isna().mean()*100,2)}% "
                     f"of nans with -1 in column: {column}"
                 )
-            df[column].fillna(-1, inplace=True)
-            # astype('str') will not touch the None values, only the not None types are processed
-            df[column] = df[column].astype("str")
-            df[column] = df[column].str.lower().str.replace(" ", "_")
+            columns[column] = normalize_categorical(df[column].values[mask])
+        for column in numerical_features:
+            columns[column] = df[column].values[mask]
+        features = pd.DataFrame(columns, index=df.index[mask])
 
         target = ["duration"]
-
-        df.drop(
-            df.columns.difference(categorical_features + numerical_features + target),
-            axis=1,
-            inplace=True,
-        )
+        duration = (df["trip_seconds"].values[mask] / 60).reshape(-1, 1)
 
         if self.verbose:
-            print(f"\nfinal shape: {df.shape}")
-            print(f"\nfinal types:\n{df.dtypes}")
+            print(f"\nfinal shape: {(len(features), features.shape[1] + 1)}")
+            print(f"\nfinal types:\n{features.dtypes}")
             print(f"\ncategorical_features: {categorical_features}")
             print(f"\nnumerical_features: {numerical_features}")
             print(f"\ntarget: {target}")
 
-        return df[categorical_features + numerical_features], df[target].values
+        return features, duration
 
     def prepare_dictionaries(
         self,
@@ -173,8 +354,20 @@ class Preprocessor:
         dtype: dict,
     ):
 
-        file_path = self.read_dataframe_csv(csv_file_path, parse_dates, dtype)
-        df_raw = self.read_dataframe_parquet(file_path)
+        parquet_path = Path(csv_file_path).with_suffix(".parquet")
+        if (
+            not self.analyse
+            and parquet_path.exists()
+            and parquet_path.stat().st_mtime >= Path(csv_file_path).stat().st_mtime
+        ):
+            # Already converted: only the columns and rows used by preprocess_data
+            df_raw = self.read_dataframe_parquet(
+                str(parquet_path),
+                columns=preprocessing_columns(categorical_features, []),
+                filters=TRIP_SECONDS_FILTERS,
+            )
+        else:
+            df_raw = self.read_dataframe(csv_file_path, parse_dates, dtype)
 
         if self.analyse:
             self.analyse_dataframe(df_raw, target)
@@ -0,0 +1,88 @@
+"""
+Cache of the preprocessed reference datasets of the evidently service.
+
+Preprocessing the reference CSV (read, write parquet, read back, filter) takes most
+of the service startup. The preprocessed frame is stored as parquet, with the
+categorical columns as pandas categories, under a key made of the hash of the
+source file and of the preprocessing config (arguments and preprocessor.py source).
+A change in any of them gives a new key, so stale entries are never read.
+
+Functions:
+
+    file_hash(file_path)
+    cache_key(source_path, config)
+    load_reference_data(source_path, config, preprocess, cache_dir)
+
+"""
+
+import os
+import json
+import hashlib
+import logging
+from typing import Callable, Optional
+
+import pandas as pd
+
+# Source of the preprocessing, part of the cache key
+PREPROCESSOR_PATH = os.path.join(os.path.dirname(__file__), "preprocessor.py")
+
+
+def file_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(source_path: str, config: dict) -> str:
+
+    digest = hashlib.sha256()
+    digest.update(file_hash(source_path).encode())
+    # default=str for the dtypes, e.g. {"Pickup Community Area": str}
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    if os.path.exists(PREPROCESSOR_PATH):
+        digest.update(file_hash(PREPROCESSOR_PATH).encode())
+    return digest.hexdigest()[:16]
+
+
+def load_reference_data(
+    source_path: str,
+    config: dict,
+    preprocess: Callable[[], pd.DataFrame],
+    cache_dir: Optional[str],
+) -> pd.DataFrame:
+    """
+    Returns the preprocessed reference data from the cache, or calls preprocess
+    and stores its result. The cache is disabled if cache_dir is None or empty.
+    """
+    if not cache_dir:
+        return preprocess()
+
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    cache_path = os.path.join(
+        cache_dir, f"{name}-{cache_key(source_path, config)}.parquet"
+    )
+    if os.path.exists(cache_path):
+        logging.info("Reference cache hit: %s", cache_path)
+        return pd.read_parquet(cache_path)
+
+    logging.info("Reference cache miss: %s", cache_path)
+    reference_data = preprocess()
+    # Low cardinality text columns (not trip_id) are stored as categories: smaller
+    # and faster to load
+    reference_data = reference_data.astype(
+        {
+            column: "category"
+            for column in reference_data.columns
+            if reference_data[column].dtype == object
+            and reference_data[column].nunique() < len(reference_data) // 2
+        }
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write and rename, so that a failed write never leaves a partial entry
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    reference_data.to_parquet(temp_path, engine="pyarrow", index=False)
+    os.replace(temp_path, cache_path)
+    return reference_data
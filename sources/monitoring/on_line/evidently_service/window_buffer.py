@@ -0,0 +1,194 @@
+"""
+Fixed capacity, column oriented ring buffer for the current data window of the
+monitoring service.
+
+Columns are preallocated NumPy arrays: categorical columns are stored as integer
+codes (with one category list per column), the other columns as floats. Appending
+rows writes into the arrays in place, so it costs O(rows) regardless of the window
+size. A DataFrame is only built (to_frame) when the metrics are calculated.
+
+The number of rows of each category in the window (counts) is updated as rows are
+appended and evicted, for the incremental drift statistics (categorical_drift.py).
+
+Classes:
+
+    WindowBuffer
+
+"""
+
+import copy
+from typing import Dict, List, Union, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+MISSING_CODE = -1
+
+
+class WindowBuffer:
+    def __init__(
+        self,
+        capacity: int,
+        categorical_columns: List[str],
+        numerical_columns: Optional[List[str]] = None,
+    ):
+
+        self.capacity = capacity
+        self.categorical_columns = list(categorical_columns)
+        self.numerical_columns = list(numerical_columns or [])
+        self.arrays = {
+            column: np.full(capacity, MISSING_CODE, dtype=np.int32)
+            for column in self.categorical_columns
+        }
+        self.arrays.update(
+            {
+                column: np.full(capacity, np.nan, dtype=np.float64)
+                for column in self.numerical_columns
+            }
+        )
+        # Category values and their codes, per categorical column
+        self.categories = {column: [] for column in self.categorical_columns}
+        self.codes = {column: {} for column in self.categorical_columns}
+        # Rows in the window per category code, per categorical column
+        self.counts = {
+            column: np.zeros(0, dtype=np.int64) for column in self.categorical_columns
+        }
+        # Columns received at least once. Only these are returned by to_frame
+        self.seen = set()
+        # Next position to write and number of valid rows
+        self.position = 0
+        self.size = 0
+        self.total_rows = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def encode(self, column: str, values: Iterable) -> np.ndarray:
+
+        codes = self.codes[column]
+        categories = self.categories[column]
+        encoded = []
+        for value in values:
+            # None and NaN are missing values
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                encoded.append(MISSING_CODE)
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = len(categories)
+                codes[value] = code
+                categories.append(value)
+            encoded.append(code)
+        return np.asarray(encoded, dtype=np.int32)
+
+    def count(self, column: str, codes: np.ndarray, sign: int):
+
+        counts = np.bincount(
+            codes[codes != MISSING_CODE], minlength=len(self.categories[column])
+        )
+        if len(counts) > len(self.counts[column]):
+            # New categories
+            self.counts[column] = np.pad(
+                self.counts[column], (0, len(counts) - len(self.counts[column]))
+            )
+        self.counts[column] += sign * counts
+
+    def write(self, array: np.ndarray, values: np.ndarray):
+
+        end = self.position + len(values)
+        if end <= self.capacity:
+            array[self.position : end] = values
+        else:
+            split = self.capacity - self.position
+            array[self.position :] = values[:split]
+            array[: end - self.capacity] = values[split:]
+
+    def extend_columns(self, columns: Dict[str, Union[list, np.ndarray]], n_rows: int):
+        """Appends n_rows given as one list/array per column"""
+        if n_rows == 0:
+            return
+        self.total_rows += n_rows
+        # Only the last `capacity` rows fit in the window
+        skip = max(0, n_rows - self.capacity)
+        n_rows -= skip
+
+        # Rows overwritten by the new ones, oldest first
+        n_evicted = max(0, self.size + n_rows - self.capacity)
+        evicted = (self.position - self.size + np.arange(n_evicted)) % self.capacity
+        for column in self.categorical_columns:
+            self.count(column, self.arrays[column][evicted], -1)
+
+        for column, array in self.arrays.items():
+            values = columns.get(column)
+            if values is None:
+                fill_value = MISSING_CODE if column in self.codes else np.nan
+                array_values = np.full(n_rows, fill_value, dtype=array.dtype)
+            else:
+                self.seen.add(column)
+                values = values[skip:]
+                if column in self.codes:
+                    array_values = self.encode(column, values)
+                else:
+                    array_values = pd.to_numeric(
+                        np.asarray(values, dtype=object), errors="coerce"
+                    ).astype(np.float64)
+            self.write(array, array_values)
+            if column in self.codes:
+                self.count(column, array_values, 1)
+
+        self.position = (self.position + n_rows) % self.capacity
+        self.size = min(self.capacity, self.size + n_rows)
+
+    def extend(self, rows: Union[pd.DataFrame, List[dict]]):
+
+        if isinstance(rows, pd.DataFrame):
+            columns = {
+                column: rows[column].values for column in self.arrays if column in rows
+            }
+        else:
+            columns = {
+                column: [row.get(column) for row in rows]
+                for column in self.arrays
+                if any(column in row for row in rows)
+            }
+        self.extend_columns(columns, len(rows))
+
+    def append(self, row: dict):
+        self.extend([row])
+
+    def snapshot(self) -> "WindowBuffer":
+        """Copy of the window, e.g. to build the DataFrame in another thread"""
+        snapshot = copy.copy(self)
+        snapshot.arrays = {
+            column: array.copy() for column, array in self.arrays.items()
+        }
+        snapshot.categories = {
+            column: list(categories) for column, categories in self.categories.items()
+        }
+        snapshot.codes = {column: dict(codes) for column, codes in self.codes.items()}
+        snapshot.counts = {
+            column: counts.copy() for column, counts in self.counts.items()
+        }
+        snapshot.seen = set(self.seen)
+        return snapshot
+
+    def ordered(self, array: np.ndarray) -> np.ndarray:
+
+        # Oldest row first
+        if self.size < self.capacity:
+            return array[: self.size]
+        return np.concatenate([array[self.position :], array[: self.position]])
+
+    def to_frame(self) -> pd.DataFrame:
+
+        data = {}
+        for column, array in self.arrays.items():
+            if column not in self.seen:
+                continue
+            values = self.ordered(array)
+            if column in self.codes:
+                # Decoded to objects, the same dtype as the reference data
+                categories = np.asarray(self.categories[column] + [None], dtype=object)
+                values = categories[values]
+            data[column] = values
+        return pd.DataFrame(data)
@@ -1,14 +1,29 @@
+# pylint: disable=wrong-import-position
+import time
+
+# Measures the import time of this module, including mlflow and sklearn
+IMPORT_STARTED = time.perf_counter()
+
 import os
 import json
-import logging
-
-import requests
 
 from production.model_service import (
+    ID_COLUMN,
+    FEATURES,
     init_model_s3,
     init_dummy_model,
     init_model_local,
     init_model_mlflow,
+    init_model_lookup_table,
+    json_lines_columns,
+)
+from production.stage_timer import init_stage_timer
+from production.evidently_forwarder import EvidentlyForwarder
+from production.model_refresher import (
+    FileRegistry,
+    MlflowRegistry,
+    ModelRefresher,
+    init_model_registry,
 )
 
 # Run from test folder if local model is in use, so that default model location is found
@@ -25,46 +40,212 @@ MLFLOW_MODEL_LOCATION = os.getenv("MLFLOW_MODEL_LOCATION", "")
 MLFLOW_MODEL_STAGE = os.getenv("MLFLOW_MODEL_STATE", "Staging")
 MLFLOW_MODEL_NAME = os.getenv("MLFLOW_MODEL_NAME", "chicago-taxi")
 MLFLOW_TRACKING_URI = os.getenv("MLFLOW_TRACKING_URI", "http://127.0.0.1:8080")
+# Directory with a lookup table exported by development/export_lookup_table.py
+# If set, it takes precedence over MLFLOW_MODEL_LOCATION
+LOOKUP_TABLE_LOCATION = os.getenv("LOOKUP_TABLE_LOCATION", "")
+# Bodies with these content types are sent to the model service as JSON lines
+JSON_LINES_CONTENT_TYPES = ["application/x-ndjson", "application/jsonlines"]
+# Local snapshots of the deserialized model, keyed by run_id or registry version.
+# Disabled by default (empty string): /tmp is empty on each Lambda cold start, so
+# a snapshot there would always miss, and add its write to the cold start. Point
+# it to a location that survives cold starts: EFS, or a directory of snapshots
+# built into the image (e.g. by running the model load once in the Dockerfile)
+MODEL_SNAPSHOT_DIR = os.getenv("MODEL_SNAPSHOT_DIR", "")
+# Local registry used when MLFLOW_MODEL_LOCATION is "file", see FileRegistry
+MODEL_REGISTRY_PATH = os.getenv("MODEL_REGISTRY_PATH", "./registry")
+# Polls the registry ("mlflow" or "file" locations) and swaps the model when a new
+# version is in MLFLOW_MODEL_STAGE. 0 disables it.
+# Note that Lambda freezes background threads between invocations, this is meant
+# mainly for long running containers
+MODEL_REFRESH_INTERVAL_SEC = float(os.getenv("MODEL_REFRESH_INTERVAL_SEC", "0"))
+# Predictions are sent to the evidently service in the background, in batches.
+# Note that Lambda freezes the worker between invocations, so queued records are
+# sent on the next invocations
+EVIDENTLY_FORWARDING = os.getenv("EVIDENTLY_FORWARDING", "false").lower() == "true"
+EVIDENTLY_QUEUE_SIZE = int(os.getenv("EVIDENTLY_QUEUE_SIZE", "10000"))
+EVIDENTLY_BATCH_SIZE = int(os.getenv("EVIDENTLY_BATCH_SIZE", "100"))
+EVIDENTLY_FLUSH_INTERVAL_SEC = float(os.getenv("EVIDENTLY_FLUSH_INTERVAL_SEC", "1"))
+# Per-stage timings of a sample of the requests (see production/stage_timer.py):
+# "emf" (CloudWatch metrics from the logs, the default in Lambda), "prometheus"
+# (histograms, served on STAGE_TIMING_METRICS_PORT if set) or "off". The same
+# sink exports the model version and the counters of the model refresher
+STAGE_TIMING = os.getenv(
+    "STAGE_TIMING", "emf" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "off"
+).lower()
+STAGE_TIMING_SAMPLE_RATE = float(os.getenv("STAGE_TIMING_SAMPLE_RATE", "0.01"))
+STAGE_TIMING_NAMESPACE = os.getenv("STAGE_TIMING_NAMESPACE", "ChicagoTaxi")
+STAGE_TIMING_METRICS_PORT = int(os.getenv("STAGE_TIMING_METRICS_PORT", "0"))
+# Prints every prediction. Off by default: at high request rates the print is a
+# significant part of the cost of the request
+LOG_PREDICTIONS = os.getenv("LOG_PREDICTIONS", "false").lower() == "true"
+
+# The model is loaded on the first request, see get_model
+model = None
+# Background registry poller, if enabled
+refresher = None
+
+
+def start_forwarder():
+
+    if not EVIDENTLY_FORWARDING:
+        return None
+    return EvidentlyForwarder(
+        f"{EVIDENTLY_SERVICE_ADDRESS}/iterate/taxi",
+        max_queue_size=EVIDENTLY_QUEUE_SIZE,
+        batch_size=EVIDENTLY_BATCH_SIZE,
+        flush_interval_sec=EVIDENTLY_FLUSH_INTERVAL_SEC,
+    ).start()
+
+
+forwarder = start_forwarder()
+stage_timer = init_stage_timer(
+    STAGE_TIMING, STAGE_TIMING_SAMPLE_RATE, namespace=STAGE_TIMING_NAMESPACE
+)
+if STAGE_TIMING == "prometheus" and STAGE_TIMING_METRICS_PORT:
+    # pylint: disable=import-outside-toplevel
+    from prometheus_client import start_http_server
+
+    start_http_server(STAGE_TIMING_METRICS_PORT)
+# Cold start timings, reported once with the first prediction
+TIMINGS = {}
+
+
+def init_model():
 
-print(f"Loading model from location {MLFLOW_MODEL_LOCATION}")
+    print(f"Loading model from location {MLFLOW_MODEL_LOCATION}")
 
-# Todo: get model location from mlflow's model registry server
-if MLFLOW_MODEL_LOCATION == "s3":
-    model = init_model_s3(S3_BUCKET_NAME, S3_BUCKET_FOLDER, EXPERIMENT_ID, RUN_ID)
-elif MLFLOW_MODEL_LOCATION == "":
-    model = init_dummy_model()
-elif MLFLOW_MODEL_LOCATION == "mlflow":
-    model = init_model_mlflow(
-        tracking_uri=MLFLOW_TRACKING_URI,
+    # Todo: get model location from mlflow's model registry server
+    if LOOKUP_TABLE_LOCATION != "":
+        print(f"Serving lookup table from {LOOKUP_TABLE_LOCATION}")
+        return init_model_lookup_table(LOOKUP_TABLE_LOCATION)
+    if MLFLOW_MODEL_LOCATION == "s3":
+        return init_model_s3(
+            S3_BUCKET_NAME,
+            S3_BUCKET_FOLDER,
+            EXPERIMENT_ID,
+            RUN_ID,
+            snapshot_dir=MODEL_SNAPSHOT_DIR,
+        )
+    if MLFLOW_MODEL_LOCATION == "":
+        return init_dummy_model()
+    if MLFLOW_MODEL_LOCATION == "file":
+        return init_model_registry(
+            FileRegistry(MODEL_REGISTRY_PATH, snapshot_dir=MODEL_SNAPSHOT_DIR),
+            name=MLFLOW_MODEL_NAME,
+            stage=MLFLOW_MODEL_STAGE,
+        )
+    if MLFLOW_MODEL_LOCATION == "mlflow":
+        return init_model_mlflow(
+            tracking_uri=MLFLOW_TRACKING_URI,
+            name=MLFLOW_MODEL_NAME,
+            stage=MLFLOW_MODEL_STAGE,
+            snapshot_dir=MODEL_SNAPSHOT_DIR,
+        )
+    return init_model_local(MLFLOW_MODEL_LOCATION, snapshot_dir=MODEL_SNAPSHOT_DIR)
+
+
+def start_refresher(model_service):
+
+    if MLFLOW_MODEL_LOCATION == "mlflow":
+        registry = MlflowRegistry(MLFLOW_TRACKING_URI, snapshot_dir=MODEL_SNAPSHOT_DIR)
+    elif MLFLOW_MODEL_LOCATION == "file":
+        registry = FileRegistry(MODEL_REGISTRY_PATH, snapshot_dir=MODEL_SNAPSHOT_DIR)
+    else:
+        return None
+    return ModelRefresher(
+        model_service,
+        registry,
         name=MLFLOW_MODEL_NAME,
         stage=MLFLOW_MODEL_STAGE,
-    )
-else:
-    model = init_model_local(MLFLOW_MODEL_LOCATION)
+        interval_sec=MODEL_REFRESH_INTERVAL_SEC,
+        sinks=stage_timer.sinks,
+    ).start()
+
+
+def get_model():
+    # pylint: disable=global-statement
+    global model, refresher
+    if model is None:
+        started = time.perf_counter()
+        model = init_model()
+        TIMINGS["model_load_seconds"] = time.perf_counter() - started
+        TIMINGS["snapshot"] = model.metadata.get("snapshot", "disabled")
+        TIMINGS["model_version"] = model.version
+        if MODEL_REFRESH_INTERVAL_SEC > 0:
+            refresher = start_refresher(model)
+    return model
+
+
+def monitoring_records(input_data, prediction) -> list:
 
+    # Records with the features and the prediction, as expected by /iterate/taxi.
+    # JSON lines bodies are passed decoded, as columns (see json_lines_columns)
+    if isinstance(prediction, dict) and not isinstance(prediction["prediction"], list):
+        return [prediction]
+    if isinstance(prediction, dict):
+        prediction = prediction["prediction"]
+    if isinstance(input_data, dict):
+        # Column oriented batch
+        columns = [c for c in [ID_COLUMN] + FEATURES if c in input_data]
+        input_data = [
+            dict(zip(columns, values))
+            for values in zip(*(input_data[c] for c in columns))
+        ]
+    return [
+        {**record, "prediction": value} for record, value in zip(input_data, prediction)
+    ]
 
-def send_to_evidently_service(record, prediction):
-    rec = record.copy()
-    logging.info(rec)
-    rec["prediction"] = prediction
-    logging.info([rec])
-    return requests.post(f"{EVIDENTLY_SERVICE_ADDRESS}/iterate/taxi", json=[rec])
+
+def send_to_evidently_service(input_data, prediction) -> int:
+
+    # Never blocks: records are dropped if the forwarder queue is full
+    if forwarder is None:
+        return 0
+    return forwarder.submit(monitoring_records(input_data, prediction))
+
+
+def decode_body(event):
+    headers = {
+        key.lower(): value for key, value in (event.get("headers") or {}).items()
+    }
+    content_type = headers.get("content-type", "").split(";")[0].strip()
+    if content_type in JSON_LINES_CONTENT_TYPES:
+        return event["body"]
+    return json.loads(event["body"])
 
 
 def lambda_handler(event, context):
     # pylint: disable=unused-argument
     # When using AWS_PROXY integration, the full http request is received as the event
-    input_data = json.loads(event["body"])
+    timings = stage_timer.request()
+    with timings.stage("decode"):
+        input_data = decode_body(event)
+    if isinstance(input_data, str):
+        # Decoded once, for the model and the monitoring records
+        input_data = json_lines_columns(input_data, timings=timings)
 
     # flush=True allows print in docker-compose
     # print(input_data, flush=True)
-    prediction = model.lambda_handler(input_data)
-    print(prediction, flush=True)
-    # This is under development. Not ready yet
-    # send_to_evidently_service(input_data, prediction['prediction'])
+    first_prediction = model is None
+    started = time.perf_counter()
+    prediction = get_model().lambda_handler(input_data, timings)
+    if first_prediction:
+        # includes the model load
+        TIMINGS["first_prediction_seconds"] = time.perf_counter() - started
+        print(json.dumps({"cold_start": TIMINGS}), flush=True)
+        stage_timer.record_model({"version": model.version})
+    if LOG_PREDICTIONS:
+        print(prediction, flush=True)
+    send_to_evidently_service(input_data, prediction)
+    with timings.stage("encode"):
+        body = json.dumps(prediction)
+    timings.finish()
     return {
         "statusCode": 200,
-        "body": json.dumps(prediction),
+        "body": body,
         "event": event,
         "isBase64Encoded": False,
     }
+
+
+TIMINGS["import_seconds"] = time.perf_counter() - IMPORT_STARTED
@@ -0,0 +1,133 @@
+"""
+Non-blocking forwarding of predictions to the evidently monitoring service.
+
+Predictions are put into a bounded in-process queue. A background worker sends
+them to `/iterate/<dataset>` in batches, when batch_size records are queued or
+flush_interval_sec has passed since the first record of the batch. When the queue
+is full, the records are dropped and counted, so that the request path never waits
+on monitoring.
+
+Classes:
+
+    EvidentlyForwarder
+
+"""
+
+import time
+import queue
+import logging
+import threading
+from typing import List, Optional
+
+import requests
+
+
+class EvidentlyForwarder:
+    def __init__(
+        self,
+        url: str,
+        max_queue_size: int = 10_000,
+        batch_size: int = 100,
+        flush_interval_sec: float = 1.0,
+        timeout_sec: float = 5.0,
+    ):
+
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.timeout_sec = timeout_sec
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # Keep-alive connection to the evidently service
+        self.session = requests.Session()
+        self.stats = {"queued": 0, "dropped": 0, "sent": 0, "failed": 0, "batches": 0}
+        # submit is called by the request threads, send by the worker
+        self.stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, records: List[dict]) -> int:
+        """
+        Queues the records without blocking. Returns the number of records queued,
+        the rest are dropped.
+        """
+        queued = 0
+        for record in records:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                break
+            queued += 1
+        with self.stats_lock:
+            self.stats["queued"] += queued
+            self.stats["dropped"] += len(records) - queued
+        return queued
+
+    def next_batch(self) -> List[dict]:
+
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            try:
+                # Short waits, so that stop() does not wait for the flush interval
+                batch.append(self.queue.get(timeout=0.05))
+            except queue.Empty:
+                if deadline is None or self._stop.is_set():
+                    break
+                continue
+            if deadline is None:
+                # The time limit starts with the first record of the batch
+                deadline = time.monotonic() + self.flush_interval_sec
+        return batch
+
+    def send(self, batch: List[dict]):
+
+        try:
+            response = self.session.post(self.url, json=batch, timeout=self.timeout_sec)
+            response.raise_for_status()
+            with self.stats_lock:
+                self.stats["sent"] += len(batch)
+                self.stats["batches"] += 1
+        except requests.RequestException as error:
+            # Monitoring is best effort: log and go on with the next batch
+            with self.stats_lock:
+                self.stats["failed"] += len(batch)
+            logging.error(
+                "Error sending %s records to %s: %s", len(batch), self.url, error
+            )
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def run(self):
+
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self.next_batch()
+            if batch:
+                self.send(batch)
+
+    def start(self):
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="evidently-forwarder", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until all queued records are sent (or failed)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout: Optional[float] = None):
+
+        # The worker sends the remaining records before exiting
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
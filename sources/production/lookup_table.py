@@ -0,0 +1,150 @@
+"""
+Precompiled lookup table inference for models whose features are all categorical.
+
+The production model only uses pickup_community_area and dropoff_community_area,
+so every possible prediction can be computed once (over the cross product of the
+categories) and stored as a dense matrix. Serving is then plain array indexing,
+without sklearn or mlflow in the prediction path.
+
+Classes:
+
+    LookupTableModel
+
+Functions:
+
+    build_lookup_table(model, categories, features)
+    save_lookup_table(path, table, categories, features, metadata)
+    load_lookup_table(path, mmap)
+    export_lookup_table(model, path, categories, features, metadata)
+    check_parity(model, lookup_model, features)
+
+"""
+
+import os
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Community areas go from 1 to 77. Nans are filled with -1 by the Preprocessor
+COMMUNITY_AREAS = ["-1"] + [str(area) for area in range(1, 78)]
+FEATURES = ["pickup_community_area", "dropoff_community_area"]
+TABLE_FILE = "table.npy"
+METADATA_FILE = "metadata.json"
+
+
+class LookupTableModel:
+    # ModelService passes column arrays instead of building a DataFrame
+    accepts_columns = True
+
+    def __init__(
+        self,
+        table: np.ndarray,
+        categories: List[List[str]],
+        features: List[str],
+        version: Optional[str] = None,
+    ):
+
+        if table.shape != tuple(len(values) for values in categories):
+            raise ValueError(
+                f"Table shape {table.shape} does not match the categories "
+                f"{[len(values) for values in categories]}"
+            )
+        self.table = table
+        self.features = features
+        # pd.Index.get_indexer is a vectorized hash lookup
+        self.categories = [pd.Index(values) for values in categories]
+        self.version = version
+
+    def codes(self, values, axis: int) -> np.ndarray:
+
+        values = np.ravel(np.asarray(values, dtype=object))
+        codes = self.categories[axis].get_indexer(values)
+        if (codes < 0).any():
+            # Values sent as numbers instead of strings
+            values = values.astype(str)
+            codes = self.categories[axis].get_indexer(values)
+        if (codes < 0).any():
+            unknown = sorted(set(values[codes < 0]))
+            raise ValueError(f"Unknown values for {self.features[axis]}: {unknown}")
+        return codes
+
+    def predict(self, features: Dict[str, np.ndarray]) -> np.ndarray:
+
+        index = tuple(
+            self.codes(features[feature], axis)
+            for axis, feature in enumerate(self.features)
+        )
+        return np.asarray(self.table[index])
+
+
+def build_lookup_table(
+    model, categories: List[List[str]], features: List[str] = FEATURES
+) -> np.ndarray:
+
+    # One call to the model over the full cross product of the categories
+    grid = np.meshgrid(
+        *[np.asarray(values, dtype=object) for values in categories], indexing="ij"
+    )
+    cross_product = pd.DataFrame(
+        {feature: values.ravel() for feature, values in zip(features, grid)}
+    )
+    predictions = np.asarray(model.predict(cross_product), dtype=float)
+    return predictions.reshape(tuple(len(values) for values in categories))
+
+
+def save_lookup_table(
+    path: str,
+    table: np.ndarray,
+    categories: List[List[str]],
+    features: List[str] = FEATURES,
+    metadata: Optional[dict] = None,
+) -> str:
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, TABLE_FILE), table)
+    with open(os.path.join(path, METADATA_FILE), "w") as f_out:
+        json.dump(
+            {"features": features, "categories": categories, **(metadata or {})},
+            f_out,
+            indent=2,
+        )
+    return path
+
+
+def load_lookup_table(path: str, mmap: bool = True) -> LookupTableModel:
+
+    with open(os.path.join(path, METADATA_FILE)) as f_in:
+        metadata = json.load(f_in)
+    table = np.load(os.path.join(path, TABLE_FILE), mmap_mode="r" if mmap else None)
+    return LookupTableModel(
+        table,
+        metadata["categories"],
+        metadata["features"],
+        version=metadata.get("version"),
+    )
+
+
+def export_lookup_table(
+    model,
+    path: str,
+    categories: Optional[List[List[str]]] = None,
+    features: List[str] = FEATURES,
+    metadata: Optional[dict] = None,
+) -> LookupTableModel:
+
+    categories = categories or [COMMUNITY_AREAS for _ in features]
+    table = build_lookup_table(model, categories, features)
+    save_lookup_table(path, table, categories, features, metadata)
+    return load_lookup_table(path)
+
+
+def check_parity(model, lookup_model: LookupTableModel, features: pd.DataFrame):
+
+    # Max absolute difference between the model and the lookup table predictions
+    expected = np.ravel(model.predict(features))
+    actual = lookup_model.predict(
+        {feature: features[feature].values for feature in lookup_model.features}
+    )
+    return float(np.max(np.abs(expected - actual))) if len(expected) else 0.0
@@ -0,0 +1,211 @@
+"""
+Hot model swap for ModelService.
+
+A background thread polls the model registry for the version in a given stage.
+When a new version appears, it is loaded in the background thread and swapped
+into the ModelService with ModelService.set_model, so that requests never wait
+for the load and requests in flight keep the previous model. After each poll,
+the stats (version, polls, swaps, errors) are passed to the metric sinks of
+production/stage_timer.py.
+
+Classes:
+
+    MlflowRegistry
+    FileRegistry
+    ModelRefresher
+
+Functions:
+
+    init_model_registry(registry, name, stage)
+
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from typing import Callable, List, Optional
+
+from production.model_service import (
+    ModelService,
+    load_model_mlflow,
+    load_model_snapshot,
+)
+
+
+class MlflowRegistry:
+    # models:/{name}/{stage} in the MLflow model registry
+    def __init__(self, tracking_uri: str, snapshot_dir: Optional[str] = None):
+
+        # Imported when used, as in model_service
+        # pylint: disable=import-outside-toplevel
+        from mlflow import set_tracking_uri
+        from mlflow.tracking import MlflowClient
+
+        # models:/ uris are resolved against the default tracking uri
+        set_tracking_uri(tracking_uri)
+        self.client = MlflowClient(tracking_uri)
+        self.snapshot_dir = snapshot_dir
+
+    def latest_version(self, name: str, stage: str) -> Optional[str]:
+
+        versions = self.client.get_latest_versions(name, stages=[stage])
+        return str(versions[0].version) if versions else None
+
+    def load(self, name: str, version: str):
+
+        run_id = self.client.get_model_version(name, version).run_id
+        return load_model_mlflow(name, version, run_id, self.snapshot_dir)
+
+
+class FileRegistry:
+    """
+    Local stand-in of the MLflow model registry, for tests and local runs.
+
+    Layout:
+        <root>/<name>/stages.json     {"Staging": "2", "Production": "1"}
+        <root>/<name>/<version>/      model, loaded with `loader`
+
+    By default the versions are mlflow model directories.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        loader: Optional[Callable[[str], object]] = None,
+        snapshot_dir: Optional[str] = None,
+    ):
+
+        self.root = root
+        self.loader = loader
+        self.snapshot_dir = snapshot_dir
+
+    def stages_path(self, name: str) -> str:
+        return os.path.join(self.root, name, "stages.json")
+
+    def latest_version(self, name: str, stage: str) -> Optional[str]:
+
+        if not os.path.exists(self.stages_path(name)):
+            return None
+        with open(self.stages_path(name)) as f_in:
+            return json.load(f_in).get(stage)
+
+    def load(self, name: str, version: str):
+
+        location = os.path.join(self.root, name, str(version))
+        if self.loader is not None:
+            return self.loader(location), {"version": str(version)}
+        model, snapshot = load_model_snapshot(
+            location, f"{name}-v{version}", self.snapshot_dir
+        )
+        return model, {"version": str(version), "snapshot": snapshot}
+
+    def transition(self, name: str, version: str, stage: str):
+
+        stages = {}
+        if os.path.exists(self.stages_path(name)):
+            with open(self.stages_path(name)) as f_in:
+                stages = json.load(f_in)
+        stages[stage] = str(version)
+        os.makedirs(os.path.dirname(self.stages_path(name)), exist_ok=True)
+        # Write and rename, so that the poller never reads half a file
+        temp_path = f"{self.stages_path(name)}.tmp"
+        with open(temp_path, "w") as f_out:
+            json.dump(stages, f_out)
+        os.replace(temp_path, self.stages_path(name))
+
+
+def init_model_registry(registry, name: str, stage: str = "Staging") -> ModelService:
+
+    version = registry.latest_version(name, stage)
+    if version is None:
+        raise ValueError(f"No version of model {name} in stage {stage}")
+    model, metadata = registry.load(name, version)
+    return ModelService(model, metadata=metadata)
+
+
+class ModelRefresher:
+    def __init__(
+        self,
+        model_service: ModelService,
+        registry,
+        name: str,
+        stage: str = "Staging",
+        interval_sec: float = 60,
+        sinks: List = None,
+    ):
+
+        self.model_service = model_service
+        self.registry = registry
+        self.name = name
+        self.stage = stage
+        self.interval_sec = interval_sec
+        # Objects with record_model(stats), e.g. StageTimer.sinks
+        self.sinks = sinks or []
+        self.stats = {
+            "version": model_service.version,
+            "polls": 0,
+            "swaps": 0,
+            "errors": 0,
+            "last_swap_time": None,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> bool:
+        """
+        Checks the registry once. Loads and swaps the model if there is a new
+        version in the stage. Returns True if the model was swapped.
+        """
+        self.stats["polls"] += 1
+        version = self.registry.latest_version(self.name, self.stage)
+        if version is None or version == self.model_service.version:
+            return False
+
+        started = time.perf_counter()
+        model, metadata = self.registry.load(self.name, version)
+        self.model_service.set_model(model, metadata)
+
+        self.stats["version"] = version
+        self.stats["swaps"] += 1
+        self.stats["last_swap_time"] = time.time()
+        logging.info(
+            "Model %s swapped to version %s (%s) in %.3f s",
+            self.name,
+            version,
+            self.stage,
+            time.perf_counter() - started,
+        )
+        return True
+
+    def poll(self):
+
+        try:
+            self.refresh()
+        except Exception as error:  # pylint: disable=broad-except
+            # Keep serving the current model. Retry in the next poll
+            self.stats["errors"] += 1
+            logging.error("Model refresh failed: %s", error)
+        for sink in self.sinks:
+            sink.record_model(self.stats)
+
+    def run(self):
+
+        while not self._stop.wait(self.interval_sec):
+            self.poll()
+
+    def start(self):
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="model-refresher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,387 @@
+"""
+Long running HTTP server of the prediction model, an alternative to the Lambda
+entry point for ECS or EC2.
+
+The server is run by gunicorn. The model is loaded once by the master process
+(preload_app) and the worker processes are forked from it, so they share the
+memory pages of the model (copy-on-write). Objects loaded before the fork are
+moved out of the garbage collector (gc.freeze), so that its passes do not write
+to, and copy, those pages. Each worker serves keep-alive connections with a pool
+of threads (gthread workers).
+
+Single records posted to /predict by the threads of a worker are grouped by a
+MicroBatcher: the records queued within MICRO_BATCH_WAIT_MS of the first one (up
+to MICRO_BATCH_SIZE) are predicted with one call to the model, through the
+column oriented path of ModelService. If that call fails, the records are
+predicted one at a time, so that a bad record only fails its own request. Bad
+records (missing features, unknown categories) get a 400 response. The records of
+requests that timed out before their batch was taken are not predicted.
+
+Routes:
+
+    POST /predict: a record, as the Lambda entry point. Lists of records are
+        predicted in one call
+    POST /predict/batch: columnar batch, list of records or JSON lines body
+    GET /health: model version
+    GET /metrics: Prometheus metrics (STAGE_TIMING=prometheus): stage timings,
+        model version and model refresher counters. With several workers, set
+        PROMETHEUS_MULTIPROC_DIR to an empty directory, so that the metrics of
+        all the workers are served
+
+Background threads (evidently forwarder, model refresher, micro-batcher) do not
+survive a fork: they are started in each worker by post_fork. Note that with a
+model refresher, each worker loads the new versions on its own.
+
+Classes:
+
+    MicroBatcher
+    ModelServer
+
+Functions:
+
+    create_app(service, batcher, stage_timer, on_prediction)
+    load_app()
+    post_fork(server, worker)
+    child_exit(server, worker)
+
+python -m production.model_server
+"""
+
+import gc
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from typing import List, Optional
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import flask
+import numpy as np
+import prometheus_client
+from prometheus_client import multiprocess
+from gunicorn.app.base import BaseApplication
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+from production import chicago_taxi_prediction as prediction_module
+from production.model_service import (
+    ModelService,
+    is_columnar,
+    json_lines_columns,
+    records_to_columns,
+)
+from production.stage_timer import StageTimer
+
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(os.cpu_count() or 1)))
+# Threads per worker, i.e. concurrent requests (and keep-alive connections in use)
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))
+# Idle keep-alive connections are closed after this time. It must be longer than
+# the idle timeout of the load balancer (60 s by default for the ALB)
+SERVER_KEEPALIVE_SEC = int(os.getenv("SERVER_KEEPALIVE_SEC", "75"))
+# 0 disables micro-batching: each record is predicted by its request thread
+MICRO_BATCH_SIZE = int(os.getenv("MICRO_BATCH_SIZE", "64"))
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "1"))
+REQUEST_TIMEOUT_SEC = 30
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        service: ModelService,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 1.0,
+        stage_timer: Optional[StageTimer] = None,
+    ):
+
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_ms / 1000
+        self.stage_timer = stage_timer or StageTimer()
+        self.queue = queue.Queue()
+        self.stats = {
+            "records": 0,
+            "batches": 0,
+            "fallbacks": 0,
+            "errors": 0,
+            "cancelled": 0,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, record: dict) -> Future:
+
+        future = Future()
+        self.queue.put((record, future))
+        return future
+
+    def predict(self, record: dict, timeout: Optional[float] = None) -> dict:
+        """Record with its prediction, as ModelService.lambda_handler"""
+        future = self.submit(record)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            # Skipped by run if its batch was not taken yet
+            future.cancel()
+            raise
+
+    def next_batch(self) -> list:
+
+        # Waits for the first record, then for the others until the batch is full
+        # or max_wait_ms have passed
+        try:
+            batch = [self.queue.get(timeout=0.05)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait_sec
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=delay))
+                except queue.Empty:
+                    break
+        return batch
+
+    def predict_records(self, records: List[dict]) -> List[dict]:
+
+        # Read once, so that all the records of the batch get the same version
+        model, metadata = self.service.loaded
+        timings = self.stage_timer.request()
+        with timings.stage("dataframe"):
+            columns = records_to_columns(records, self.service.features)
+        predictions = self.service.predict_batch(columns, model, timings)
+        timings.finish()
+        results = []
+        for record, value in zip(records, predictions):
+            result = {**record, "prediction": float(value)}
+            if metadata.get("version") is not None:
+                result["model_version"] = metadata["version"]
+            results.append(result)
+        return results
+
+    def run(self):
+
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self.next_batch()
+            # The requests that timed out are gone: their records are dropped.
+            # The others can no longer be cancelled
+            pending = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            self.stats["cancelled"] += len(batch) - len(pending)
+            if not pending:
+                continue
+            records, futures = zip(*pending)
+            try:
+                results = self.predict_records(list(records))
+            except Exception:  # pylint: disable=broad-except
+                # E.g. a category unknown to the model: the records are predicted
+                # one at a time, so that only the bad ones fail
+                self.predict_one_by_one(records, futures)
+                continue
+            self.stats["records"] += len(records)
+            self.stats["batches"] += 1
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def predict_one_by_one(self, records: List[dict], futures: List[Future]):
+
+        self.stats["fallbacks"] += 1
+        for record, future in zip(records, futures):
+            try:
+                future.set_result(self.predict_records([record])[0])
+                self.stats["records"] += 1
+            except Exception as error:  # pylint: disable=broad-except
+                # Raised by the request of the record
+                self.stats["errors"] += 1
+                future.set_exception(error)
+
+    def start(self):
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="micro-batcher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+
+        # The queued records are predicted before exiting
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+def metrics_app():
+
+    # With several worker processes, the metrics are written to files in
+    # PROMETHEUS_MULTIPROC_DIR and collected from all of them at each scrape
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.make_wsgi_app(registry)
+    return prometheus_client.make_wsgi_app()
+
+
+def create_app(
+    service: ModelService,
+    batcher: Optional[MicroBatcher] = None,
+    stage_timer: Optional[StageTimer] = None,
+    on_prediction=None,
+):
+    """
+    WSGI app serving the model. on_prediction(input_data, prediction) is called
+    after each prediction, e.g. send_to_evidently_service
+    """
+    app = flask.Flask(__name__)
+    stage_timer = stage_timer or StageTimer()
+
+    def predict_input(input_data, timings):
+
+        # Bad input (a missing feature, an unknown category...) is an error of
+        # the request, not of the server
+        try:
+            if batcher is not None and isinstance(input_data, dict):
+                if not is_columnar(input_data):
+                    return batcher.predict(input_data, REQUEST_TIMEOUT_SEC)
+            return service.lambda_handler(input_data, timings)
+        except (ValueError, KeyError) as error:
+            return flask.abort(400, f"{type(error).__name__}: {error}")
+
+    def respond(input_data, prediction, timings):
+
+        if on_prediction is not None:
+            on_prediction(input_data, prediction)
+        with timings.stage("encode"):
+            body = json.dumps(prediction)
+        timings.finish()
+        return flask.Response(body, mimetype="application/json")
+
+    @app.route("/predict", methods=["POST"])
+    def predict():
+
+        timings = stage_timer.request()
+        with timings.stage("decode"):
+            input_data = flask.request.get_json(force=True)
+        return respond(input_data, predict_input(input_data, timings), timings)
+
+    @app.route("/predict/batch", methods=["POST"])
+    def predict_batch():
+
+        timings = stage_timer.request()
+        if flask.request.mimetype in prediction_module.JSON_LINES_CONTENT_TYPES:
+            # Decoded once, for the model and on_prediction
+            input_data = json_lines_columns(
+                flask.request.get_data(as_text=True), service.features, timings
+            )
+        else:
+            with timings.stage("decode"):
+                input_data = flask.request.get_json(force=True)
+        if not isinstance(input_data, list) and not is_columnar(input_data):
+            flask.abort(400, "Expected a list of records, columns or JSON lines")
+        return respond(input_data, predict_input(input_data, timings), timings)
+
+    @app.route("/health")
+    def health():
+        return {"status": "ok", "model_version": service.version}
+
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {"/metrics": metrics_app()})
+    # Started in each worker process, see post_fork
+    app.config["batcher"] = batcher
+    return app
+
+
+def load_app():
+
+    # Runs in the gunicorn master, before the workers are forked
+    service = prediction_module.get_model()
+    print(json.dumps({"model_load": prediction_module.TIMINGS}), flush=True)
+    # The threads of the master would not run in the workers
+    if prediction_module.refresher is not None:
+        prediction_module.refresher.stop()
+    if prediction_module.forwarder is not None:
+        prediction_module.forwarder.stop()
+
+    batcher = None
+    if MICRO_BATCH_SIZE > 0:
+        batcher = MicroBatcher(
+            service,
+            max_batch_size=MICRO_BATCH_SIZE,
+            max_wait_ms=MICRO_BATCH_WAIT_MS,
+            stage_timer=prediction_module.stage_timer,
+        )
+    app = create_app(
+        service,
+        batcher,
+        prediction_module.stage_timer,
+        # Looks up the forwarder of the worker at each call
+        on_prediction=prediction_module.send_to_evidently_service,
+    )
+    # The model and the app are shared by the workers: the garbage collector
+    # ignores them, so that it does not write to their pages
+    gc.collect()
+    gc.freeze()
+    return app
+
+
+def post_fork(server, worker):
+    # pylint: disable=unused-argument
+
+    prediction_module.forwarder = prediction_module.start_forwarder()
+    # Recorded by the workers only: the master does not serve the model
+    prediction_module.stage_timer.record_model(
+        {"version": prediction_module.model.version}
+    )
+    if prediction_module.MODEL_REFRESH_INTERVAL_SEC > 0:
+        prediction_module.refresher = prediction_module.start_refresher(
+            prediction_module.model
+        )
+    batcher = worker.app.wsgi().config["batcher"]
+    if batcher is not None:
+        batcher.start()
+
+
+def child_exit(server, worker):
+    # pylint: disable=unused-argument
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
+
+
+class ModelServer(BaseApplication):
+    # pylint: disable=abstract-method
+
+    def __init__(self, options: dict = None):
+
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return load_app()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    ModelServer(
+        {
+            "bind": f"0.0.0.0:{SERVER_PORT}",
+            "workers": SERVER_WORKERS,
+            "worker_class": "gthread",
+            "threads": SERVER_THREADS,
+            "keepalive": SERVER_KEEPALIVE_SEC,
+            "preload_app": True,
+            "post_fork": post_fork,
+            "child_exit": child_exit,
+        }
+    ).run()
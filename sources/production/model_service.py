@@ -1,39 +1,107 @@
-from typing import List, Union
+import os
+import json
+from typing import Dict, List, Tuple, Union, Optional
 
-from mlflow import set_tracking_uri
-from mlflow.pyfunc import load_model
+import joblib
 import numpy as np
 import pandas as pd
 
+from production.lookup_table import load_lookup_table
+from production.stage_timer import NULL_TIMINGS
+
+# Features used by the production model. Column oriented (batch) payloads must
+# contain one list per feature, plus an optional list of ids.
+FEATURES = ["pickup_community_area", "dropoff_community_area"]
+ID_COLUMN = "trip_id"
+
 
 class DummyModel:
     def __init__(self, version: str = "1.0"):
         self.version = version
 
-    def predict(self, features: dict):
+    def predict(self, features: Union[dict, pd.DataFrame]) -> np.ndarray:
+
+        # Vectorized, so that it works both for one-row frames and column batches
+        # Missing values (None) yield a prediction of 0
+        pickup = pd.to_numeric(
+            np.ravel(features["pickup_community_area"]), errors="coerce"
+        )
+        dropoff = pd.to_numeric(
+            np.ravel(features["dropoff_community_area"]), errors="coerce"
+        )
+
+        return np.nan_to_num(pickup + dropoff, nan=0.0).astype(float)
+
+
+def parse_json_lines(body: str) -> List[dict]:
+
+    # One JSON record per line. Empty lines are ignored.
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def is_columnar(input_data, features: List[str] = FEATURES) -> bool:
+
+    # {"pickup_community_area": [...], "dropoff_community_area": [...]}, lists or
+    # arrays (decoded JSON lines, see json_lines_columns)
+    return isinstance(input_data, dict) and all(
+        isinstance(input_data.get(column), (list, np.ndarray)) for column in features
+    )
+
+
+def records_to_columns(
+    records: List[dict], columns: List[str]
+) -> Dict[str, np.ndarray]:
 
-        if (
-            features["pickup_community_area"] is not None
-            and features["dropoff_community_area"] is not None
-        ):
+    # Single pass per column over the records. Avoids the per row
+    # overhead of pd.DataFrame(records).
+    return {
+        column: np.array([record.get(column) for record in records], dtype=object)
+        for column in columns
+    }
 
-            prediction = int(features["pickup_community_area"]) + int(
-                features["dropoff_community_area"]
-            )
 
-        else:
-            prediction = 0
+def json_lines_columns(
+    body: str, features: List[str] = FEATURES, timings=NULL_TIMINGS
+) -> Dict[str, np.ndarray]:
 
-        return float(prediction)
+    # Decoded once by the entry points, so that the model and the monitoring
+    # records use the same columns
+    with timings.stage("decode"):
+        records = parse_json_lines(body)
+    columns = features
+    if records and ID_COLUMN in records[0]:
+        columns = columns + [ID_COLUMN]
+    with timings.stage("dataframe"):
+        return records_to_columns(records, columns)
 
 
 class ModelService:
     # Class that manages the model and processes prediction requests
 
-    def __init__(self, model, callbacks: List = None):
+    def __init__(
+        self,
+        model,
+        callbacks: List = None,
+        features: List[str] = None,
+        metadata: dict = None,
+    ):
 
-        self.model = model
         self.callbacks = callbacks or []
+        self.features = features or FEATURES
+        # The model and where it comes from (version, run_id, snapshot status...)
+        self.loaded = (model, metadata or {})
+
+    @property
+    def model(self):
+        return self.loaded[0]
+
+    @property
+    def metadata(self) -> dict:
+        return self.loaded[1]
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.metadata.get("version")
 
     def preprocess_features(self, data: dict):
 
@@ -44,34 +112,135 @@ class ModelService:
         # Fill Nans with -1
         return data
 
-    def predict(self, features: pd.DataFrame):
+    def predict(self, features: pd.DataFrame, model=None, timings=NULL_TIMINGS):
 
-        pred = self.model.predict(features)
-        for callback in self.callbacks:
-            callback(pred)
+        with timings.stage("predict"):
+            pred = (model or self.model).predict(features)
+        with timings.stage("callbacks"):
+            for callback in self.callbacks:
+                callback(pred)
         return pred
 
-    def set_model(self, model):
-        self.model = model
-
-    def lambda_handler(self, input_data: Union[List[dict], dict]) -> dict:
-        print(input_data)
-        print(type(input_data))
+    def predict_batch(
+        self, columns: Dict[str, np.ndarray], model=None, timings=NULL_TIMINGS
+    ) -> np.ndarray:
+
+        # Column oriented fast path: the frame is built from one array per feature
+        # (no per row work) and the model is called once for the whole batch
+        model = model or self.model
+        with timings.stage("dataframe"):
+            features = {
+                column: np.asarray(columns[column], dtype=object)
+                for column in self.features
+            }
+            if len(features[self.features[0]]) == 0:
+                return np.empty(0, dtype=float)
+            if not getattr(model, "accepts_columns", False):
+                features = pd.DataFrame(features, copy=False)
+        return np.ravel(self.predict(features, model, timings))
+
+    def records_features(self, records: List[dict], model=None, timings=NULL_TIMINGS):
+
+        # Models that accept column arrays (e.g. lookup tables) skip the DataFrame
+        with timings.stage("dataframe"):
+            if getattr(model or self.model, "accepts_columns", False):
+                return records_to_columns(records, self.features)
+            return pd.DataFrame(records)
+
+    def batch_handler(
+        self, columns: Dict[str, np.ndarray], loaded=None, timings=NULL_TIMINGS
+    ) -> dict:
+
+        # Predictions are returned in the same order as the input, so they are
+        # aligned with the trip_id list (if it was provided)
+        model, metadata = loaded or self.loaded
+        predictions = self.predict_batch(columns, model, timings)
+        result = {}
+        if columns.get(ID_COLUMN) is not None:
+            result[ID_COLUMN] = np.asarray(columns[ID_COLUMN], dtype=object).tolist()
+        result["prediction"] = predictions.tolist()
+        if metadata.get("version") is not None:
+            result["model_version"] = metadata["version"]
+        return result
+
+    def set_model(self, model, metadata: dict = None):
+
+        # Model and metadata are swapped with a single assignment. Requests in
+        # flight keep the model (and version) they started with
+        self.loaded = (model, metadata or {})
+
+    def lambda_handler(
+        self, input_data: Union[List[dict], dict, str], timings=NULL_TIMINGS
+    ) -> Union[List[float], dict]:
+
+        # Read once, so that a model swap does not affect this request
+        loaded = self.loaded
+        model, metadata = loaded
+
+        # JSON lines body: one record per line
+        if isinstance(input_data, str):
+            columns = json_lines_columns(input_data, self.features, timings)
+            return self.batch_handler(columns, loaded, timings)
+
+        # Column oriented batch: {"pickup_community_area": [...], ...}
+        if is_columnar(input_data, self.features):
+            return self.batch_handler(input_data, loaded, timings)
+
+        # List of records: returns the list of predictions
+        if isinstance(input_data, list):
+            features = self.records_features(input_data, model, timings)
+            return np.ravel(self.predict(features, model, timings)).tolist()
+
+        # Single record: returns the record with its prediction
         prediction = input_data.copy()
-        if isinstance(prediction, List):
-            pred_value = self.predict(pd.DataFrame(input_data))
-        else:
-            pred_value = self.predict(pd.DataFrame([input_data])).ravel()
-        # print(pred_value, ' ' , type(pred_value))
-        if isinstance(pred_value, np.ndarray):
-            prediction = pred_value.tolist()
-        else:
-            prediction["prediction"] = pred_value
+        features = self.records_features([input_data], model, timings)
+        pred_value = np.ravel(self.predict(features, model, timings))
+        prediction["prediction"] = float(pred_value[0])
+        if metadata.get("version") is not None:
+            prediction["model_version"] = metadata["version"]
         return prediction
 
 
+def load_model(model_uri: str, suppress_warnings: bool = False):
+
+    # mlflow is only imported to load mlflow models: serving a lookup table (or
+    # the dummy model) does not pay for its import on cold starts
+    # pylint: disable=import-outside-toplevel
+    from mlflow.pyfunc import load_model as mlflow_load_model
+
+    return mlflow_load_model(model_uri, suppress_warnings)
+
+
+def load_model_snapshot(
+    model_uri: str, key: str, snapshot_dir: Optional[str] = None
+) -> Tuple[object, str]:
+
+    # Keeps a local copy of the deserialized model, keyed by run_id or registry
+    # version, so that next cold starts do not go through mlflow's load_model.
+    # Returns the model and the snapshot status: hit, miss or disabled
+    if not snapshot_dir:
+        return load_model(model_uri, False), "disabled"
+
+    snapshot_path = os.path.join(snapshot_dir, f"{key}.joblib")
+    if os.path.exists(snapshot_path):
+        # numpy arrays of the model (e.g. trees of GBRegressor) are memory-mapped
+        return joblib.load(snapshot_path, mmap_mode="r"), "hit"
+
+    model = load_model(model_uri, False)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # Write and rename, so that a concurrent cold start never reads half a file
+    temp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    joblib.dump(model, temp_path)
+    os.replace(temp_path, snapshot_path)
+    return model, "miss"
+
+
 def get_model_s3(
-    s3_bucket_name: str, s3_bucket_folder: str, experiment_id: str, run_id: str
+    s3_bucket_name: str,
+    s3_bucket_folder: str,
+    experiment_id: str,
+    run_id: str,
+    snapshot_dir: Optional[str] = None,
 ):
 
     model_location = (
@@ -79,23 +248,45 @@ def get_model_s3(
         f"{experiment_id}/{run_id}/artifacts/model"
     )
 
-    model = load_model(model_location)
-
-    return model
+    return load_model_snapshot(model_location, f"run-{run_id}", snapshot_dir)
 
 
 def init_model_s3(
-    s3_bucket_name: str, s3_bucket_folder: str, experiment_id: str, run_id: str
+    s3_bucket_name: str,
+    s3_bucket_folder: str,
+    experiment_id: str,
+    run_id: str,
+    snapshot_dir: Optional[str] = None,
 ):
 
-    model = get_model_s3(s3_bucket_name, s3_bucket_folder, experiment_id, run_id)
-    return ModelService(model)
+    model, snapshot = get_model_s3(
+        s3_bucket_name, s3_bucket_folder, experiment_id, run_id, snapshot_dir
+    )
+    return ModelService(model, metadata={"run_id": run_id, "snapshot": snapshot})
+
+
+def init_model_local(model_location: str, snapshot_dir: Optional[str] = None):
 
+    # pylint: disable=import-outside-toplevel
+    from mlflow.models import Model
 
-def init_model_local(model_location: str):
+    # The MLmodel file identifies the model without deserializing it
+    model_info = Model.load(os.path.join(model_location, "MLmodel"))
+    key = f"run-{model_info.run_id}" if model_info.run_id else model_info.model_uuid
+    if not key:
+        # No stable key (models saved without run_id nor model_uuid): a snapshot
+        # could be loaded for another model
+        snapshot_dir = None
+    model, snapshot = load_model_snapshot(model_location, key, snapshot_dir)
+    return ModelService(
+        model, metadata={"run_id": model_info.run_id, "snapshot": snapshot}
+    )
+
+
+def init_model_lookup_table(table_location: str):
 
-    model = load_model(model_location)
-    return ModelService(model)
+    lookup_model = load_lookup_table(table_location)
+    return ModelService(lookup_model, metadata={"version": lookup_model.version})
 
 
 def init_dummy_model():
@@ -103,8 +294,37 @@ def init_dummy_model():
     return ModelService(DummyModel())
 
 
-def init_model_mlflow(tracking_uri: str, name: str, stage: str = "Staging"):
+def load_model_mlflow(
+    name: str,
+    version: str,
+    run_id: Optional[str] = None,
+    snapshot_dir: Optional[str] = None,
+) -> Tuple[object, dict]:
+
+    model, snapshot = load_model_snapshot(
+        f"models:/{name}/{version}", f"{name}-v{version}", snapshot_dir
+    )
+    return model, {"version": str(version), "run_id": run_id, "snapshot": snapshot}
+
+
+def init_model_mlflow(
+    tracking_uri: str,
+    name: str,
+    stage: str = "Staging",
+    snapshot_dir: Optional[str] = None,
+):
+
+    # pylint: disable=import-outside-toplevel
+    from mlflow import set_tracking_uri
+    from mlflow.tracking import MlflowClient
 
     set_tracking_uri(tracking_uri)
-    model = load_model(f"models:/{name}/{stage}", False)
-    return ModelService(model)
+    # Resolve the stage to a version, so the snapshot key is stable. Loading by
+    # version also avoids a race with a stage transition during the load
+    model_version = MlflowClient(tracking_uri).get_latest_versions(
+        name, stages=[stage]
+    )[0]
+    model, metadata = load_model_mlflow(
+        name, model_version.version, model_version.run_id, snapshot_dir
+    )
+    return ModelService(model, metadata=metadata)
@@ -0,0 +1,271 @@
+"""
+Sampled per-stage timing of the prediction requests.
+
+A request is timed with probability sample_rate: its stages (JSON decode,
+DataFrame construction, model.predict, callbacks, JSON encode) are measured with
+perf_counter, and the durations are passed to the sinks when the request is
+finished. Requests that are not sampled, or all of them when timing is disabled,
+get NULL_TIMINGS, whose stages are a shared no-op context manager.
+
+The sinks also export the version of the model being served and the counters of
+the model refresher (registry polls, swaps and errors), passed to
+StageTimer.record_model when the model starts serving (first Lambda request,
+model server worker) and after each poll of the refresher. These are not
+sampled.
+
+Sinks:
+
+- PrometheusSink: one histogram, labelled by stage, for long running servers.
+  The model version is a gauge labelled by version, and the refresher counters
+  are counters.
+- EmfSink: one CloudWatch Embedded Metric Format line per request, written to
+  stdout, for Lambda (CloudWatch extracts the metrics from the logs). The model
+  version and the counter increments go out as one more line.
+
+Classes:
+
+    NullTimings
+    RequestTimings
+    StageTimer
+    PrometheusSink
+    EmfSink
+
+Functions:
+
+    counter_increments(previous: dict, stats: dict)
+    init_stage_timer(mode: str, sample_rate: float, namespace: str, service: str)
+
+"""
+
+import sys
+import json
+import time
+import random
+from typing import Dict, List
+from contextlib import contextmanager, nullcontext
+
+# Prometheus buckets, in seconds: a dummy model predicts in microseconds, and a
+# large batch on a sklearn pipeline in hundreds of milliseconds
+HISTOGRAM_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+# Counters of ModelRefresher.stats, with their description
+MODEL_COUNTERS = {
+    "polls": "Polls of the model registry",
+    "swaps": "New model versions swapped in",
+    "errors": "Failed registry polls or model loads",
+}
+
+
+def counter_increments(previous: dict, stats: dict) -> Dict[str, int]:
+
+    # The refresher stats are totals: the sinks export the increments since the
+    # stats they recorded last
+    return {name: stats.get(name, 0) - previous.get(name, 0) for name in MODEL_COUNTERS}
+
+
+class NullTimings:
+    # Timings of the requests that are not sampled: nothing is measured
+    sampled = False
+    _stage = nullcontext()
+
+    def stage(self, name: str):
+        # pylint: disable=unused-argument
+        return self._stage
+
+    def finish(self):
+        pass
+
+
+NULL_TIMINGS = NullTimings()
+
+
+class RequestTimings:
+    sampled = True
+
+    def __init__(self, sinks: List):
+
+        self.sinks = sinks
+        # Stage: seconds. A stage entered more than once is accumulated
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name: str):
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = (
+                self.seconds.get(name, 0.0) + time.perf_counter() - started
+            )
+
+    def finish(self):
+
+        for sink in self.sinks:
+            sink.record(self.seconds)
+
+
+class StageTimer:
+    def __init__(self, sample_rate: float = 0.0, sinks: List = None):
+
+        self.sample_rate = sample_rate
+        self.sinks = sinks or []
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 and bool(self.sinks)
+
+    def request(self):
+        """Timings of a new request: RequestTimings if sampled, else NULL_TIMINGS"""
+        if not self.enabled:
+            return NULL_TIMINGS
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return NULL_TIMINGS
+        return RequestTimings(self.sinks)
+
+    def record_model(self, stats: dict):
+        """Exports the model version and the refresher counters of stats"""
+        for sink in self.sinks:
+            sink.record_model(stats)
+
+
+class PrometheusSink:
+    def __init__(self, registry=None, buckets: tuple = HISTOGRAM_BUCKETS):
+
+        # Optional dependency, only needed by the servers that export metrics
+        # pylint: disable=import-outside-toplevel
+        import prometheus_client
+
+        kwargs = {} if registry is None else {"registry": registry}
+        self.histogram = prometheus_client.Histogram(
+            "prediction_stage_seconds",
+            "Duration of the stages of the prediction requests (sampled)",
+            ["stage"],
+            buckets=buckets,
+            **kwargs,
+        )
+        # Info metrics are not supported with several worker processes: the
+        # version is the label of a gauge, 1 for the version being served and 0
+        # for the previous ones. With several processes, the label is removed
+        # from the memory of the process, but not from its metrics file
+        self.model_version = prometheus_client.Gauge(
+            "prediction_model_version_info",
+            "Version of the model being served",
+            ["version"],
+            multiprocess_mode="liveall",
+            **kwargs,
+        )
+        self.model_counters = {
+            name: prometheus_client.Counter(
+                f"model_refresh_{name}", description, **kwargs
+            )
+            for name, description in MODEL_COUNTERS.items()
+        }
+        self.model_stats = {}
+        # Label of the version set in the gauge
+        self.version = None
+
+    def record(self, seconds: Dict[str, float]):
+
+        for stage, value in seconds.items():
+            self.histogram.labels(stage).observe(value)
+
+    def record_model(self, stats: dict):
+
+        version = str(stats.get("version"))
+        if version != self.version:
+            if self.version is not None:
+                self.model_version.labels(self.version).set(0)
+            self.model_version.labels(version).set(1)
+            self.version = version
+        for name, increment in counter_increments(self.model_stats, stats).items():
+            if increment > 0:
+                self.model_counters[name].inc(increment)
+        self.model_stats = dict(stats)
+
+
+class EmfSink:
+    def __init__(
+        self,
+        namespace: str = "ChicagoTaxi",
+        service: str = "chicago-taxi-prediction",
+        stream=None,
+    ):
+
+        self.namespace = namespace
+        self.service = service
+        # None: the current sys.stdout
+        self.stream = stream
+        self.model_stats = {}
+
+    def line(self, metrics: Dict[str, float], unit: str, **properties) -> str:
+
+        return json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": self.namespace,
+                            "Dimensions": [["Service"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit} for name in metrics
+                            ],
+                        }
+                    ],
+                },
+                "Service": self.service,
+                **properties,
+                **metrics,
+            }
+        )
+
+    def record(self, seconds: Dict[str, float]):
+
+        metrics = {f"{stage}_ms": value * 1000 for stage, value in seconds.items()}
+        print(
+            self.line(metrics, "Milliseconds"),
+            file=self.stream or sys.stdout,
+            flush=True,
+        )
+
+    def record_model(self, stats: dict):
+
+        # The version is a property of the line, searchable in the logs
+        increments = counter_increments(self.model_stats, stats)
+        metrics = {f"model_refresh_{name}": value for name, value in increments.items()}
+        self.model_stats = dict(stats)
+        print(
+            self.line(metrics, "Count", ModelVersion=stats.get("version")),
+            file=self.stream or sys.stdout,
+            flush=True,
+        )
+
+
+def init_stage_timer(
+    mode: str,
+    sample_rate: float,
+    namespace: str = "ChicagoTaxi",
+    service: str = "chicago-taxi-prediction",
+) -> StageTimer:
+
+    # mode: "emf", "prometheus" or "off"
+    if mode == "emf":
+        return StageTimer(sample_rate, [EmfSink(namespace, service)])
+    if mode == "prometheus":
+        return StageTimer(sample_rate, [PrometheusSink()])
+    return StageTimer(0.0)
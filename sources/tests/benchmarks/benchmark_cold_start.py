@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+from pathlib import Path
+
+import mlflow.sklearn
+import pandas as pd
+from sklearn.compose import make_column_transformer
+from sklearn.pipeline import make_pipeline
+from sklearn.linear_model import LinearRegression
+from sklearn.preprocessing import OneHotEncoder
+
+from production.model_service import FEATURES
+from tests.benchmarks.benchmark_model_service import make_records
+
+"""
+Measures the cold start of production/chicago_taxi_prediction.py (import, model
+load and first prediction) in a new process, with and without a model snapshot.
+
+MLFLOW_MODEL_LOCATION may point to an existing local model, otherwise a small
+sklearn pipeline is saved to a temporary directory.
+
+python -m tests.benchmarks.benchmark_cold_start
+"""
+
+COLD_START_SCRIPT = """
+import json
+from production.chicago_taxi_prediction import lambda_handler
+lambda_handler(json.loads(EVENT), None)
+"""
+SOURCES_PATH = str(Path(__file__).parent / "../..")
+
+
+def save_model(location: str):
+
+    df = pd.DataFrame(make_records(5_000))[FEATURES]
+    # Same structure as development/model.py: the remaining columns are dropped
+    pipeline = make_pipeline(
+        make_column_transformer((OneHotEncoder(handle_unknown="ignore"), FEATURES)),
+        LinearRegression(),
+    )
+    pipeline.fit(df, list(range(len(df))))
+    mlflow.sklearn.save_model(pipeline, location, serialization_format="cloudpickle")
+
+
+def cold_start(model_location: str, snapshot_dir: str) -> dict:
+
+    event = {"body": json.dumps(make_records(1)[0])}
+    env = dict(
+        os.environ,
+        PYTHONPATH=SOURCES_PATH,
+        MLFLOW_MODEL_LOCATION=model_location,
+        MODEL_SNAPSHOT_DIR=snapshot_dir,
+    )
+    script = f"EVENT = {json.dumps(json.dumps(event))}\n{COLD_START_SCRIPT}"
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr)
+    output = output.stdout
+    for line in output.splitlines():
+        if line.startswith('{"cold_start"'):
+            return json.loads(line)["cold_start"]
+    raise ValueError(f"No cold start timings in the output:\n{output}")
+
+
+if __name__ == "__main__":
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_location = os.getenv("MLFLOW_MODEL_LOCATION", "")
+        if model_location == "":
+            model_location = f"{temp_dir}/model"
+            save_model(model_location)
+        snapshot_dir = f"{temp_dir}/snapshots"
+
+        print(f"{'run':<22} {'import':>8} {'load':>8} {'first pred':>11} snapshot")
+        runs = [
+            ("no snapshot", ""),
+            ("first (writes)", snapshot_dir),
+            ("next (reads)", snapshot_dir),
+        ]
+        for name, run_snapshot_dir in runs:
+            timings = cold_start(model_location, run_snapshot_dir)
+            print(
+                f"{name:<22} {timings['import_seconds']:>8.3f} "
+                f"{timings['model_load_seconds']:>8.3f} "
+                f"{timings['first_prediction_seconds']:>11.3f} {timings['snapshot']}"
+            )
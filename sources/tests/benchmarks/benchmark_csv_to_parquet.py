@@ -0,0 +1,93 @@
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+
+import pandas as pd
+
+from development.preprocessor import Preprocessor
+from tests.benchmarks.benchmark_preprocessor import make_month
+
+"""
+Peak RSS and wall time of the monthly csv to parquet conversion
+(Preprocessor.read_dataframe_csv): previous pandas implementation (read the whole
+csv, rename, write) against the pyarrow streaming converter, on a synthetic month
+of Chicago taxi trips (~600k rows). Each conversion runs in its own process.
+
+python -m tests.benchmarks.benchmark_csv_to_parquet
+"""
+
+DATE_FIELDS = ["Trip Start Timestamp", "Trip End Timestamp"]
+DTYPE = {"Pickup Community Area": str, "Dropoff Community Area": str}
+MODULE = "tests.benchmarks.benchmark_csv_to_parquet"
+
+
+def write_csv(file_path: str):
+
+    month = make_month()
+    # Column names and timestamps as in the data.cityofchicago.org csv files
+    month.columns = month.columns.str.replace("_", " ").str.title()
+    month.to_csv(file_path, index=False, date_format="%m/%d/%Y %I:%M:%S %p")
+
+
+def convert_pandas(file_path: str):
+
+    # Previous Preprocessor.read_dataframe_csv
+    df = pd.read_csv(file_path, parse_dates=DATE_FIELDS, dtype=DTYPE)
+    df.columns = df.columns.str.lower().str.replace(" ", "_")
+    df.to_parquet(file_path.replace(".csv", ".pandas.parquet"), index=None)
+
+
+def convert_streaming(file_path: str):
+    Preprocessor().read_dataframe_csv(file_path, DATE_FIELDS, DTYPE)
+
+
+def peak_rss_kb() -> int:
+
+    # ru_maxrss is inherited across exec, VmHWM is not
+    with open("/proc/self/status") as f_in:
+        for line in f_in:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(implementation: str, file_path: str):
+
+    # Peak RSS of a new process
+    result = subprocess.run(
+        [sys.executable, "-m", MODULE, implementation, file_path],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    elapsed, max_rss = result.stdout.split()
+    return float(elapsed), int(max_rss) / 1024
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 3:
+        started = time.perf_counter()
+        implementations = {
+            # Only the imports
+            "baseline": lambda file_path: None,
+            "pandas": convert_pandas,
+            "streaming": convert_streaming,
+        }
+        implementations[sys.argv[1]](sys.argv[2])
+        elapsed = time.perf_counter() - started
+        print(elapsed, peak_rss_kb())
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_path = str(Path(temp_dir) / "Taxi_Trips_2022_04.csv")
+        write_csv(csv_path)
+        print(f"csv: {Path(csv_path).stat().st_size / 2**20:.0f} MB")
+
+        print(f"{'implementation':<16} {'time (s)':>9} {'peak RSS (MB)':>14}")
+        for implementation in ["baseline", "pandas", "streaming"]:
+            elapsed, max_rss = run(implementation, csv_path)
+            print(f"{implementation:<16} {elapsed:>9.3f} {max_rss:>14.0f}")
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from contextlib import redirect_stdout
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from tests.benchmarks.benchmark_cold_start import SOURCES_PATH, save_model
+from tests.benchmarks.benchmark_model_service import make_records
+
+"""
+Load test of production/chicago_taxi_prediction.lambda_handler, per model backend
+(BENCHMARK_BACKENDS: dummy, local, mlflow), at increasing concurrency:
+
+- in-process: each backend runs in a new process, so the first request is a cold
+  start (import, model load and first prediction). The warm requests are then
+  sent by a thread pool calling lambda_handler.
+- http: requests to the local Lambda container (LAMBDA_URL), if it is running,
+  e.g. started by tests/integration_tests/run.sh. Its first request is reported as
+  the cold one only if the container was just started.
+
+Latency percentiles (p50, p95, p99) and throughput are stored as JSON in
+BENCHMARK_RESULTS_DIR (tests/benchmarks/results by default, ignored by git), one
+file per commit. If BENCHMARK_BASELINE is the file of a previous run, the
+differences are printed.
+
+The local backend uses MLFLOW_MODEL_LOCATION if set, otherwise a small sklearn
+pipeline. The mlflow backend needs the tracking server of MLFLOW_TRACKING_URI.
+
+python -m tests.benchmarks.benchmark_lambda_load
+"""
+
+BACKENDS = os.getenv("BENCHMARK_BACKENDS", "dummy,local").split(",")
+CONCURRENCY_LEVELS = [1, 2, 4, 8, 16]
+REQUESTS_PER_LEVEL = int(os.getenv("BENCHMARK_REQUESTS", "1000"))
+LAMBDA_URL = os.getenv(
+    "LAMBDA_URL", "http://localhost:8080/2015-03-31/functions/function/invocations"
+)
+RESULTS_DIR = os.getenv("BENCHMARK_RESULTS_DIR", str(Path(__file__).parent / "results"))
+PERCENTILES = [50, 95, 99]
+
+WORKER_SCRIPT = """
+from tests.benchmarks.benchmark_lambda_load import in_process_worker
+in_process_worker()
+"""
+
+
+def summary(latencies: list, seconds: float) -> dict:
+
+    values = np.percentile(np.array(latencies) * 1000, PERCENTILES)
+    result = {f"p{p}_ms": float(value) for p, value in zip(PERCENTILES, values)}
+    result["requests"] = len(latencies)
+    result["throughput_rps"] = len(latencies) / seconds
+    return result
+
+
+def make_events(n_events: int) -> list:
+
+    return [{"body": json.dumps(record)} for record in make_records(n_events)]
+
+
+def run_load(send, events: list, concurrency: int) -> dict:
+    """Sends the events with concurrency threads. send(event) does one request"""
+    latencies = []
+    lock = threading.Lock()
+
+    def timed_send(event):
+        started = time.perf_counter()
+        send(event)
+        latency = time.perf_counter() - started
+        with lock:
+            latencies.append(latency)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Raises the first error
+        list(executor.map(timed_send, events))
+    return summary(latencies, time.perf_counter() - started)
+
+
+def in_process_worker():
+
+    # Runs in a new process, with the backend set by the environment
+    events = make_events(REQUESTS_PER_LEVEL)
+    started = time.perf_counter()
+    # pylint: disable=import-outside-toplevel
+    from production import chicago_taxi_prediction
+
+    # The handler may print the predictions (LOG_PREDICTIONS) and the stage timings,
+    # which are part of its cost. The output is discarded, only the result line is
+    # written to the real stdout
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        chicago_taxi_prediction.lambda_handler(events[0], None)
+        cold = {
+            "first_request_seconds": time.perf_counter() - started,
+            **chicago_taxi_prediction.TIMINGS,
+        }
+        warm = {}
+        for concurrency in CONCURRENCY_LEVELS:
+            warm[concurrency] = run_load(
+                lambda event: chicago_taxi_prediction.lambda_handler(event, None),
+                events,
+                concurrency,
+            )
+    print(json.dumps({"load": {"cold": cold, "warm": warm}}), flush=True)
+
+
+def run_in_process(backend_env: dict) -> dict:
+
+    env = dict(os.environ, PYTHONPATH=SOURCES_PATH, **backend_env)
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER_SCRIPT],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr)
+    for line in output.stdout.splitlines():
+        if line.startswith('{"load"'):
+            return json.loads(line)["load"]
+    raise ValueError(f"No load results in the output:\n{output.stdout}")
+
+
+def run_http(url: str) -> dict:
+
+    session = threading.local()
+
+    def send(event):
+        if not hasattr(session, "session"):
+            session.session = requests.Session()
+        response = session.session.post(url, json=event, timeout=30)
+        response.raise_for_status()
+
+    events = make_events(REQUESTS_PER_LEVEL)
+    try:
+        started = time.perf_counter()
+        send(events[0])
+    except requests.ConnectionError:
+        return {"skipped": f"no Lambda container at {url}"}
+    cold = {"first_request_seconds": time.perf_counter() - started}
+    warm = {
+        concurrency: run_load(send, events, concurrency)
+        for concurrency in CONCURRENCY_LEVELS
+    }
+    return {"cold": cold, "warm": warm}
+
+
+def git_commit() -> str:
+
+    output = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+        check=False,
+        cwd=SOURCES_PATH,
+    )
+    return output.stdout.strip() or "unknown"
+
+
+def backend_envs(temp_dir: str) -> dict:
+
+    envs = {}
+    for backend in BACKENDS:
+        if backend == "dummy":
+            envs[backend] = {"MLFLOW_MODEL_LOCATION": ""}
+        elif backend == "local":
+            location = os.getenv("MLFLOW_MODEL_LOCATION", "")
+            if location in ["", "s3", "mlflow", "file"]:
+                location = f"{temp_dir}/model"
+                save_model(location)
+            envs[backend] = {"MLFLOW_MODEL_LOCATION": location}
+        elif backend == "mlflow":
+            envs[backend] = {"MLFLOW_MODEL_LOCATION": "mlflow"}
+    # No snapshot: the cold start includes the model load
+    for env in envs.values():
+        env["MODEL_SNAPSHOT_DIR"] = ""
+    return envs
+
+
+def print_results(results: dict, baseline: dict = None):
+
+    print(
+        f"{'backend':<9} {'mode':<16} {'conc':>4} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'req/s':>9} {'vs baseline':>12}"
+    )
+    for backend, modes in results["backends"].items():
+        for mode, result in modes.items():
+            if "skipped" in result or "error" in result:
+                reason = result.get("skipped") or result.get("error")
+                print(f"{backend:<9} {mode:<16} {reason}")
+                continue
+            print(
+                f"{backend:<9} {mode + ' cold':<16} {1:>4} "
+                f"{result['cold']['first_request_seconds'] * 1000:>8.1f}"
+            )
+            for concurrency, warm in result["warm"].items():
+                delta = ""
+                try:
+                    base = baseline["backends"][backend][mode]["warm"][concurrency]
+                    delta = f"{(warm['p50_ms'] / base['p50_ms'] - 1) * 100:>+11.1f}%"
+                except (TypeError, KeyError):
+                    pass
+                print(
+                    f"{backend:<9} {mode + ' warm':<16} {concurrency:>4} "
+                    f"{warm['p50_ms']:>8.2f} {warm['p95_ms']:>8.2f} "
+                    f"{warm['p99_ms']:>8.2f} {warm['throughput_rps']:>9.0f} {delta}"
+                )
+
+
+if __name__ == "__main__":
+
+    # Read first, it may be the file of the same commit
+    baseline = None
+    if os.getenv("BENCHMARK_BASELINE"):
+        with open(os.environ["BENCHMARK_BASELINE"]) as f_in:
+            baseline = json.load(f_in)
+
+    results = {
+        "commit": git_commit(),
+        "datetime": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "requests_per_level": REQUESTS_PER_LEVEL,
+        "backends": {},
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, env in backend_envs(temp_dir).items():
+            print(f"Running {name}")
+            try:
+                in_process = run_in_process(env)
+            except RuntimeError as error:
+                in_process = {"error": str(error).strip().splitlines()[-1]}
+            results["backends"][name] = {"in-process": in_process}
+    # The container serves the model it was started with
+    results["backends"]["container"] = {"http": run_http(LAMBDA_URL)}
+
+    # JSON keys are strings: the concurrency levels are read back as strings
+    results = json.loads(json.dumps(results))
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f"lambda_load-{results['commit']}.json")
+    with open(results_path, "w") as f_out:
+        json.dump(results, f_out, indent=2)
+
+    print_results(results, baseline)
+    print(f"Results: {results_path}")
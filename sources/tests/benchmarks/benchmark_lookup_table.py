@@ -0,0 +1,48 @@
+import tempfile
+
+from production.lookup_table import export_lookup_table
+from production.model_service import ModelService
+from tests.benchmarks.benchmark_model_service import (
+    BATCH_SIZES,
+    best_time,
+    to_columns,
+    make_records,
+    train_linreg,
+)
+
+"""
+Compares the latency of the LinReg pipeline with the exported lookup table, both
+served through ModelService, for single records and column oriented batches.
+
+python -m tests.benchmarks.benchmark_lookup_table
+"""
+
+
+if __name__ == "__main__":
+
+    model = train_linreg()
+    with tempfile.TemporaryDirectory() as table_path:
+        pipeline_service = ModelService(model)
+        lookup_service = ModelService(export_lookup_table(model, table_path))
+
+        record = make_records(1)[0]
+        pipeline_time = best_time(lambda: pipeline_service.lambda_handler(record), 200)
+        lookup_time = best_time(lambda: lookup_service.lambda_handler(record), 200)
+        print("\nsingle record")
+        print(f"pipeline: {pipeline_time*1e6:.1f} us, lookup: {lookup_time*1e6:.1f} us")
+
+        print("\ncolumnar batch")
+        print(f"{'rows':>8} {'pipeline (ms)':>14} {'lookup (ms)':>12} {'speed-up':>9}")
+        for n_rows in BATCH_SIZES:
+            columns = to_columns(make_records(n_rows))
+            number = max(1, 1_000 // n_rows)
+            pipeline_time = best_time(
+                lambda: pipeline_service.lambda_handler(columns), number
+            )
+            lookup_time = best_time(
+                lambda: lookup_service.lambda_handler(columns), number
+            )
+            print(
+                f"{n_rows:>8} {pipeline_time*1000:>14.3f} {lookup_time*1000:>12.3f} "
+                f"{pipeline_time/lookup_time:>8.1f}x"
+            )
@@ -0,0 +1,73 @@
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from development.model import LinReg
+from production.model_service import FEATURES, DummyModel, ModelService
+
+"""
+Compares the row-dict path of ModelService.lambda_handler (list of records, one
+DataFrame built from the dicts) with the column oriented batch path.
+
+python -m tests.benchmarks.benchmark_model_service
+"""
+
+BATCH_SIZES = [1, 100, 10_000]
+CATEGORIES = ["-1"] + [str(area) for area in range(1, 78)]
+
+
+def make_records(n_rows: int, seed: int = 42):
+
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "trip_id": f"trip-{i}",
+            "pickup_community_area": str(rng.choice(CATEGORIES)),
+            "dropoff_community_area": str(rng.choice(CATEGORIES)),
+        }
+        for i in range(n_rows)
+    ]
+
+
+def to_columns(records):
+
+    return {
+        column: [record[column] for record in records]
+        for column in ["trip_id"] + FEATURES
+    }
+
+
+def train_linreg(n_rows: int = 5_000):
+
+    df = pd.DataFrame(make_records(n_rows, seed=0))[FEATURES]
+    y = np.random.default_rng(0).uniform(1, 60, n_rows)
+    return LinReg(categorical=FEATURES, numerical=[]).fit(df, y)
+
+
+def best_time(function, number: int) -> float:
+
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def run_benchmark(model_service: ModelService, name: str):
+
+    print(f"\n{name}")
+    print(f"{'rows':>8} {'row-dict (ms)':>14} {'columnar (ms)':>14} {'speed-up':>9}")
+    for n_rows in BATCH_SIZES:
+        records = make_records(n_rows)
+        columns = to_columns(records)
+        number = max(1, 1_000 // n_rows)
+
+        row_time = best_time(lambda: model_service.lambda_handler(records), number)
+        col_time = best_time(lambda: model_service.lambda_handler(columns), number)
+        print(
+            f"{n_rows:>8} {row_time*1000:>14.3f} {col_time*1000:>14.3f} "
+            f"{row_time/col_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+
+    run_benchmark(ModelService(DummyModel()), "DummyModel")
+    run_benchmark(ModelService(train_linreg()), "LinReg pipeline")
@@ -0,0 +1,87 @@
+import io
+import time
+import tempfile
+from pathlib import Path
+
+from pyarrow import parquet as pq
+
+from development.preprocessor import TRIP_SECONDS_FILTERS, preprocessing_columns
+from tests.benchmarks.benchmark_preprocessor import CATEGORICAL_FEATURES, make_month
+
+"""
+Bytes read and wall time of loading a monthly taxi parquet file for the
+preprocessing: all the columns (previous read_dataframe_parquet) against the
+columns of preprocess_data and the trip_seconds filter pushed down into the read.
+The file has row groups of 50k rows, in trip start order (as downloaded) and
+sorted by trip_seconds (where the row group statistics skip whole row groups).
+
+python -m tests.benchmarks.benchmark_parquet_pushdown
+"""
+
+ROW_GROUP_SIZE = 50_000
+
+
+class CountingFile(io.RawIOBase):
+    # Counts the bytes read from the parquet file
+    def __init__(self, file_path: str):
+
+        self.file = open(file_path, "rb")  # pylint: disable=consider-using-with
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def readinto(self, buffer):
+
+        n_bytes = self.file.readinto(buffer)
+        self.bytes_read += n_bytes
+        return n_bytes
+
+    def close(self):
+
+        self.file.close()
+        super().close()
+
+
+def load(file_path: str, columns=None, filters=None):
+
+    source = CountingFile(file_path)
+    started = time.perf_counter()
+    df = pq.read_table(source, columns=columns, filters=filters).to_pandas()
+    elapsed = time.perf_counter() - started
+    source.close()
+    return df, elapsed, source.bytes_read
+
+
+if __name__ == "__main__":
+
+    month = make_month()
+    columns = preprocessing_columns(CATEGORICAL_FEATURES, [])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = {
+            "trip start order": month.sort_values("trip_start_timestamp"),
+            "trip_seconds order": month.sort_values("trip_seconds"),
+        }
+        print(f"{'file':<20} {'read':<12} {'rows':>8} {'MB read':>8} {'time (s)':>9}")
+        for name, df in files.items():
+            file_path = str(Path(temp_dir) / "month.parquet")
+            df.to_parquet(file_path, index=False, row_group_size=ROW_GROUP_SIZE)
+            for read, kwargs in [
+                ("all", {}),
+                ("pushdown", {"columns": columns, "filters": TRIP_SECONDS_FILTERS}),
+            ]:
+                result, elapsed, bytes_read = load(file_path, **kwargs)
+                print(
+                    f"{name:<20} {read:<12} {len(result):>8,} "
+                    f"{bytes_read / 2**20:>8.1f} {elapsed:>9.3f}"
+                )
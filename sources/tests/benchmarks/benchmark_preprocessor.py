@@ -0,0 +1,107 @@
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from development.preprocessor import Preprocessor
+
+"""
+Peak memory (tracemalloc) and wall time of Preprocessor.preprocess_data on a
+synthetic full month of Chicago taxi trips (~600k rows, columns as read by
+read_dataframe_csv): previous string formatting of every row against the
+normalization of the unique values (categorical columns).
+
+python -m tests.benchmarks.benchmark_preprocessor
+"""
+
+N_ROWS = 600_000
+CATEGORICAL_FEATURES = ["pickup_community_area", "dropoff_community_area", "trip_id"]
+COMMUNITY_AREAS = [str(area) for area in range(1, 78)]
+
+
+def make_month(n_rows: int = N_ROWS, seed: int = 42) -> pd.DataFrame:
+
+    rng = np.random.default_rng(seed)
+
+    def community_areas():
+        # ~10% of the trips have no community area
+        values = rng.choice(COMMUNITY_AREAS, size=n_rows).astype(object)
+        values[rng.random(n_rows) < 0.1] = None
+        return values
+
+    start = pd.Timestamp("2022-04-01") + pd.to_timedelta(
+        rng.integers(0, 30 * 24 * 3600, size=n_rows), unit="s"
+    )
+    trip_seconds = rng.gamma(2.0, 500.0, size=n_rows).round()
+    return pd.DataFrame(
+        {
+            "trip_id": [f"{value:040x}" for value in rng.integers(0, 2**62, n_rows)],
+            "taxi_id": [f"{value:0128x}" for value in rng.integers(0, 5000, n_rows)],
+            "trip_start_timestamp": start,
+            "trip_end_timestamp": start + pd.to_timedelta(trip_seconds, unit="s"),
+            "trip_seconds": trip_seconds,
+            "trip_miles": rng.gamma(2.0, 2.0, size=n_rows),
+            "pickup_community_area": community_areas(),
+            "dropoff_community_area": community_areas(),
+            "fare": rng.gamma(2.0, 10.0, size=n_rows),
+            "payment_type": rng.choice(["Cash", "Credit Card", "Mobile"], n_rows),
+            "company": rng.choice(["Flash Cab", "Taxi Affiliation Services"], n_rows),
+        }
+    )
+
+
+def preprocess_data_strings(df, categorical_features, numerical_features):
+
+    # Previous Preprocessor.preprocess_data
+    df = df[df.trip_seconds.notnull()]
+    df = df[(df.trip_seconds > 60) & (df.trip_seconds < 3600)]
+    df["duration"] = df["trip_seconds"] / 60
+    for column in categorical_features:
+        df[column].fillna(-1, inplace=True)
+        df[column] = df[column].astype("str")
+        df[column] = df[column].str.lower().str.replace(" ", "_")
+    target = ["duration"]
+    df.drop(
+        df.columns.difference(categorical_features + numerical_features + target),
+        axis=1,
+        inplace=True,
+    )
+    return df[categorical_features + numerical_features], df[target].values
+
+
+def measure(preprocess, df):
+
+    # tracemalloc slows down the allocations, so the time is measured without it
+    started = time.perf_counter()
+    features, _ = preprocess(df, CATEGORICAL_FEATURES, [])
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    preprocess(df, CATEGORICAL_FEATURES, [])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return features, elapsed, peak
+
+
+if __name__ == "__main__":
+
+    month = make_month()
+    print(f"{len(month):,} rows, {month.memory_usage(deep=True).sum() / 2**20:.0f} MB")
+
+    pd.options.mode.chained_assignment = None
+    strings, strings_time, strings_peak = measure(preprocess_data_strings, month)
+    categories, categories_time, categories_peak = measure(
+        Preprocessor().preprocess_data, month
+    )
+    assert strings.equals(categories.astype(str))
+
+    print(
+        f"{'implementation':<16} {'time (s)':>9} {'peak (MB)':>10} {'result (MB)':>12}"
+    )
+    for name, features, elapsed, peak in [
+        ("strings", strings, strings_time, strings_peak),
+        ("categories", categories, categories_time, categories_peak),
+    ]:
+        size = features.memory_usage(deep=True).sum()
+        print(f"{name:<16} {elapsed:>9.3f} {peak / 2**20:>10.0f} {size / 2**20:>12.0f}")
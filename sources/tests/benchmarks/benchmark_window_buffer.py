@@ -0,0 +1,91 @@
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+"""
+Sustained ingest rate (rows/s, one row per /iterate call) of the current data window
+of the evidently service: DataFrame append + drop + reset_index (previous
+implementation) against the ring buffer, for window sizes of 1k, 10k and 100k.
+
+python -m tests.benchmarks.benchmark_window_buffer
+"""
+
+# The evidently service modules are not in a package
+sys.path.append(
+    str(Path(__file__).parent / "../../monitoring/on_line/evidently_service")
+)
+from window_buffer import WindowBuffer  # pylint: disable=wrong-import-position
+
+WINDOW_SIZES = [1_000, 10_000, 100_000]
+CATEGORICAL = ["pickup_community_area", "dropoff_community_area"]
+CATEGORIES = ["-1"] + [str(area) for area in range(1, 78)]
+
+
+def make_rows(n_rows: int, seed: int = 42):
+
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "trip_id": f"trip-{i}",
+            "pickup_community_area": str(rng.choice(CATEGORIES)),
+            "dropoff_community_area": str(rng.choice(CATEGORIES)),
+            "prediction": float(rng.uniform(1, 60)),
+        }
+        for i in range(n_rows)
+    ]
+
+
+def dataframe_window(current_data, new_rows, window_size):
+
+    # Previous MonitoringService.iterate (pd.concat instead of DataFrame.append,
+    # which is removed in pandas 2)
+    current_data = pd.concat([current_data, new_rows], ignore_index=True)
+    current_size = current_data.shape[0]
+    if current_size > window_size:
+        current_data.drop(
+            index=list(range(0, current_size - window_size)), inplace=True
+        )
+        current_data.reset_index(drop=True, inplace=True)
+    return current_data
+
+
+def ingest_rate_dataframe(window_size: int, n_events: int) -> float:
+
+    current_data = pd.DataFrame(make_rows(window_size, seed=0))
+    rows = make_rows(n_events)
+    started = time.perf_counter()
+    for row in rows:
+        current_data = dataframe_window(
+            current_data, pd.DataFrame.from_dict([row]), window_size
+        )
+    return n_events / (time.perf_counter() - started)
+
+
+def ingest_rate_buffer(window_size: int, n_events: int) -> float:
+
+    buffer = WindowBuffer(window_size, CATEGORICAL, ["prediction"])
+    buffer.extend(make_rows(window_size, seed=0))
+    rows = make_rows(n_events)
+    started = time.perf_counter()
+    for row in rows:
+        buffer.append(row)
+    return n_events / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+
+    print(f"{'window':>8} {'DataFrame (rows/s)':>19} {'ring buffer (rows/s)':>21}")
+    for window_size in WINDOW_SIZES:
+        # Fewer events for the slow implementation
+        dataframe_rate = ingest_rate_dataframe(window_size, 200)
+        buffer_rate = ingest_rate_buffer(window_size, 20_000)
+        print(f"{window_size:>8} {dataframe_rate:>19,.0f} {buffer_rate:>21,.0f}")
+
+    buffer = WindowBuffer(100_000, CATEGORICAL, ["prediction"])
+    buffer.extend(make_rows(100_000))
+    started = time.perf_counter()
+    buffer.to_frame()
+    print(f"\nto_frame of a 100k window: {(time.perf_counter() - started)*1000:.1f} ms")
@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+
+# Get this script file path
+# and set working directory to ../../, so if the script is run from
+# sources directory, and the packages are loaded correctly
+if [[ -z "${GITHUB_ACTIONS}" ]]; then
+  cd "$(dirname "$0")"
+  cd ../..
+fi
+
+export PYTHONPATH=.
+
+for benchmark in ./tests/benchmarks/benchmark_*.py; do
+  module=$(basename "${benchmark}" .py)
+  echo "Running ${module}"
+  pipenv run python -m "tests.benchmarks.${module}" || exit $?
+done
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# The evidently service is not a package: its modules import each other as top
+# level modules (e.g. `from preprocessor import Preprocessor`), as in its container
+EVIDENTLY_SERVICE_PATH = (
+    Path(__file__).parent / "../../monitoring/on_line/evidently_service"
+).resolve()
+sys.path.append(str(EVIDENTLY_SERVICE_PATH))
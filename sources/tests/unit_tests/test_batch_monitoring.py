@@ -0,0 +1,250 @@
+import json
+import inspect
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import mongomock
+from bson import ObjectId
+from mongomock.collection import BulkOperationBuilder
+from evidently import ColumnMapping
+from evidently.tests import TestShareOfDriftedFeatures
+from evidently.metrics import DataDriftTable
+from evidently.test_suite import TestSuite
+
+from monitoring.batch import batch_monitoring
+
+TARGETS = [(f"trip-{i}", i / 10) for i in range(25)]
+
+
+@pytest.fixture(name="collection")
+def fixture_collection(monkeypatch):
+    # Real mongomock collection, that records the bulk_write calls
+    add_update = BulkOperationBuilder.add_update
+    if "sort" not in inspect.signature(add_update).parameters:
+        # pymongo >= 4.9 passes sort (None for UpdateOne) to the bulk builder of
+        # mongomock, which does not accept it. Not needed with the pinned pymongo
+
+        def add_update_without_sort(self, *args, sort=None, **kwargs):
+            assert sort is None
+            return add_update(self, *args, **kwargs)
+
+        monkeypatch.setattr(BulkOperationBuilder, "add_update", add_update_without_sort)
+
+    bulk_writes = []
+    bulk_write = mongomock.Collection.bulk_write
+
+    def recorded_bulk_write(self, requests, ordered=True, **kwargs):
+        bulk_writes.append((len(requests), ordered))
+        return bulk_write(self, requests, ordered=ordered, **kwargs)
+
+    monkeypatch.setattr(mongomock.Collection, "bulk_write", recorded_bulk_write)
+    collection = mongomock.MongoClient().db.data
+    collection.bulk_writes = bulk_writes
+    return collection
+
+
+def test_add_target_to_actual_data(collection, tmp_path):
+
+    # Predictions of all the trips but the last one, and of a trip without target
+    collection.insert_many(
+        [{"trip_id": trip_id, "prediction": 1.0} for trip_id, _ in TARGETS[:-1]]
+        + [{"trip_id": "other", "prediction": 2.0}]
+    )
+    filename = tmp_path / "test_target_values.csv"
+    filename.write_text("".join(f"{trip_id},{target}\n" for trip_id, target in TARGETS))
+
+    stats = batch_monitoring.add_target_to_actual_data(
+        str(filename), collection, batch_size=10
+    )
+
+    assert stats["rows"] == 25
+    assert stats["matched"] == 24
+    assert collection.bulk_writes == [(10, False), (10, False), (5, False)]
+    targets = {
+        document["trip_id"]: document.get("target")
+        for document in collection.find({}, {"_id": 0})
+    }
+    assert targets == {**dict(TARGETS[:-1]), "other": None}
+    assert "trip_id_1" in collection.index_information()
+
+
+def test_add_target_to_actual_data_empty_file(collection, tmp_path):
+
+    filename = tmp_path / "test_target_values.csv"
+    filename.write_text("")
+
+    stats = batch_monitoring.add_target_to_actual_data(str(filename), collection)
+
+    assert stats["rows"] == 0
+    assert collection.bulk_writes == []
+
+
+def test_get_actual_data():
+
+    collection = mongomock.MongoClient().db.data
+    # One prediction per minute, with fields that are not read
+    collection.insert_many(
+        [
+            {
+                "_id": ObjectId.from_datetime(datetime(2022, 4, 1, 0, i)),
+                "trip_id": f"trip-{i}",
+                "pickup_community_area": str(i % 3),
+                "dropoff_community_area": str(i % 5),
+                "prediction": i / 2,
+                "target": i / 3,
+                "payload": "x" * 100,
+            }
+            for i in range(30)
+        ]
+    )
+
+    df = batch_monitoring.get_actual_data(
+        features=["pickup_community_area", "dropoff_community_area"],
+        target=["target"],
+        prediction=["prediction"],
+        start=datetime(2022, 4, 1, 0, 10),
+        end=datetime(2022, 4, 1, 0, 20),
+        collection=collection,
+        batch_size=4,
+    )
+
+    assert df.columns.tolist() == [
+        "pickup_community_area",
+        "dropoff_community_area",
+        "target",
+        "prediction",
+    ]
+    assert df["prediction"].tolist() == [i / 2 for i in range(10, 20)]
+    assert df["pickup_community_area"].tolist() == [str(i % 3) for i in range(10, 20)]
+
+    # Without window, and before the targets were added
+    collection.update_many({}, {"$unset": {"target": ""}})
+    df = batch_monitoring.get_actual_data(
+        ["trip_id"], ["target"], ["prediction"], collection=collection
+    )
+    assert len(df) == 30
+    assert df["target"].isna().all()
+
+
+def evidently_data(seed, pickup_areas):
+
+    rng = np.random.default_rng(seed)
+    target = rng.uniform(5, 30, 500)
+    return pd.DataFrame(
+        {
+            "pickup_community_area": rng.choice(pickup_areas, 500),
+            "dropoff_community_area": rng.choice(["8", "32", "28"], 500),
+            "target": target,
+            "prediction": target + rng.normal(0, 2, 500),
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "pickup_areas, status", [(["8", "32", "28"], "SUCCESS"), (["76", "77"], "FAIL")]
+)
+def test_run_evidently(pickup_areas, status, tmp_path, monkeypatch):
+
+    ref_data = evidently_data(1, ["8", "32", "28"])
+    data = evidently_data(2, pickup_areas)
+    calculate = DataDriftTable.calculate
+    calls = []
+
+    def counted_calculate(self, data):
+        calls.append(self)
+        return calculate(self, data)
+
+    monkeypatch.setattr(DataDriftTable, "calculate", counted_calculate)
+    html_path = tmp_path / "report.html"
+
+    profile, test_results, timings = batch_monitoring.run_evidently(
+        ref_data, data, str(html_path)
+    )
+
+    # The drift is calculated once for the profile and the test, and once more
+    # for the HTML report
+    assert len(calls) == 2
+    assert sorted(timings) == ["analysis", "drift_test", "html", "profile"]
+    assert html_path.exists()
+    assert sorted(profile["metrics"]) == [
+        "DataDriftTable",
+        "DatasetDriftMetric",
+        "RegressionErrorBiasTable",
+        "RegressionQualityMetric",
+    ]
+    test_result = test_results["tests"][0]
+    assert test_result["status"] == status
+    assert test_result["parameters"]["condition"] == {"lt": 0.3}
+    # Same result as the test suite
+    monkeypatch.setattr(DataDriftTable, "calculate", calculate)
+    test_suite = TestSuite(tests=[TestShareOfDriftedFeatures()])
+    test_suite.run(
+        reference_data=ref_data,
+        current_data=data,
+        column_mapping=ColumnMapping(
+            prediction="prediction",
+            categorical_features=["pickup_community_area", "dropoff_community_area"],
+            numerical_features=[],
+        ),
+    )
+    assert test_result == json.loads(test_suite.json())["tests"][0]
+
+
+def test_run_evidently_without_html(monkeypatch):
+
+    data = evidently_data(1, ["8", "32", "28"])
+    calculate = DataDriftTable.calculate
+    calls = []
+
+    def counted_calculate(self, data):
+        calls.append(self)
+        return calculate(self, data)
+
+    monkeypatch.setattr(DataDriftTable, "calculate", counted_calculate)
+
+    _, test_results, timings = batch_monitoring.run_evidently(data, data)
+
+    assert "html" not in timings
+    assert len(calls) == 1
+    assert test_results["tests"][0]["status"] == "SUCCESS"
+
+
+class CountingModel:
+    # Model with the metadata of ModelService, that counts the predictions
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.calls = 0
+
+    def predict(self, features):
+        self.calls += 1
+        return features["target"].values * 2 + len(self.metadata["version"])
+
+
+def test_add_prediction_to_ref_data(tmp_path):
+
+    ref_data = evidently_data(1, ["8", "32", "28"]).drop(columns="prediction")
+    model = CountingModel({"version": "3", "run_id": "abc"})
+
+    for _ in range(2):
+        data = ref_data.copy()
+        batch_monitoring.add_prediction_to_ref_data(data, model, str(tmp_path))
+        np.testing.assert_array_equal(data["prediction"], ref_data["target"] * 2 + 1)
+    assert model.calls == 1
+
+    # A new Staging model replaces the predictions of the previous one
+    new_model = CountingModel({"version": "10", "run_id": "def"})
+    data = ref_data.copy()
+    batch_monitoring.add_prediction_to_ref_data(data, new_model, str(tmp_path))
+    np.testing.assert_array_equal(data["prediction"], ref_data["target"] * 2 + 2)
+    assert new_model.calls == 1
+    assert [path.name.split("-", 1)[1] for path in tmp_path.iterdir()] == [
+        "run-def.parquet"
+    ]
+
+    # Other reference data
+    data = ref_data.head(100).copy()
+    batch_monitoring.add_prediction_to_ref_data(data, new_model, str(tmp_path))
+    assert new_model.calls == 2
+    assert len(list(tmp_path.iterdir())) == 2
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from evidently.calculations.stattests.psi import _psi
+from evidently.calculations.stattests.jensenshannon import _jensenshannon
+from evidently.calculations.stattests.chisquare_stattest import _chi_stat_test
+
+from window_buffer import WindowBuffer
+from categorical_drift import CategoricalDrift
+
+CATEGORICAL = ["pickup_community_area", "dropoff_community_area"]
+CATEGORIES = [str(area) for area in range(1, 12)]
+
+
+def make_frame(n_rows: int, probabilities, seed: int) -> pd.DataFrame:
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            column: rng.choice(CATEGORIES, size=n_rows, p=probabilities)
+            for column in CATEGORICAL
+        }
+    )
+
+
+def test_categorical_drift_matches_evidently():
+
+    reference = make_frame(500, None, seed=1)
+    # The window only has 10 of the 11 categories, with a different distribution
+    probabilities = np.array([0.0] + [1.0] * 9 + [5.0])
+    current = make_frame(700, probabilities / probabilities.sum(), seed=2)
+
+    window = WindowBuffer(200, CATEGORICAL)
+    drift = CategoricalDrift(window, reference, CATEGORICAL)
+    # Rows added in batches and one by one, wrapping around the window
+    window.extend(current.iloc[:450])
+    for _, row in current.iloc[450:].iterrows():
+        window.append(row.to_dict())
+
+    statistics = drift.statistics()
+    window_frame = window.to_frame()
+    for column in CATEGORICAL:
+        reference_data = reference[column]
+        current_data = window_frame[column]
+        expected = {
+            "chisquare": _chi_stat_test(reference_data, current_data, "cat", 0.05)[0],
+            "psi": _psi(reference_data, current_data, "cat", 0.1)[0],
+            "jensenshannon": _jensenshannon(reference_data, current_data, "cat", 0.1)[
+                0
+            ],
+        }
+        assert statistics[column] == pytest.approx(expected, rel=1e-9)
+
+
+def test_categorical_drift_missing_values():
+
+    reference = make_frame(500, None, seed=3).astype(object)
+    current = make_frame(150, None, seed=4).astype(object)
+    # Missing values on both sides, more of them in the window
+    reference.loc[::10, "dropoff_community_area"] = None
+    current.loc[::3, "dropoff_community_area"] = None
+    current.loc[::7, "pickup_community_area"] = np.nan
+
+    window = WindowBuffer(200, CATEGORICAL)
+    drift = CategoricalDrift(window, reference, CATEGORICAL)
+    window.extend(current)
+
+    statistics = drift.statistics()
+    window_frame = window.to_frame()
+    for column in CATEGORICAL:
+        # evidently drops the missing values of each column
+        reference_data = reference[column].dropna()
+        current_data = window_frame[column].dropna()
+        expected = {
+            "chisquare": _chi_stat_test(reference_data, current_data, "cat", 0.05)[0],
+            "psi": _psi(reference_data, current_data, "cat", 0.1)[0],
+            "jensenshannon": _jensenshannon(reference_data, current_data, "cat", 0.1)[
+                0
+            ],
+        }
+        assert statistics[column] == pytest.approx(expected, rel=1e-9)
+
+    # A column without values in the window is skipped
+    window = WindowBuffer(200, CATEGORICAL)
+    drift = CategoricalDrift(window, reference, CATEGORICAL)
+    window.append({"pickup_community_area": "1", "dropoff_community_area": None})
+    assert list(drift.statistics()) == ["pickup_community_area"]
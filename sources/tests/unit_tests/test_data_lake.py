@@ -0,0 +1,139 @@
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+import flask
+import numpy as np
+import pytest
+from werkzeug.serving import make_server
+
+from development import preprocessor as preprocessor_module
+from development.data_lake import TripsDataLake
+from development.preprocessing_cache import PreprocessingCache
+
+HEADER = (
+    "Trip ID,Trip Start Timestamp,Trip End Timestamp,Trip Seconds,"
+    "Pickup Community Area,Dropoff Community Area,Fare"
+)
+# One trip every 2 hours in April 2022
+TRIPS = [
+    (
+        f"trip-{i}",
+        datetime(2022, 4, 1) + timedelta(hours=2 * i),
+        30 * (i % 10),
+        "" if i % 7 == 0 else str(i % 77 + 1),
+        str(i % 5 + 1),
+    )
+    for i in range(12 * 30)
+]
+CATEGORICAL_FEATURES = ["pickup_community_area", "dropoff_community_area"]
+
+
+@pytest.fixture(name="trips_api")
+def fixture_trips_api():
+    # Local stand-in of the data.cityofchicago.org csv export, with the trips of
+    # the query window. Records the start of each requested window
+    app = flask.Flask(__name__)
+    app.config["requests"] = []
+
+    @app.route("/rows.csv")
+    def rows():
+        start, end = re.findall(r"'([0-9T:-]+)'", flask.request.args["query"])
+        app.config["requests"].append(start)
+        start, end = datetime.fromisoformat(start), datetime.fromisoformat(end)
+        lines = [HEADER] + [
+            f"{trip_id},{timestamp:%m/%d/%Y %I:%M:%S %p},"
+            f"{timestamp + timedelta(seconds=seconds):%m/%d/%Y %I:%M:%S %p},"
+            f"{seconds},{pickup},{dropoff},{seconds / 100}"
+            for trip_id, timestamp, seconds, pickup, dropoff in TRIPS
+            if start <= timestamp < end
+        ]
+        return "\n".join(lines) + "\n"
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, f"http://127.0.0.1:{server.server_port}/rows.csv"
+    server.shutdown()
+    thread.join()
+
+
+def test_ensure_downloads_missing_days(trips_api, tmp_path):
+
+    app, url = trips_api
+    lake = TripsDataLake(str(tmp_path / "trips"), base_url=url, max_workers=2)
+
+    lake.ensure(datetime(2022, 4, 1), datetime(2022, 4, 4))
+    assert sorted(app.config["requests"]) == [
+        "2022-04-01T00:00:00",
+        "2022-04-02T00:00:00",
+        "2022-04-03T00:00:00",
+    ]
+    assert os.path.exists(
+        tmp_path / "trips" / "year=2022" / "month=4" / "day=3" / "part-0.parquet"
+    )
+    # No staging files left
+    assert sorted(os.listdir(tmp_path / "trips")) == ["year=2022"]
+
+    # Only the days 4 and 5 are missing
+    app.config["requests"] = []
+    files = lake.ensure(datetime(2022, 4, 2), datetime(2022, 4, 6))
+    assert sorted(app.config["requests"]) == [
+        "2022-04-04T00:00:00",
+        "2022-04-05T00:00:00",
+    ]
+    assert len(files) == 4
+
+
+def test_read_range_and_columns(trips_api, tmp_path):
+
+    _, url = trips_api
+    lake = TripsDataLake(str(tmp_path / "trips"), base_url=url)
+
+    df = lake.read(
+        datetime(2022, 4, 2),
+        datetime(2022, 4, 4),
+        columns=["trip_id", "pickup_community_area", "trip_seconds"],
+        filters=preprocessor_module.TRIP_SECONDS_FILTERS,
+    )
+
+    expected = [
+        (trip_id, pickup or None, float(seconds))
+        for trip_id, timestamp, seconds, pickup, _ in TRIPS
+        if 2 <= timestamp.day < 4 and 60 < seconds < 3600
+    ]
+    assert df.columns.tolist() == ["trip_id", "pickup_community_area", "trip_seconds"]
+    assert list(df.itertuples(index=False, name=None)) == expected
+    # Same types for all the days, e.g. the areas are never read as floats
+    day_1 = lake.read(datetime(2022, 4, 1), datetime(2022, 4, 2))
+    assert (
+        day_1.dtypes.to_dict()
+        == lake.read(datetime(2022, 4, 3), datetime(2022, 4, 4)).dtypes.to_dict()
+    )
+    assert day_1["pickup_community_area"].dtype == object
+    assert day_1["trip_start_timestamp"].dtype == np.dtype("datetime64[ns]")
+
+
+def test_process_trips(trips_api, tmp_path):
+
+    app, url = trips_api
+    lake = TripsDataLake(str(tmp_path / "trips"), base_url=url)
+    start, end = datetime(2022, 4, 1), datetime(2022, 4, 3)
+    expected_df, expected_y = preprocessor_module.Preprocessor().preprocess_data(
+        lake.read(start, end), CATEGORICAL_FEATURES, []
+    )
+
+    cache = PreprocessingCache(str(tmp_path / "cache"))
+    preprocessor = preprocessor_module.Preprocessor(cache=cache)
+    for _ in range(2):
+        df, y = preprocessor.process_trips(
+            lake, start, end, "trip_seconds", CATEGORICAL_FEATURES
+        )
+        assert df.astype(str).values.tolist() == expected_df.astype(str).values.tolist()
+        np.testing.assert_array_equal(y, expected_y)
+
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+    # Each day was downloaded once
+    assert len(app.config["requests"]) == 2
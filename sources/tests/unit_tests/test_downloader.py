@@ -0,0 +1,184 @@
+import re
+import time
+import threading
+from datetime import datetime, timedelta
+
+import flask
+import pandas as pd
+import pytest
+from werkzeug.serving import make_server
+
+from development import downloader
+
+HEADER = "Trip ID,Trip Start Timestamp,Trip Seconds"
+# One trip every 2 hours in April 2022
+TRIPS = [
+    (f"trip-{i}", datetime(2022, 4, 1) + timedelta(hours=2 * i), i)
+    for i in range(12 * 30)
+]
+
+
+def window_csv(start: datetime, end: datetime) -> str:
+
+    lines = [HEADER] + [
+        f"{trip_id},{timestamp:%m/%d/%Y %I:%M:%S %p},{seconds}"
+        for trip_id, timestamp, seconds in TRIPS
+        if start <= timestamp < end
+    ]
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture(name="trips_api")
+def fixture_trips_api():
+    # Local stand-in of the data.cityofchicago.org csv export: serves the trips of
+    # the query window. The first request of each window in "fail" gets a 500,
+    # and the first one of each window in "hang" waits 2 seconds before answering.
+    # Range requests get the rest of the file (206), or a 416 past its end
+    app = flask.Flask(__name__)
+    app.config["requests"] = []
+    app.config["ranges"] = []
+    app.config["fail"] = set()
+    app.config["hang"] = set()
+
+    @app.route("/rows.csv")
+    def rows():
+        start, end = re.findall(r"'([0-9T:-]+)'", flask.request.args["query"])
+        app.config["requests"].append(start)
+        if start in app.config["fail"]:
+            app.config["fail"].discard(start)
+            return "Internal Server Error", 500
+        if start in app.config["hang"]:
+            app.config["hang"].discard(start)
+            time.sleep(2)
+        start, end = datetime.fromisoformat(start), datetime.fromisoformat(end)
+        body = window_csv(start, end).encode()
+        if "Range" not in flask.request.headers:
+            return body
+        app.config["ranges"].append(flask.request.headers["Range"])
+        offset = int(re.match(r"bytes=(\d+)-", flask.request.headers["Range"])[1])
+        if offset >= len(body):
+            return "", 416, {"Content-Range": f"bytes */{len(body)}"}
+        content_range = f"bytes {offset}-{len(body) - 1}/{len(body)}"
+        return body[offset:], 206, {"Content-Range": content_range}
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, f"http://127.0.0.1:{server.server_port}/rows.csv"
+    server.shutdown()
+    thread.join()
+
+
+def test_query_windows():
+
+    windows = downloader.query_windows(
+        datetime(2022, 4, 1), datetime(2022, 4, 2, 6), timedelta(hours=12)
+    )
+
+    assert windows == [
+        (datetime(2022, 4, 1, 0), datetime(2022, 4, 1, 12)),
+        (datetime(2022, 4, 1, 12), datetime(2022, 4, 2, 0)),
+        (datetime(2022, 4, 2, 0), datetime(2022, 4, 2, 6)),
+    ]
+
+
+def test_download_dataset(trips_api, tmp_path, monkeypatch):
+
+    app, url = trips_api
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+    app.config["fail"] = {"2022-04-03T00:00:00"}
+    output_filename = str(tmp_path / "Taxi_Trips_2022_04.csv")
+
+    downloader.download_dataset(
+        2022, 4, 6, output_filename, max_workers=3, base_url=url
+    )
+
+    df = pd.read_csv(output_filename)
+    # Days 1 to 5, in order, with a single header
+    expected = [trip_id for trip_id, timestamp, _ in TRIPS if timestamp.day < 6]
+    assert df["Trip ID"].tolist() == expected
+    # 5 windows, one of them retried
+    assert len(app.config["requests"]) == 6
+    assert not (tmp_path / "Taxi_Trips_2022_04.csv.parts").exists()
+
+
+def test_download_dataset_resumes(trips_api, tmp_path):
+
+    app, url = trips_api
+    output_filename = str(tmp_path / "Taxi_Trips_2022_04.csv")
+    windows = downloader.query_windows(datetime(2022, 4, 1), datetime(2022, 4, 4))
+    # A previous run failed after downloading the first window
+    downloader.download_windows(windows[:1], f"{output_filename}.parts", url)
+    assert app.config["requests"] == ["2022-04-01T00:00:00"]
+
+    downloader.download_dataset(2022, 4, 4, output_filename, base_url=url)
+
+    assert sorted(app.config["requests"]) == [
+        "2022-04-01T00:00:00",
+        "2022-04-02T00:00:00",
+        "2022-04-03T00:00:00",
+    ]
+    assert len(pd.read_csv(output_filename)) == 36
+
+
+def test_download_dataset_stalled(trips_api, tmp_path, monkeypatch):
+
+    app, url = trips_api
+    monkeypatch.setattr(downloader, "DOWNLOAD_TIMEOUT_SEC", 0.2)
+    app.config["hang"] = {"2022-04-02T00:00:00"}
+    output_filename = str(tmp_path / "Taxi_Trips_2022_04.csv")
+
+    started = time.perf_counter()
+    downloader.download_dataset(2022, 4, 4, output_filename, base_url=url)
+
+    # The stalled window timed out and was retried, without waiting for the server
+    assert time.perf_counter() - started < 2
+    assert sorted(app.config["requests"]) == [
+        "2022-04-01T00:00:00",
+        "2022-04-02T00:00:00",
+        "2022-04-02T00:00:00",
+        "2022-04-03T00:00:00",
+    ]
+    assert len(pd.read_csv(output_filename)) == 36
+
+
+@pytest.mark.parametrize("partial_size", [100, None])
+def test_download_window_resumes_partial_file(trips_api, tmp_path, partial_size):
+
+    app, url = trips_api
+    start, end = datetime(2022, 4, 1), datetime(2022, 4, 2)
+    expected = window_csv(start, end).encode()
+    part_path = tmp_path / "part.csv"
+    # A previous attempt was interrupted after partial_size bytes, or after the
+    # last byte but before the rename (None)
+    partial = expected[:partial_size]
+    (tmp_path / "part.csv.tmp").write_bytes(partial)
+
+    downloader.download_window(
+        downloader.query_url(start, end, url), str(part_path), retries=0
+    )
+
+    assert part_path.read_bytes() == expected
+    assert not (tmp_path / "part.csv.tmp").exists()
+    assert app.config["ranges"] == [f"bytes={len(partial)}-"]
+
+
+def test_download_window_restarts_mismatched_partial_file(
+    trips_api, tmp_path, monkeypatch
+):
+
+    app, url = trips_api
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+    start, end = datetime(2022, 4, 1), datetime(2022, 4, 2)
+    expected = window_csv(start, end).encode()
+    part_path = tmp_path / "part.csv"
+    # Longer than the file of the server: the 416 does not mean complete
+    (tmp_path / "part.csv.tmp").write_bytes(expected + b"extra")
+
+    downloader.download_window(
+        downloader.query_url(start, end, url), str(part_path), retries=1
+    )
+
+    assert part_path.read_bytes() == expected
+    # The 416, then the whole file
+    assert len(app.config["requests"]) == 2
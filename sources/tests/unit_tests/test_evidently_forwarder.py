@@ -0,0 +1,141 @@
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+import pytest
+from werkzeug.serving import make_server
+
+from production.model_service import json_lines_columns
+from production.evidently_forwarder import EvidentlyForwarder
+from production.chicago_taxi_prediction import monitoring_records
+
+RECORD = {
+    "trip_id": "2b0bbf69fcaa3815ea9280360c01be4e9642f805",
+    "pickup_community_area": "8",
+    "dropoff_community_area": "32",
+    "prediction": 40.0,
+}
+
+
+@pytest.fixture(name="evidently_service")
+def fixture_evidently_service():
+    # Local stand-in of the evidently service, that records the received batches
+    app = flask.Flask(__name__)
+    app.config["batches"] = []
+    app.config["delay_sec"] = 0
+
+    @app.route("/iterate/<dataset>", methods=["POST"])
+    def iterate(dataset: str):
+        time.sleep(app.config["delay_sec"])
+        app.config["batches"].append((dataset, flask.request.json))
+        return "ok"
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, f"http://127.0.0.1:{server.server_port}/iterate/taxi"
+    server.shutdown()
+    thread.join()
+
+
+def test_forwarder_batches_by_size(evidently_service):
+
+    app, url = evidently_service
+    forwarder = EvidentlyForwarder(url, batch_size=10, flush_interval_sec=5).start()
+
+    forwarder.submit([dict(RECORD, trip_id=str(i)) for i in range(25)])
+    # 2 full batches are sent without waiting for the flush interval
+    for _ in range(200):
+        if len(app.config["batches"]) >= 2:
+            break
+        time.sleep(0.01)
+    forwarder.stop(timeout=10)
+
+    sizes = [len(batch) for _, batch in app.config["batches"]]
+    assert sizes == [10, 10, 5]
+    assert [record["trip_id"] for _, b in app.config["batches"] for record in b] == [
+        str(i) for i in range(25)
+    ]
+    assert forwarder.stats["sent"] == 25
+    assert forwarder.stats["batches"] == 3
+
+
+def test_forwarder_batches_by_time(evidently_service):
+
+    app, url = evidently_service
+    forwarder = EvidentlyForwarder(url, batch_size=100, flush_interval_sec=0.05)
+    forwarder.start()
+
+    forwarder.submit([RECORD])
+    assert forwarder.flush(timeout=5)
+    forwarder.stop(timeout=5)
+
+    assert app.config["batches"] == [("taxi", [RECORD])]
+
+
+def test_forwarder_drops_when_queue_is_full(evidently_service):
+
+    _, url = evidently_service
+    # Not started, so nothing is consumed from the queue
+    forwarder = EvidentlyForwarder(url, max_queue_size=3)
+
+    assert forwarder.submit([RECORD] * 5) == 3
+    assert forwarder.stats["queued"] == 3
+    assert forwarder.stats["dropped"] == 2
+
+
+def test_forwarder_does_not_block_on_slow_service(evidently_service):
+
+    app, url = evidently_service
+    app.config["delay_sec"] = 1
+    forwarder = EvidentlyForwarder(url, batch_size=1, flush_interval_sec=0.01).start()
+
+    started = time.perf_counter()
+    for _ in range(100):
+        forwarder.submit([RECORD])
+    elapsed = time.perf_counter() - started
+    forwarder.stop(timeout=0)
+
+    assert elapsed < 0.5
+
+
+def test_forwarder_counts_failed_batches():
+
+    forwarder = EvidentlyForwarder(
+        "http://127.0.0.1:1/iterate/taxi", flush_interval_sec=0.01, timeout_sec=1
+    ).start()
+
+    forwarder.submit([RECORD])
+    assert forwarder.flush(timeout=5)
+    forwarder.stop(timeout=5)
+
+    assert forwarder.stats["failed"] == 1
+
+
+def test_forwarder_counts_concurrent_submits():
+
+    # Not started: the queue fills up and the rest of the records are dropped
+    forwarder = EvidentlyForwarder(
+        "http://127.0.0.1:1/iterate/taxi", max_queue_size=500
+    )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        queued = sum(executor.map(lambda _: forwarder.submit([RECORD] * 3), range(400)))
+
+    assert queued == forwarder.stats["queued"] == 500
+    assert forwarder.stats["dropped"] == 1200 - 500
+
+
+def test_monitoring_records():
+
+    features = {key: RECORD[key] for key in RECORD if key != "prediction"}
+    batch = {key: [value, value] for key, value in features.items()}
+
+    assert monitoring_records(features, RECORD) == [RECORD]
+    assert monitoring_records([features], [40.0]) == [RECORD]
+    assert monitoring_records(batch, {"prediction": [40.0, 40.0]}) == [RECORD] * 2
+    # JSON lines body, decoded once by the entry point
+    columns = json_lines_columns("\n".join(json.dumps(features) for _ in range(2)))
+    assert monitoring_records(columns, {"prediction": [40.0, 40.0]}) == [RECORD] * 2
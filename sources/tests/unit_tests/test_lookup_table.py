@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from development.model import LinReg, GBRegressor
+from production.lookup_table import (
+    FEATURES,
+    COMMUNITY_AREAS,
+    check_parity,
+    load_lookup_table,
+    export_lookup_table,
+)
+from production.model_service import DummyModel, ModelService
+
+SOURCES_PATH = str(Path(__file__).parent.parent.parent.resolve())
+# Serves one request from a lookup table, and reports the modules imported
+LOOKUP_HANDLER_SCRIPT = """
+import sys
+import json
+from production.chicago_taxi_prediction import lambda_handler
+
+record = {"pickup_community_area": "8", "dropoff_community_area": "32"}
+response = lambda_handler({"body": json.dumps(record)}, None)
+print(json.dumps({
+    "body": json.loads(response["body"]),
+    "mlflow": "mlflow" in sys.modules,
+}))
+"""
+
+
+def make_features(n_rows: int, seed: int):
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {feature: rng.choice(COMMUNITY_AREAS, size=n_rows) for feature in FEATURES}
+    )
+
+
+def train(model_class, **kwargs):
+
+    df = make_features(2_000, seed=0)
+    y = np.random.default_rng(0).uniform(1, 60, len(df))
+    return model_class(categorical=FEATURES, numerical=[], **kwargs).fit(df, y)
+
+
+@pytest.mark.parametrize(
+    "model",
+    [train(LinReg), train(GBRegressor, n_estimators=10)],
+    ids=["LinReg", "GBRegressor"],
+)
+def test_lookup_table_parity(model, tmp_path):
+
+    lookup_model = export_lookup_table(
+        model, str(tmp_path / "lookup_table"), metadata={"version": "3"}
+    )
+
+    assert lookup_model.table.shape == (len(COMMUNITY_AREAS), len(COMMUNITY_AREAS))
+    assert lookup_model.version == "3"
+    assert check_parity(model, lookup_model, make_features(1_000, seed=1)) < 1e-9
+
+
+def test_lookup_table_model_service(tmp_path):
+
+    model = train(LinReg)
+    export_lookup_table(model, str(tmp_path))
+    model_service = ModelService(load_lookup_table(str(tmp_path)))
+
+    record = {
+        "trip_id": "a",
+        "pickup_community_area": "8",
+        "dropoff_community_area": 32,
+    }
+    batch = {
+        "trip_id": ["a", "b"],
+        "pickup_community_area": ["8", "-1"],
+        "dropoff_community_area": ["32", "77"],
+    }
+    expected = model.predict(pd.DataFrame(batch)[FEATURES])
+
+    assert model_service.lambda_handler(record)["prediction"] == pytest.approx(
+        expected[0]
+    )
+    assert model_service.lambda_handler(batch)["prediction"] == pytest.approx(
+        expected.tolist()
+    )
+
+
+def test_lookup_table_unknown_category(tmp_path):
+
+    lookup_model = export_lookup_table(train(LinReg), str(tmp_path))
+
+    with pytest.raises(ValueError, match="pickup_community_area"):
+        lookup_model.predict(
+            {"pickup_community_area": ["78"], "dropoff_community_area": ["1"]}
+        )
+
+
+def test_lookup_table_does_not_import_mlflow(tmp_path):
+
+    export_lookup_table(DummyModel(), str(tmp_path))
+    env = dict(
+        os.environ,
+        PYTHONPATH=SOURCES_PATH,
+        LOOKUP_TABLE_LOCATION=str(tmp_path),
+        STAGE_TIMING="off",
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", LOOKUP_HANDLER_SCRIPT],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    assert result["body"]["prediction"] == 40.0
+    assert not result["mlflow"]
@@ -0,0 +1,146 @@
+import io
+import json
+import threading
+
+from prometheus_client import CollectorRegistry
+
+from production.stage_timer import EmfSink, StageTimer, PrometheusSink
+from production.model_service import FEATURES, ModelService
+from production.model_refresher import FileRegistry, ModelRefresher
+
+MODEL_NAME = "chicago-taxi"
+
+FEATURES_RECORD = {
+    "trip_id": "2b0bbf69fcaa3815ea9280360c01be4e9642f805",
+    "pickup_community_area": "8",
+    "dropoff_community_area": "32",
+}
+
+
+class ConstantModel:
+    def __init__(self, value: float, release: threading.Event = None):
+        self.value = value
+        self.release = release
+        self.started = threading.Event()
+
+    def predict(self, features):
+        # Blocks until released, to simulate a prediction in flight
+        self.started.set()
+        if self.release is not None:
+            self.release.wait(5)
+        return [self.value] * len(features[FEATURES[0]])
+
+
+def make_registry(tmp_path, models: dict):
+    # The version directory name is mapped to a model instead of an mlflow model
+    return FileRegistry(
+        str(tmp_path), loader=lambda location: models[location.split("/")[-1]]
+    )
+
+
+def test_model_refresher_swaps_new_version(tmp_path):
+
+    registry = make_registry(
+        tmp_path, {"1": ConstantModel(1.0), "2": ConstantModel(2.0)}
+    )
+    registry.transition(MODEL_NAME, "1", "Staging")
+    model_service = ModelService(ConstantModel(1.0), metadata={"version": "1"})
+    refresher = ModelRefresher(model_service, registry, MODEL_NAME, "Staging")
+
+    assert not refresher.refresh()
+
+    registry.transition(MODEL_NAME, "2", "Staging")
+    assert refresher.refresh()
+
+    prediction = model_service.lambda_handler(FEATURES_RECORD)
+    assert prediction["prediction"] == 2.0
+    assert prediction["model_version"] == "2"
+    assert refresher.stats["swaps"] == 1
+    assert refresher.stats["version"] == "2"
+
+
+def test_model_refresher_in_flight_prediction_keeps_old_model(tmp_path):
+
+    release = threading.Event()
+    old_model = ConstantModel(1.0, release)
+    registry = make_registry(tmp_path, {"2": ConstantModel(2.0)})
+    model_service = ModelService(old_model, metadata={"version": "1"})
+    refresher = ModelRefresher(model_service, registry, MODEL_NAME, "Staging")
+
+    result = {}
+    request = threading.Thread(
+        target=lambda: result.update(model_service.lambda_handler(FEATURES_RECORD))
+    )
+    request.start()
+    assert old_model.started.wait(5)
+
+    registry.transition(MODEL_NAME, "2", "Staging")
+    assert refresher.refresh()
+    release.set()
+    request.join(5)
+
+    assert result["prediction"] == 1.0
+    assert result["model_version"] == "1"
+    assert model_service.lambda_handler(FEATURES_RECORD)["model_version"] == "2"
+
+
+def test_model_refresher_background_polling(tmp_path):
+
+    registry = make_registry(tmp_path, {"2": ConstantModel(2.0)})
+    model_service = ModelService(ConstantModel(1.0), metadata={"version": "1"})
+    refresher = ModelRefresher(
+        model_service, registry, MODEL_NAME, "Production", interval_sec=0.01
+    ).start()
+
+    registry.transition(MODEL_NAME, "2", "Production")
+    try:
+        for _ in range(500):
+            if model_service.version == "2":
+                break
+            threading.Event().wait(0.01)
+    finally:
+        refresher.stop(timeout=5)
+
+    assert model_service.version == "2"
+    assert refresher.stats["errors"] == 0
+
+
+def test_model_refresher_exports_stats(tmp_path):
+
+    registry = make_registry(
+        tmp_path, {"1": ConstantModel(1.0), "2": ConstantModel(2.0)}
+    )
+    registry.transition(MODEL_NAME, "1", "Staging")
+    model_service = ModelService(ConstantModel(1.0), metadata={"version": "1"})
+    prometheus = CollectorRegistry()
+    stream = io.StringIO()
+    timer = StageTimer(0.0, [PrometheusSink(prometheus), EmfSink(stream=stream)])
+    timer.record_model({"version": model_service.version})
+    refresher = ModelRefresher(
+        model_service, registry, MODEL_NAME, "Staging", sinks=timer.sinks
+    )
+
+    refresher.poll()
+    registry.transition(MODEL_NAME, "2", "Staging")
+    refresher.poll()
+    registry.transition(MODEL_NAME, "3", "Staging")
+    # Version 3 has no model
+    refresher.poll()
+
+    def sample(name, labels=None):
+        return prometheus.get_sample_value(name, labels or {})
+
+    assert sample("prediction_model_version_info", {"version": "2"}) == 1
+    assert sample("prediction_model_version_info", {"version": "1"}) == 0
+    assert sample("model_refresh_polls_total") == 3
+    assert sample("model_refresh_swaps_total") == 1
+    assert sample("model_refresh_errors_total") == 1
+
+    # One EMF line per record, with the increments of the counters
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["ModelVersion"] for line in lines] == ["1", "1", "2", "2"]
+    assert [line["model_refresh_swaps"] for line in lines] == [0, 0, 1, 0]
+    assert [line["model_refresh_errors"] for line in lines] == [0, 0, 0, 1]
+    assert sum(line["model_refresh_polls"] for line in lines) == 3
+    metrics = lines[-1]["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    assert {"Name": "model_refresh_swaps", "Unit": "Count"} in metrics
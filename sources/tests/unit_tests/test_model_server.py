@@ -0,0 +1,196 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from production.model_server import MicroBatcher, create_app
+from production.model_service import DummyModel, ModelService
+
+RECORD = {
+    "trip_id": "2b0bbf69fcaa3815ea9280360c01be4e9642f805",
+    "pickup_community_area": "8",
+    "dropoff_community_area": "32",
+}
+EXPECTED_PREDICTION = {**RECORD, "prediction": 40.0}
+BATCH = {
+    "trip_id": ["a", "b", "c"],
+    "pickup_community_area": ["8", "1", "-1"],
+    "dropoff_community_area": ["32", "77", "5"],
+}
+
+
+class CountingModel(DummyModel):
+    # Records the size of each call to predict
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def predict(self, features):
+        with self.lock:
+            self.calls.append(len(features["pickup_community_area"]))
+        return super().predict(features)
+
+
+class StrictModel(CountingModel):
+    # Fails on an unknown area, as OneHotEncoder(handle_unknown="error")
+    def predict(self, features):
+        predictions = super().predict(features)
+        if "999" in list(features["pickup_community_area"]):
+            raise ValueError("Found unknown categories ['999']")
+        return predictions
+
+
+@pytest.fixture(name="batcher")
+def fixture_batcher():
+    service = ModelService(CountingModel(), metadata={"version": "3"})
+    batcher = MicroBatcher(service, max_batch_size=16, max_wait_ms=50).start()
+    yield batcher
+    batcher.stop()
+
+
+def test_micro_batcher_groups_records(batcher):
+
+    records = [
+        {
+            "trip_id": str(i),
+            "pickup_community_area": str(i),
+            "dropoff_community_area": "1",
+        }
+        for i in range(32)
+    ]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = list(executor.map(lambda record: batcher.predict(record, 5), records))
+
+    assert results == [
+        {**record, "prediction": float(i + 1), "model_version": "3"}
+        for i, record in enumerate(records)
+    ]
+    # Fewer calls to the model than records
+    assert sum(batcher.service.model.calls) == 32
+    assert batcher.stats["batches"] == len(batcher.service.model.calls) < 32
+
+
+def test_micro_batcher_errors(batcher):
+
+    batcher.service.set_model(None)
+    with pytest.raises(AttributeError):
+        batcher.predict(RECORD, 5)
+    assert batcher.stats["errors"] == 1
+
+
+def test_micro_batcher_bad_record_fails_alone():
+
+    batcher = MicroBatcher(ModelService(StrictModel()), max_batch_size=16)
+    bad_record = {**RECORD, "pickup_community_area": "999"}
+    # Queued before the batcher starts, so that they are in the same batch
+    futures = [batcher.submit(record) for record in [RECORD, bad_record, RECORD]]
+    batcher.start()
+    try:
+        assert futures[0].result(5) == EXPECTED_PREDICTION
+        with pytest.raises(ValueError, match="unknown categories"):
+            futures[1].result(5)
+        assert futures[2].result(5) == EXPECTED_PREDICTION
+    finally:
+        batcher.stop()
+
+    # The batch, then each record
+    assert batcher.service.model.calls == [3, 1, 1, 1]
+    assert batcher.stats == {
+        "records": 2,
+        "batches": 0,
+        "fallbacks": 1,
+        "errors": 1,
+        "cancelled": 0,
+    }
+
+
+def test_micro_batcher_skips_timed_out_records():
+
+    batcher = MicroBatcher(ModelService(CountingModel()), max_batch_size=16)
+    # Not started: the request times out before its record is taken
+    with pytest.raises(FutureTimeoutError):
+        batcher.predict(RECORD, 0.05)
+    batcher.start()
+    try:
+        assert batcher.predict(RECORD, 5) == EXPECTED_PREDICTION
+    finally:
+        batcher.stop()
+
+    assert batcher.service.model.calls == [1]
+    assert batcher.stats["cancelled"] == 1
+    assert batcher.stats["records"] == 1
+
+
+def test_predict_bad_input():
+
+    batcher = MicroBatcher(ModelService(StrictModel()), max_batch_size=16).start()
+    client = create_app(batcher.service, batcher).test_client()
+    bad_record = {**RECORD, "pickup_community_area": "999"}
+    try:
+        response = client.post("/predict", json=bad_record)
+        assert response.status_code == 400
+        assert b"unknown categories" in response.data
+        batch = {key: [value] for key, value in bad_record.items()}
+        assert client.post("/predict/batch", json=batch).status_code == 400
+        # Missing feature
+        response = client.post("/predict", json=[{"trip_id": "a"}])
+        assert response.status_code == 400
+        assert b"KeyError" in response.data
+        assert client.post("/predict", json=RECORD).status_code == 200
+    finally:
+        batcher.stop()
+
+
+def test_predict_routes(batcher):
+
+    inputs = []
+    predictions = []
+    service = batcher.service
+
+    def on_prediction(input_data, prediction):
+        inputs.append(input_data)
+        predictions.append(prediction)
+
+    app = create_app(service, batcher, on_prediction=on_prediction)
+    client = app.test_client()
+
+    response = client.post("/predict", json=RECORD)
+    assert response.status_code == 200
+    assert response.json == {**EXPECTED_PREDICTION, "model_version": "3"}
+
+    response = client.post("/predict", json=[RECORD, RECORD])
+    assert response.json == [40.0, 40.0]
+
+    response = client.post("/predict/batch", json=BATCH)
+    assert response.json == {
+        "trip_id": ["a", "b", "c"],
+        "prediction": [40.0, 78.0, 4.0],
+        "model_version": "3",
+    }
+    response = client.post(
+        "/predict/batch",
+        data="\n".join(json.dumps(RECORD) for _ in range(2)),
+        content_type="application/x-ndjson",
+    )
+    assert response.json["prediction"] == [40.0, 40.0]
+    # Decoded once: on_prediction gets the columns, not the body
+    assert inputs[-1]["trip_id"].tolist() == [RECORD["trip_id"]] * 2
+
+    assert client.post("/predict/batch", json=RECORD).status_code == 400
+    assert (
+        client.post("/predict", data="{", content_type="application/json").status_code
+        == 400
+    )
+    assert client.get("/health").json == {"status": "ok", "model_version": "3"}
+    assert client.get("/metrics").status_code == 200
+    assert len(predictions) == 4
+
+
+def test_predict_without_batcher():
+
+    app = create_app(ModelService(DummyModel()))
+    response = app.test_client().post("/predict", json=RECORD)
+    assert response.json == EXPECTED_PREDICTION
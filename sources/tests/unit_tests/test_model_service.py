@@ -1,8 +1,10 @@
+import json
 from pathlib import Path
 
 from deepdiff import DeepDiff
 
 from production.model_service import ModelService
+from production.model_service import DummyModel as VectorizedDummyModel
 
 FEATURES = {
     "trip_id": "2b0bbf69fcaa3815ea9280360c01be4e9642f805",
@@ -17,6 +19,17 @@ EXPECTED_RESULT = {
     "prediction": 40.0,
 }
 
+BATCH_FEATURES = {
+    "trip_id": ["a", "b", "c"],
+    "pickup_community_area": ["8", "1", "-1"],
+    "dropoff_community_area": ["32", "77", "5"],
+}
+
+EXPECTED_BATCH_RESULT = {
+    "trip_id": ["a", "b", "c"],
+    "prediction": [40.0, 78.0, 4.0],
+}
+
 
 def read_text(file):
     test_directory = Path(__file__).parent
@@ -53,6 +66,50 @@ def test_model_service(features=FEATURES, expected_result=EXPECTED_RESULT):
     return actual_prediction
 
 
+def test_model_service_columnar_batch(
+    features=BATCH_FEATURES, expected_result=EXPECTED_BATCH_RESULT
+):
+
+    model_service = ModelService(VectorizedDummyModel())
+    actual_prediction = model_service.lambda_handler(features)
+
+    diff = DeepDiff(actual_prediction, expected_result, significant_digits=1)
+
+    assert "type_changes" not in diff
+    assert "values_changed" not in diff
+    assert "iterable_item_added" not in diff
+    assert "iterable_item_removed" not in diff
+
+
+def test_model_service_json_lines_batch(
+    features=BATCH_FEATURES, expected_result=EXPECTED_BATCH_RESULT
+):
+
+    body = "\n".join(
+        json.dumps(dict(zip(features, values))) for values in zip(*features.values())
+    )
+    model_service = ModelService(VectorizedDummyModel())
+    actual_prediction = model_service.lambda_handler(body + "\n")
+
+    diff = DeepDiff(actual_prediction, expected_result, significant_digits=1)
+
+    assert "type_changes" not in diff
+    assert "values_changed" not in diff
+    assert "iterable_item_added" not in diff
+    assert "iterable_item_removed" not in diff
+
+
+def test_model_service_batch_matches_row_path(features=BATCH_FEATURES):
+
+    model_service = ModelService(VectorizedDummyModel())
+    records = [dict(zip(features, values)) for values in zip(*features.values())]
+
+    row_predictions = model_service.lambda_handler(records)
+    batch_predictions = model_service.lambda_handler(features)["prediction"]
+
+    assert row_predictions == batch_predictions
+
+
 if __name__ == "__main__":
 
     actual_prediction = test_model_service(FEATURES)
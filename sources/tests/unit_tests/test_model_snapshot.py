@@ -0,0 +1,73 @@
+import os
+
+import mlflow.sklearn
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.pipeline import make_pipeline
+from sklearn.linear_model import LinearRegression
+from sklearn.preprocessing import OneHotEncoder
+
+from production import model_service
+from production.model_service import FEATURES, init_model_local
+
+FEATURES_DF = pd.DataFrame(
+    {
+        "pickup_community_area": ["8", "1", "-1", "32"],
+        "dropoff_community_area": ["32", "77", "5", "8"],
+    }
+)
+
+
+@pytest.fixture(name="model_location")
+def fixture_model_location(tmp_path):
+
+    pipeline = make_pipeline(OneHotEncoder(), LinearRegression())
+    pipeline.fit(FEATURES_DF[FEATURES], np.arange(len(FEATURES_DF), dtype=float))
+    location = str(tmp_path / "model")
+    mlflow.sklearn.save_model(pipeline, location, serialization_format="cloudpickle")
+    return location
+
+
+def test_model_snapshot(model_location, tmp_path, monkeypatch):
+
+    snapshot_dir = str(tmp_path / "snapshots")
+
+    cold = init_model_local(model_location, snapshot_dir=snapshot_dir)
+    assert cold.metadata["snapshot"] == "miss"
+
+    # Next cold starts must not go through mlflow's load_model
+    def fail_load_model(*args, **kwargs):
+        raise AssertionError("load_model should not be called")
+
+    monkeypatch.setattr(model_service, "load_model", fail_load_model)
+    warm = init_model_local(model_location, snapshot_dir=snapshot_dir)
+
+    assert warm.metadata["snapshot"] == "hit"
+    np.testing.assert_allclose(
+        warm.predict(FEATURES_DF), cold.predict(FEATURES_DF), rtol=1e-12
+    )
+
+
+def test_model_snapshot_disabled(model_location):
+
+    service = init_model_local(model_location, snapshot_dir="")
+
+    assert service.metadata["snapshot"] == "disabled"
+    assert len(service.predict(FEATURES_DF)) == len(FEATURES_DF)
+
+
+def test_model_snapshot_without_key(model_location, tmp_path):
+
+    # e.g. a model saved by an mlflow version without model_uuid
+    mlmodel_path = os.path.join(model_location, "MLmodel")
+    with open(mlmodel_path) as f_in:
+        lines = [line for line in f_in if not line.startswith("model_uuid:")]
+    with open(mlmodel_path, "w") as f_out:
+        f_out.writelines(lines)
+    snapshot_dir = tmp_path / "snapshots"
+
+    service = init_model_local(model_location, snapshot_dir=str(snapshot_dir))
+
+    assert service.metadata["snapshot"] == "disabled"
+    assert not snapshot_dir.exists()
@@ -0,0 +1,220 @@
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+import pyarrow as pa
+import prometheus_client
+from evidently.pipeline.column_mapping import ColumnMapping
+
+import app
+from app import LoadedDataset, MonitoringService
+
+CATEGORICAL = ["pickup_community_area", "dropoff_community_area"]
+CATEGORIES = [str(area) for area in range(1, 10)]
+
+
+def make_service(window_size: int) -> MonitoringService:
+
+    rng = np.random.default_rng(0)
+    reference = pd.DataFrame(
+        {column: rng.choice(CATEGORIES, size=300) for column in CATEGORICAL}
+    )
+    dataset = LoadedDataset(
+        name="taxi",
+        references=reference,
+        monitors=["data_drift"],
+        column_mapping=ColumnMapping(
+            categorical_features=CATEGORICAL, numerical_features=[]
+        ),
+    )
+    return MonitoringService(
+        {"taxi": dataset},
+        window_size=window_size,
+        registry=prometheus_client.CollectorRegistry(),
+    )
+
+
+def make_rows(n_rows: int):
+    return [
+        {
+            "trip_id": str(i),
+            "pickup_community_area": CATEGORIES[i % len(CATEGORIES)],
+            "dropoff_community_area": "3",
+            "prediction": 1.0,
+        }
+        for i in range(n_rows)
+    ]
+
+
+def test_monitoring_service_waits_for_full_window():
+
+    service = make_service(window_size=50)
+    service.iterate("taxi", make_rows(49))
+
+    assert len(service.current["taxi"]) == 49
+    assert not service.run_pending()
+    assert not service.metrics
+
+
+def test_monitoring_service_calculates_drift():
+
+    service = make_service(window_size=50)
+    for row in make_rows(60):
+        service.iterate("taxi", [row])
+    # iterate only appends to the window
+    assert not service.metrics
+
+    for future in service.run_pending():
+        future.result()
+
+    assert len(service.current["taxi"]) == 50
+    # All dropoffs are "3": the dropoff column drifts
+    drifted = service.registry.get_sample_value(
+        "evidently:data_drift:n_drifted_features", {"dataset_name": "taxi"}
+    )
+    assert drifted >= 1
+    assert service.stats["calculations"] == 1
+
+
+def test_monitoring_service_skips_busy_calculations():
+
+    service = make_service(window_size=50)
+    service.calculation_period_sec = 0
+    service.iterate("taxi", make_rows(50))
+
+    release = threading.Event()
+    calculate = service.calculate
+
+    def slow_calculate(dataset_name, window):
+        release.wait(5)
+        calculate(dataset_name, window)
+
+    service.calculate = slow_calculate
+    futures = service.run_pending()
+    # The first calculation is still running
+    assert not service.run_pending()
+    assert service.stats["skipped"] == 1
+
+    release.set()
+    for future in futures:
+        future.result()
+    assert service.stats["calculations"] == 1
+    assert service.stats["overruns"] == 1
+    assert service.registry.get_sample_value("evidently_service:skipped") == 1
+    service.stop()
+
+
+def test_categorical_drift_exported_with_evidently_metrics():
+
+    service = make_service(window_size=50)
+    service.iterate("taxi", make_rows(60))
+    for future in service.run_pending():
+        future.result()
+
+    for column in CATEGORICAL:
+        # The reference of the service has less than 1000 rows: evidently uses
+        # the chi-square test
+        evidently_value = service.registry.get_sample_value(
+            "evidently:data_drift:value",
+            {
+                "dataset_name": "taxi",
+                "feature": column,
+                "feature_type": "cat",
+                "stat_test": "chi-square p_value",
+            },
+        )
+        value = service.registry.get_sample_value(
+            "evidently:categorical_drift:value",
+            {"dataset_name": "taxi", "feature": column, "stat_test": "chisquare"},
+        )
+        assert value == pytest.approx(evidently_value, rel=1e-9)
+
+
+class BrokenDrift:
+    def statistics(self):
+        raise ValueError("broken window")
+
+
+def test_collect_skips_failing_monitor():
+
+    service = make_service(window_size=50)
+    service.iterate("taxi", make_rows(60))
+    service.categorical_drift = {"broken": BrokenDrift(), **service.categorical_drift}
+
+    # The other monitors and the service stats are still exported
+    value = service.registry.get_sample_value(
+        "evidently:categorical_drift:value",
+        {"dataset_name": "taxi", "feature": CATEGORICAL[0], "stat_test": "chisquare"},
+    )
+    assert value is not None
+    assert service.registry.get_sample_value("evidently_service:errors") == 0
+
+
+def post_iterate(service: MonitoringService, data, content_type: str):
+
+    app.SERVICE = service
+    try:
+        client = app.app.test_client()
+        return client.post("/iterate/taxi", data=data, content_type=content_type)
+    finally:
+        app.SERVICE = None
+
+
+def test_iterate_endpoint_accepts_one_record():
+
+    service = make_service(window_size=50)
+    response = post_iterate(service, json.dumps(make_rows(1)[0]), "application/json")
+
+    assert response.status_code == 200
+    assert len(service.current["taxi"]) == 1
+
+
+def test_iterate_endpoint_accepts_json_list():
+
+    service = make_service(window_size=50)
+    response = post_iterate(service, json.dumps(make_rows(30)), "application/json")
+
+    assert response.status_code == 200
+    assert len(service.current["taxi"]) == 30
+
+
+def test_iterate_endpoint_accepts_json_lines():
+
+    service = make_service(window_size=50)
+    body = "\n".join(json.dumps(row) for row in make_rows(30))
+    response = post_iterate(service, body, "application/x-ndjson")
+
+    assert response.status_code == 200
+    assert len(service.current["taxi"]) == 30
+
+
+def test_iterate_endpoint_accepts_arrow_stream():
+
+    service = make_service(window_size=50)
+    table = pa.Table.from_pylist(make_rows(60))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    response = post_iterate(
+        service, sink.getvalue().to_pybytes(), "application/vnd.apache.arrow.stream"
+    )
+
+    assert response.status_code == 200
+    assert len(service.current["taxi"]) == 50
+    # Same window as sending the rows one by one
+    expected = make_service(window_size=50)
+    expected.iterate("taxi", make_rows(60))
+    assert (
+        service.current["taxi"].to_frame().equals(expected.current["taxi"].to_frame())
+    )
+
+
+def test_iterate_endpoint_rejects_bad_body():
+
+    service = make_service(window_size=50)
+    response = post_iterate(service, "{not json", "application/x-ndjson")
+
+    assert response.status_code == 400
+    assert len(service.current["taxi"]) == 0
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from development.preprocessor import Preprocessor
+from development.preprocessing_cache import PreprocessingCache
+from tests.unit_tests.test_preprocessor_csv import (
+    DTYPE,
+    DATE_FIELDS,
+    CATEGORICAL_FEATURES,
+    make_csv,
+)
+
+
+def process(preprocessor: Preprocessor, csv_path: str):
+    return preprocessor.process(
+        csv_path, DATE_FIELDS, "trip_seconds", CATEGORICAL_FEATURES, DTYPE
+    )
+
+
+def test_preprocessing_cache_hit(tmp_path, monkeypatch):
+
+    csv_path = make_csv(tmp_path)
+    cache = PreprocessingCache(str(tmp_path / "cache"))
+    features, target = process(Preprocessor(cache=cache), csv_path)
+
+    # A repeated run does not parse the file
+    def process_file(*args):
+        raise AssertionError("file processed")
+
+    monkeypatch.setattr(Preprocessor, "process_file", process_file)
+    cached_features, cached_target = process(Preprocessor(cache=cache), csv_path)
+
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+    pd.testing.assert_frame_equal(cached_features, features)
+    assert cached_features["pickup_community_area"].dtype == "category"
+    assert np.array_equal(cached_target, target)
+
+
+def test_preprocessing_cache_key(tmp_path):
+
+    csv_path = make_csv(tmp_path)
+    cache = PreprocessingCache(str(tmp_path / "cache"))
+    key = cache.key(csv_path, {"categorical_features": CATEGORICAL_FEATURES})
+
+    assert cache.key(csv_path, {"categorical_features": CATEGORICAL_FEATURES}) == key
+    assert cache.key(csv_path, {"categorical_features": ["trip_id"]}) != key
+    # Same content in a new file: same key
+    os.rename(csv_path, tmp_path / "renamed.csv")
+    make_csv(tmp_path)
+    assert cache.key(csv_path, {"categorical_features": CATEGORICAL_FEATURES}) == key
+    # New content
+    make_csv(tmp_path, n_rows=100)
+    assert cache.key(csv_path, {"categorical_features": CATEGORICAL_FEATURES}) != key
+
+
+def test_preprocessing_cache_lru_eviction(tmp_path):
+
+    cache = PreprocessingCache(str(tmp_path / "cache"))
+    features = pd.DataFrame({"trip_id": [str(i) for i in range(1000)]})
+    target = np.arange(1000, dtype=float).reshape(-1, 1)
+
+    cache.put("a", features, target)
+    cache.put("b", features, target)
+    # "a" is now the most recently used
+    os.utime(cache.entry_path("b"), (0, 0))
+    assert cache.get("a") is not None
+    cache.max_bytes = cache.size() + cache.entry_path("a").stat().st_size // 2
+    cache.put("c", features, target)
+
+    assert cache.stats["evictions"] == 1
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
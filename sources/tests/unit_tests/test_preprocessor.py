@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from development.preprocessor import Preprocessor, normalize_categorical
+
+CATEGORICAL_FEATURES = ["pickup_community_area", "dropoff_community_area", "trip_id"]
+
+
+def normalize_strings(values: pd.Series) -> pd.Series:
+    # Previous implementation of the categorical formatting
+    return values.fillna(-1).astype("str").str.lower().str.replace(" ", "_")
+
+
+def test_normalize_categorical():
+
+    values = pd.Series(["8", None, "Near West", "near west", "32", np.nan, "8"])
+    normalized = normalize_categorical(values.values)
+
+    assert list(normalized) == list(normalize_strings(values))
+    assert sorted(normalized.categories) == ["-1", "32", "8", "near_west"]
+
+
+def test_normalize_categorical_numbers():
+
+    values = pd.Series([8.0, np.nan, 32.0])
+
+    assert list(normalize_categorical(values.values)) == list(normalize_strings(values))
+
+
+def test_preprocess_data():
+
+    df = pd.DataFrame(
+        {
+            "trip_id": ["a", "b", "c", "d", "e", "f"],
+            "trip_seconds": [30.0, 120.0, np.nan, 600.0, 4000.0, 900.0],
+            "pickup_community_area": ["8", None, "8", "32", "1", "Loop Area"],
+            "dropoff_community_area": ["1", "2", "3", None, "5", "6"],
+            "fare": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        }
+    )
+
+    features, target = Preprocessor().preprocess_data(df, CATEGORICAL_FEATURES, [])
+
+    assert list(features.columns) == CATEGORICAL_FEATURES
+    assert list(features.index) == [1, 3, 5]
+    assert all(features[column].dtype == "category" for column in features)
+    assert features.astype(str).to_dict("list") == {
+        "pickup_community_area": ["-1", "32", "loop_area"],
+        "dropoff_community_area": ["2", "-1", "6"],
+        "trip_id": ["b", "d", "f"],
+    }
+    assert target.shape == (3, 1)
+    assert np.allclose(target[:, 0], [2.0, 10.0, 15.0])
+    # The input frame is not modified
+    assert list(df.columns) == [
+        "trip_id",
+        "trip_seconds",
+        "pickup_community_area",
+        "dropoff_community_area",
+        "fare",
+    ]
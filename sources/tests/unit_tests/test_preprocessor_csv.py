@@ -0,0 +1,126 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from development import preprocessor
+from development.preprocessor import Preprocessor
+
+DATE_FIELDS = ["Trip Start Timestamp", "Trip End Timestamp"]
+DTYPE = {"Pickup Community Area": str, "Dropoff Community Area": str}
+CATEGORICAL_FEATURES = ["pickup_community_area", "dropoff_community_area", "trip_id"]
+HEADER = (
+    "Trip ID,Trip Start Timestamp,Trip End Timestamp,Trip Seconds,Trip Miles,"
+    "Pickup Community Area,Dropoff Community Area,Fare,Payment Type,"
+    "Dropoff Centroid  Location"
+)
+
+
+def make_csv(tmp_path, n_rows: int = 500) -> str:
+
+    lines = [HEADER]
+    for i in range(n_rows):
+        # Decimals and empty values only after the first rows
+        miles = f"{i}.5" if i > n_rows // 2 else str(i)
+        pickup = "" if i % 7 == 0 else str(i % 77 + 1)
+        location = "" if i < n_rows // 2 else f"POINT (-87.{i} 41.{i})"
+        lines.append(
+            f"{i:040x},04/01/2022 0{i % 9 + 1}:15:00 PM,04/01/2022 0{i % 9 + 1}:45:00 PM,"
+            f"{i * 3},{miles},{pickup},0{i % 9 + 1},{i * 0.25},Cash,{location}"
+        )
+    csv_path = tmp_path / "Taxi_Trips_2022_04.csv"
+    csv_path.write_text("\n".join(lines) + "\n")
+    return str(csv_path)
+
+
+def read_dataframe_pandas(file_path: str) -> pd.DataFrame:
+    # Previous read_dataframe_csv, without the parquet file
+    df = pd.read_csv(file_path, parse_dates=DATE_FIELDS, dtype=DTYPE)
+    df.columns = df.columns.str.lower().str.replace(" ", "_")
+    return df
+
+
+def test_read_dataframe_csv_streaming(tmp_path, monkeypatch):
+
+    # Many small blocks
+    monkeypatch.setattr(preprocessor, "CSV_BLOCK_SIZE", 4096)
+    csv_path = make_csv(tmp_path)
+
+    df = Preprocessor().read_dataframe(csv_path, DATE_FIELDS, DTYPE)
+    parquet_path = Preprocessor().read_dataframe_csv(csv_path, DATE_FIELDS, DTYPE)
+    expected = read_dataframe_pandas(csv_path)
+
+    assert parquet_path == str(tmp_path / "Taxi_Trips_2022_04.parquet")
+    pd.testing.assert_frame_equal(pd.read_parquet(parquet_path), df)
+    # Same values and types, except that integers are read as floats
+    expected = expected.astype(
+        {column: float for column in ["trip_seconds", "trip_miles", "fare"]}
+    )
+    assert list(df.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+    assert df["trip_start_timestamp"].dtype == np.dtype("datetime64[ns]")
+    assert df["pickup_community_area"].isna().sum() == 72
+
+
+def test_read_dataframe_parquet_pushdown(tmp_path):
+
+    csv_path = make_csv(tmp_path)
+    parquet_path = Preprocessor().read_dataframe_csv(csv_path, DATE_FIELDS, DTYPE)
+    columns = preprocessor.preprocessing_columns(CATEGORICAL_FEATURES, [])
+
+    df = Preprocessor().read_dataframe_parquet(
+        parquet_path, columns=columns, filters=preprocessor.TRIP_SECONDS_FILTERS
+    )
+    full = Preprocessor().read_dataframe_parquet(parquet_path)
+    expected = full[(full.trip_seconds > 60) & (full.trip_seconds < 3600)][columns]
+
+    assert list(df.columns) == columns
+    pd.testing.assert_frame_equal(df, expected.reset_index(drop=True))
+    # The filter does not change the preprocessed data
+    features, target = Preprocessor().preprocess_data(df, CATEGORICAL_FEATURES, [])
+    expected_features, expected_target = Preprocessor().preprocess_data(
+        full, CATEGORICAL_FEATURES, []
+    )
+    assert features.reset_index(drop=True).equals(
+        expected_features.reset_index(drop=True)
+    )
+    assert np.array_equal(target, expected_target)
+
+
+def test_process_reads_converted_parquet(tmp_path, monkeypatch):
+
+    csv_path = make_csv(tmp_path)
+    first = Preprocessor().process(
+        csv_path, DATE_FIELDS, "trip_seconds", CATEGORICAL_FEATURES, DTYPE
+    )
+
+    # The csv is not read again
+    def read_dataframe(*args):
+        raise AssertionError("csv read")
+
+    monkeypatch.setattr(Preprocessor, "read_dataframe", read_dataframe)
+    second = Preprocessor().process(
+        csv_path, DATE_FIELDS, "trip_seconds", CATEGORICAL_FEATURES, DTYPE
+    )
+
+    assert first[0].reset_index(drop=True).equals(second[0].reset_index(drop=True))
+    assert np.array_equal(first[1], second[1])
+
+
+def test_read_dataframe_csv_type_changes_after_first_block(tmp_path, monkeypatch):
+
+    # Numbers in the first block, text in the last rows
+    monkeypatch.setattr(preprocessor, "CSV_BLOCK_SIZE", 4096)
+    csv_path = make_csv(tmp_path)
+    lines = Path(csv_path).read_text().splitlines()
+    fields = lines[-1].split(",")
+    fields[3] = "unknown"
+    lines[-1] = ",".join(fields)
+    Path(csv_path).write_text("\n".join(lines) + "\n")
+
+    df = Preprocessor().read_dataframe(csv_path, DATE_FIELDS, DTYPE)
+    expected = read_dataframe_pandas(csv_path)
+
+    assert df["trip_seconds"].iloc[-1] == "unknown"
+    assert list(df["trip_seconds"]) == list(expected["trip_seconds"])
+    assert df["trip_miles"].dtype == np.dtype("float64")
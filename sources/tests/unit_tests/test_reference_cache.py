@@ -0,0 +1,66 @@
+import pandas as pd
+
+from reference_cache import cache_key, load_reference_data
+
+CONFIG = {"categorical_features": ["pickup_community_area"], "dtype": {"a": str}}
+
+
+def make_source(tmp_path, content: str = "a,b\n1,2\n"):
+
+    source_path = tmp_path / "Taxi_Trips.csv"
+    source_path.write_text(content)
+    return str(source_path)
+
+
+def test_reference_cache_hit(tmp_path):
+
+    source_path = make_source(tmp_path)
+    reference = pd.DataFrame(
+        {
+            "pickup_community_area": ["8", "32", "8", "-1"] * 5,
+            "trip_id": [str(i) for i in range(20)],
+            "target": [float(i) for i in range(20)],
+        }
+    )
+    calls = []
+
+    def preprocess():
+        calls.append(1)
+        return reference.copy()
+
+    cache_dir = str(tmp_path / "cache")
+    first = load_reference_data(source_path, CONFIG, preprocess, cache_dir)
+    second = load_reference_data(source_path, CONFIG, preprocess, cache_dir)
+
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, second)
+    # Low cardinality columns are stored as categories
+    assert second["pickup_community_area"].dtype == "category"
+    assert second["trip_id"].dtype == object
+    assert second.astype({"pickup_community_area": object}).equals(reference)
+
+
+def test_reference_cache_key(tmp_path):
+
+    source_path = make_source(tmp_path)
+    key = cache_key(source_path, CONFIG)
+
+    assert cache_key(source_path, {**CONFIG, "dtype": {"a": float}}) != key
+    make_source(tmp_path, "a,b\n1,3\n")
+    assert cache_key(source_path, CONFIG) != key
+
+
+def test_reference_cache_disabled(tmp_path):
+
+    source_path = make_source(tmp_path)
+    calls = []
+
+    def preprocess():
+        calls.append(1)
+        return pd.DataFrame({"a": [1]})
+
+    load_reference_data(source_path, CONFIG, preprocess, "")
+    load_reference_data(source_path, CONFIG, preprocess, "")
+
+    assert len(calls) == 2
+    assert not list(tmp_path.glob("**/*.parquet"))
@@ -0,0 +1,211 @@
+import time
+import asyncio
+import threading
+
+import flask
+import mongomock
+import pandas as pd
+import pytest
+from werkzeug.serving import make_server
+
+from monitoring.batch.replay import ReplayClient, TimerWheel
+from monitoring.batch.send_data import trip_start_timestamps
+
+RECORDS = [
+    {
+        "trip_id": f"trip-{i}",
+        "pickup_community_area": str(i % 7),
+        "dropoff_community_area": str(i % 3),
+    }
+    for i in range(40)
+]
+
+
+@pytest.fixture(name="prediction_api")
+def fixture_prediction_api():
+    # Local stand-in of the prediction service: a record gets the record with its
+    # prediction, a list of records the list of predictions
+    app = flask.Flask(__name__)
+    app.config["requests"] = []
+    app.config["times"] = []
+    # Batches with trip-13 get one prediction less
+    app.config["short_batches"] = False
+
+    def predict(record):
+        return float(record["pickup_community_area"]) + 0.5
+
+    @app.route("/predict", methods=["POST"])
+    def predict_route():
+        body = flask.request.get_json()
+        app.config["requests"].append(body)
+        app.config["times"].append(time.perf_counter())
+        if isinstance(body, list):
+            predictions = [predict(record) for record in body]
+            trip_ids = [record["trip_id"] for record in body]
+            if app.config["short_batches"] and "trip-13" in trip_ids:
+                predictions = predictions[:-1]
+            return flask.jsonify(predictions)
+        if body["trip_id"] == "trip-13":
+            return "Internal Server Error", 500
+        return flask.jsonify({**body, "prediction": predict(body)})
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, f"http://127.0.0.1:{server.server_port}/predict"
+    server.shutdown()
+    thread.join()
+
+
+def test_replay_batches(prediction_api):
+
+    app, url = prediction_api
+    collection = mongomock.MongoClient().db.data
+    client = ReplayClient(
+        url, concurrency=4, batch_size=6, collection=collection, insert_batch_size=10
+    )
+
+    report = client.replay(RECORDS)
+
+    assert len(app.config["requests"]) == 7
+    assert report["requests"] == 7
+    assert report["records"] == 40
+    assert report["inserted"] == 40
+    assert sorted(report["latency_ms"]) == ["p50", "p95", "p99"]
+    documents = {
+        document["trip_id"]: document for document in collection.find({}, {"_id": 0})
+    }
+    assert documents == {
+        record["trip_id"]: {
+            **record,
+            "prediction": float(record["pickup_community_area"]) + 0.5,
+        }
+        for record in RECORDS
+    }
+
+
+def test_replay_rate_and_errors(prediction_api):
+
+    app, url = prediction_api
+    collection = mongomock.MongoClient().db.data
+    client = ReplayClient(url, concurrency=2, rate=100, collection=collection)
+
+    start = time.perf_counter()
+    report = client.replay(RECORDS[:20])
+
+    # 20 requests at 100 requests/sec
+    assert time.perf_counter() - start >= 0.19
+    # One record per request
+    assert all(isinstance(body, dict) for body in app.config["requests"])
+    assert report["errors"] == 1
+    assert report["records"] == 19
+    assert collection.count_documents({}) == 19
+    assert collection.count_documents({"trip_id": "trip-13"}) == 0
+
+
+def test_replay_prediction_count_mismatch(prediction_api):
+
+    app, url = prediction_api
+    app.config["short_batches"] = True
+    collection = mongomock.MongoClient().db.data
+    client = ReplayClient(url, batch_size=5, collection=collection)
+
+    report = client.replay(RECORDS)
+
+    # The batch of trip-10 to trip-14 is not stored
+    assert report["errors"] == 1
+    assert report["records"] == 35
+    assert collection.count_documents({}) == 35
+    assert collection.count_documents({"trip_id": "trip-10"}) == 0
+
+
+def test_timer_wheel():
+
+    # Small wheel: the timers of the last tick are in a later round of its slot
+    wheel = TimerWheel(tick_sec=0.01, n_slots=8)
+    fired = []
+    for delay, name in [(0.25, "c"), (0.0, "a1"), (0.0, "a2"), (0.05, "b")]:
+        wheel.schedule(
+            delay, lambda name: fired.append((name, time.perf_counter())), name
+        )
+
+    start = time.perf_counter()
+    asyncio.run(wheel.run())
+
+    assert [name for name, _ in fired] == ["a1", "a2", "b", "c"]
+    offsets = [fired_at - start for _, fired_at in fired]
+    # Timers never fire early. The upper bounds allow for a busy test machine
+    assert offsets[1] - offsets[0] < 0.02
+    assert 0.05 - 0.01 <= offsets[2] < 0.05 + 0.05
+    assert 0.25 - 0.01 <= offsets[3] < 0.25 + 0.05
+    assert len(wheel.lags) == 4
+    assert wheel.pending == 0
+
+
+def test_replay_timed(prediction_api):
+
+    app, url = prediction_api
+    collection = mongomock.MongoClient().db.data
+    # A burst of 3 trips, then trips 1, 2 and 10 minutes later
+    timestamps = pd.Series(
+        pd.to_datetime(
+            [
+                "2022-04-01 08:00:00",
+                "2022-04-01 08:00:00",
+                "2022-04-01 08:00:00",
+                "2022-04-01 08:01:00",
+                "2022-04-01 08:02:00",
+                "2022-04-01 08:10:00",
+            ]
+        )
+    )
+    client = ReplayClient(url, concurrency=4, batch_size=2, collection=collection)
+
+    # Arrivals are measured from the start of the replay, not from the first
+    # arrival, which also includes the connection setup of its request
+    start = time.perf_counter()
+    report = client.replay_timed(RECORDS[:6], timestamps, speedup=600)
+
+    # The burst is sent together, 2 trips per request
+    assert [len(body) for body in app.config["requests"]][-3:] == [1, 1, 1]
+    assert sorted(len(body) for body in app.config["requests"][:2]) == [1, 2]
+    times = [t - start for t in app.config["times"]]
+    # 60s, 120s and 600s, 600 times faster
+    for received, expected in zip(times[2:], [0.1, 0.2, 1.0]):
+        assert expected - 0.01 <= received < expected + 0.1
+    assert report["records"] == 6
+    assert collection.count_documents({}) == 6
+    assert sorted(report["schedule_lag_ms"]) == ["p50", "p95", "p99"]
+
+
+class TripsLake:
+    # Data lake with the trips in another order than the preprocessed ones
+    def __init__(self, trips):
+        self.trips = trips
+
+    def read(self, start, end, columns=None, filters=None):
+        # pylint: disable=unused-argument
+        return self.trips[columns]
+
+
+def test_trip_start_timestamps():
+
+    trips = pd.DataFrame(
+        {
+            "trip_id": ["B2", "A1", "C3"],
+            "trip_start_timestamp": pd.to_datetime(
+                ["2022-04-01 10:00", "2022-04-01 09:00", "2022-04-01 11:00"]
+            ),
+        }
+    )
+
+    timestamps = trip_start_timestamps(
+        TripsLake(trips), None, None, ["a1", "c3", "missing", "b2"]
+    )
+
+    assert timestamps.tolist()[:2] == [
+        pd.Timestamp("2022-04-01 09:00"),
+        pd.Timestamp("2022-04-01 11:00"),
+    ]
+    assert pd.isna(timestamps[2])
+    assert timestamps[3] == pd.Timestamp("2022-04-01 10:00")
@@ -0,0 +1,143 @@
+import io
+import os
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+from prometheus_client import CollectorRegistry
+
+from production.model_service import DummyModel, ModelService
+from production.stage_timer import (
+    NULL_TIMINGS,
+    EmfSink,
+    StageTimer,
+    PrometheusSink,
+    RequestTimings,
+)
+
+SOURCES_PATH = str(Path(__file__).parent.parent.parent.resolve())
+RECORD = {
+    "trip_id": "2b0bbf69fcaa3815ea9280360c01be4e9642f805",
+    "pickup_community_area": "8",
+    "dropoff_community_area": "32",
+}
+BATCH = {
+    "pickup_community_area": ["8", "1", "-1"],
+    "dropoff_community_area": ["32", "77", "5"],
+}
+
+
+class ListSink:
+    def __init__(self):
+        self.records = []
+
+    def record(self, seconds):
+        self.records.append(dict(seconds))
+
+
+def test_sampling():
+
+    sink = ListSink()
+    assert StageTimer(0.0, [sink]).request() is NULL_TIMINGS
+    assert StageTimer(1.0, []).request() is NULL_TIMINGS
+    assert isinstance(StageTimer(1.0, [sink]).request(), RequestTimings)
+
+    timer = StageTimer(0.25, [sink])
+    sampled = sum(timer.request().sampled for _ in range(4000))
+    assert 800 < sampled < 1200
+
+
+def test_model_service_stages():
+
+    sink = ListSink()
+    timer = StageTimer(1.0, [sink])
+    service = ModelService(DummyModel(), callbacks=[lambda pred: None])
+
+    for input_data in [RECORD, [RECORD, RECORD], BATCH, json.dumps(RECORD)]:
+        timings = timer.request()
+        service.lambda_handler(input_data, timings)
+        timings.finish()
+
+    assert [sorted(seconds) for seconds in sink.records] == [
+        ["callbacks", "dataframe", "predict"],
+        ["callbacks", "dataframe", "predict"],
+        ["callbacks", "dataframe", "predict"],
+        ["callbacks", "dataframe", "decode", "predict"],
+    ]
+    assert all(value >= 0 for seconds in sink.records for value in seconds.values())
+
+    # Not sampled: same results, nothing recorded
+    assert service.lambda_handler(BATCH, NULL_TIMINGS) == service.lambda_handler(BATCH)
+    NULL_TIMINGS.finish()
+    assert len(sink.records) == 4
+
+
+def test_emf_sink():
+
+    stream = io.StringIO()
+    EmfSink("Test", "service", stream).record({"decode": 0.001, "predict": 0.002})
+
+    line = json.loads(stream.getvalue())
+    metrics = line["_aws"]["CloudWatchMetrics"][0]
+    assert metrics["Namespace"] == "Test"
+    assert metrics["Dimensions"] == [["Service"]]
+    assert [metric["Name"] for metric in metrics["Metrics"]] == [
+        "decode_ms",
+        "predict_ms",
+    ]
+    assert line["Service"] == "service"
+    assert line["predict_ms"] == 2.0
+
+
+def test_prometheus_sink():
+
+    registry = CollectorRegistry()
+    timer = StageTimer(1.0, [PrometheusSink(registry)])
+    for _ in range(3):
+        timings = timer.request()
+        with timings.stage("predict"):
+            pass
+        timings.finish()
+
+    count = registry.get_sample_value(
+        "prediction_stage_seconds_count", {"stage": "predict"}
+    )
+    assert count == 3
+
+
+MULTIPROCESS_SCRIPT = """
+import json
+from prometheus_client import CollectorRegistry, multiprocess
+from production.stage_timer import PrometheusSink
+
+sink = PrometheusSink(CollectorRegistry())
+sink.record_model({"version": "1"})
+sink.record_model({"version": "2", "polls": 1, "swaps": 1})
+
+registry = CollectorRegistry()
+multiprocess.MultiProcessCollector(registry)
+print(json.dumps({
+    sample.labels["version"]: sample.value
+    for metric in registry.collect()
+    if metric.name == "prediction_model_version_info"
+    for sample in metric.samples
+}))
+"""
+
+
+def test_prometheus_sink_model_version_multiprocess(tmp_path):
+
+    # The metrics files of the processes are read at each scrape: the previous
+    # version must be set to 0, removing its label is not enough
+    env = dict(
+        os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path), PYTHONPATH=SOURCES_PATH
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", MULTIPROCESS_SCRIPT],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert json.loads(output.stdout) == {"1": 0.0, "2": 1.0}
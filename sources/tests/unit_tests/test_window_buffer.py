@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from deepdiff import DeepDiff
+
+from window_buffer import WindowBuffer
+
+CATEGORICAL = ["pickup_community_area", "dropoff_community_area"]
+NUMERICAL = ["prediction", "target"]
+
+
+def make_rows(start: int, stop: int):
+    return [
+        {
+            "trip_id": str(i),
+            "pickup_community_area": str(i % 7),
+            "dropoff_community_area": None if i % 5 == 0 else str(i % 3),
+            "prediction": float(i),
+        }
+        for i in range(start, stop)
+    ]
+
+
+def reference_window(rows, window_size: int):
+    # What the DataFrame.append + drop implementation kept
+    df = pd.DataFrame(rows).tail(window_size).reset_index(drop=True)
+    return df[CATEGORICAL + ["prediction"]]
+
+
+def test_window_buffer_keeps_last_rows():
+
+    buffer = WindowBuffer(10, CATEGORICAL, NUMERICAL)
+    rows = make_rows(0, 27)
+    for row in rows[:4]:
+        buffer.append(row)
+    buffer.extend(rows[4:15])
+    buffer.extend(pd.DataFrame(rows[15:27]))
+
+    diff = DeepDiff(
+        buffer.to_frame().to_dict("list"),
+        reference_window(rows, 10).to_dict("list"),
+        ignore_nan_inequality=True,
+    )
+
+    assert len(buffer) == 10
+    assert buffer.total_rows == 27
+    assert not diff
+
+
+def test_window_buffer_not_full():
+
+    buffer = WindowBuffer(10, CATEGORICAL, NUMERICAL)
+    rows = make_rows(0, 3)
+    buffer.extend(rows)
+
+    frame = buffer.to_frame()
+    assert list(frame.columns) == CATEGORICAL + ["prediction"]
+    assert frame.to_dict("list") == reference_window(rows, 10).to_dict("list")
+
+
+def test_window_buffer_batch_larger_than_window():
+
+    buffer = WindowBuffer(5, CATEGORICAL, NUMERICAL)
+    rows = make_rows(0, 13)
+    buffer.extend(rows[:2])
+    buffer.extend(rows[2:])
+
+    assert buffer.to_frame()["prediction"].tolist() == [8.0, 9.0, 10.0, 11.0, 12.0]
+
+
+def test_window_buffer_missing_columns():
+
+    buffer = WindowBuffer(4, CATEGORICAL, NUMERICAL)
+    buffer.extend([{"pickup_community_area": "1", "prediction": 3}])
+    buffer.extend([{"pickup_community_area": "2", "dropoff_community_area": "8"}])
+
+    frame = buffer.to_frame()
+    assert frame["dropoff_community_area"].tolist() == [None, "8"]
+    assert np.isnan(frame["prediction"].iloc[1])
+    assert "target" not in frame
+
+
+def test_window_buffer_counts_categories():
+
+    buffer = WindowBuffer(10, CATEGORICAL, NUMERICAL)
+    rows = make_rows(0, 27)
+    buffer.extend(rows[:4])
+    buffer.extend(rows[4:19])
+    buffer.extend(rows[19:27])
+
+    frame = buffer.to_frame()
+    for column in CATEGORICAL:
+        counts = dict(zip(buffer.categories[column], buffer.counts[column]))
+        expected = frame[column].value_counts().to_dict()
+        assert {value: n for value, n in counts.items() if n} == expected